@@ -1,26 +1,35 @@
 import subprocess
 import re
 import logging
-import pymongo
 import os
 import shutil
+import hashlib
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import Union
-from symbol_engine import find_compilation_blocks_and_lines, CompilationBlock, find_children
-from helpers import get_source_version_info, trigger_compilation_blocks, find_real_source_file, get_source_compilation_command, instrument_source
+from symbol_engine import find_compilation_blocks_and_lines, CompilationBlock, find_children, PARSER_VERSION
+from helpers import get_source_version_info, trigger_compilation_blocks, find_real_source_file, instrument_source, relocate_compilation_command, write_instrumented_source, CommandRelocationError
+from helpers import ProbeMode, get_probe_command, normalize_compilation_command, get_environment_fingerprint, get_build_fingerprint, SourceBuffer, git_commit_strategy, hash_strategy
+from linemarker_engine import trigger_compilation_blocks_linemarkers
+from condition_evaluator import load_config_macros, get_macro_environment, predict_activated_blocks
+from coverage_cache import ResultCache, DEFAULT_CACHE_SIZE, PARSE_NAMESPACE, ACTIVATION_NAMESPACE
+from command_index import CompileCommandIndex
+from probe_scheduler import ProbeScheduler, ProbeError, DEFAULT_PROBE_TIMEOUT, DEFAULT_PROBE_RETRIES
+from parse_stage import ParseStage, unpack_block
 from helpers import SourceDocument, CompilationBlock, GitCommitStrategy, SHA1Strategy, SourceVersionStrategy
-from coverity_vuln_scraper import fetch_vulnerabilities
-import coverage
-from bson.objectid import ObjectId
-from pymongo import ReturnDocument
+from storage import SourceWriter, DEFAULT_BATCH_SIZE, get_storage
+from summaries import get_summary_contributions, get_summary_deltas, queue_summary_deltas, rebuild_summaries
+from compilation_bits import COMPILATION_BIT_FIELD, TRIGGERED_BITS_FIELD, set_bit, clear_bit
 from enum import Enum
-DATABASE = coverage.DATABASE
-SOURCES_COLLECTION = coverage.SOURCES_COLLECTION
-COMPILATION_COLLECTION = coverage.COMPILATION_COLLECTION
-COVERITY_DEFECTS_COLLECTION = coverage.COVERITY_DEFECTS_COLLECTION
-db = coverage.db
+from dataclasses import dataclass
 
 logger = logging.getLogger(__name__)
 
+# one lock per real source path, so that workers never instrument or register the same file at the same time
+source_locks : dict[str, threading.Lock] = {}
+source_locks_guard = threading.Lock()
+
 
 class SourceStatus(Enum):
     NEW = 0
@@ -29,15 +38,118 @@ class SourceStatus(Enum):
     UNKNOWN = 3
 
 
-def is_new_source(src_path : str) -> SourceStatus:
-    
-    global db
+class InstrumentationMode(Enum):
+    # the source is instrumented inside the Unikraft tree and restored from build/srcs afterwards
+    IN_PLACE = "in-place"
+    # the instrumented copy lives in a private scratch directory, the source tree is never touched
+    OUT_OF_TREE = "out-of-tree"
 
-    latest_version : Union[SourceVersionStrategy, dict] = get_source_version_info(src_path)
 
-    existing_source : Union[SourceDocument, dict] = db[DATABASE][SOURCES_COLLECTION].find_one(
-        {"source_path" : os.path.relpath(src_path, os.environ["UK_WORKDIR"])}
-    )
+class ActivationEngine(Enum):
+    # #warning COMPILATION_COVERAGE_<n> after every block directive, activations are read from gcc stderr
+    WARNING = "warning"
+    # the unmodified source is preprocessed, activations are read from the linemarkers of the output
+    LINEMARKER = "linemarker"
+
+
+class RegistrationMode(Enum):
+    # the tag must not be registered yet
+    NEW = "new"
+    # finish a registration that did not complete, the sources done by the previous run are skipped
+    RESUME = "resume"
+    # register a tag again in place, like resume, but a source analyzed again first loses what the previous run bound and the sources the app no longer compiles are removed from the compilation
+    UPDATE = "update"
+
+
+@dataclass
+class AnalysisOptions:
+
+    jobs : int = 1
+    instrumentation : InstrumentationMode = InstrumentationMode.IN_PLACE
+    probe : ProbeMode = ProbeMode.COMPILE
+    engine : ActivationEngine = ActivationEngine.WARNING
+
+    # decide block activation from the app configuration and -D flags, gcc is only run for undecidable sources
+    static_evaluation : bool = False
+
+    # CONFIG_ macros of the app, loaded by add_app_subcommand for the static evaluation
+    config_macros : dict = None
+
+    # on-disk cache shared by all runs, None disables it
+    cache_dir : str = None
+    cache_size : int = DEFAULT_CACHE_SIZE
+
+    # number of buffered writes sent to the database at once
+    batch_size : int = DEFAULT_BATCH_SIZE
+
+    # processes parsing new and deprecated sources ahead of the workers, None uses one per worker (at most one per core) when there are several workers, 0 lets the workers parse
+    parse_jobs : int = None
+
+    # compilers running at the same time, None allows one per worker
+    max_probes : int = None
+
+    # seconds a single compiler run may take and how many times it is retried, a source whose probe keeps failing is recorded and skipped
+    probe_timeout : float = DEFAULT_PROBE_TIMEOUT
+    probe_retries : int = DEFAULT_PROBE_RETRIES
+
+    # no new compiler is started while the load average is at or above it, None disables the check
+    max_load : float = None
+
+    # take a token of the make jobserver for every compiler, when the tool runs inside make -j
+    jobserver : bool = False
+
+    # what happens with a tag that is already registered
+    registration : RegistrationMode = RegistrationMode.NEW
+
+    # set up by analyze_application_sources: prefetched source documents by source path and the buffered writer
+    source_documents : dict = None
+    writer : SourceWriter = None
+
+    # sources with at least this many blocks store them in their own collection (MongoDB only), None keeps all blocks inside the source documents
+    split_threshold : int = None
+
+    # set up by add_app_subcommand, bit of the compilation in the bitsets of the sources and blocks
+    compilation_bit : int = None
+
+    # set up by add_app_subcommand from cache_dir
+    parse_cache : ResultCache = None
+    activation_cache : ResultCache = None
+
+    # generated headers and tree versions the activation of a source depends on besides its compilation command
+    environment_fingerprint : str = None
+
+    # set up by add_app_subcommand, compilation commands of the build directory by lib and source
+    command_index : CompileCommandIndex = None
+
+    # set up by analyze_application_sources when sources are parsed ahead of the workers
+    parse_stage : ParseStage = None
+
+    # set up by add_app_subcommand, runs every compiler of the analysis
+    probe_scheduler : ProbeScheduler = None
+
+    # set up by add_app_subcommand for out-of-tree instrumentation
+    scratch_dir : str = None
+
+    # set up by add_app_subcommand, (source path, lib) -> fingerprint of the sources done by previous runs of the compilation, see get_checkpoint_fingerprint
+    checkpoints : dict = None
+
+    # set up by add_app_subcommand, generated headers of the build directory, part of every checkpoint
+    build_fingerprint : str = None
+
+    # set up by analyze_application_sources with --update, sources of the app bound to the compilation by a previous run and not bound again yet
+    stale_sources : set = None
+
+
+def get_source_lock(real_src_path : str) -> threading.Lock:
+
+    with source_locks_guard:
+        if real_src_path not in source_locks:
+            source_locks[real_src_path] = threading.Lock()
+
+        return source_locks[real_src_path]
+
+
+def is_new_source(src_path : str, existing_source : Union[SourceDocument, dict, None], latest_version : Union[SourceVersionStrategy, dict]) -> SourceStatus:
 
     logger.debug(f"{src_path} has git commit log {latest_version}")
         
@@ -68,49 +180,160 @@ def is_new_source(src_path : str) -> SourceStatus:
     logger.critical(f"{existing_source} VS {latest_version}")
 
     return SourceStatus.UNKNOWN
-    
-        
 
-def update_db_activated_compile_blocks(activated_block_counters : list[int], src_path : str, compilation_tag: str) -> Union[SourceDocument, dict]:
 
-    global db
-    
-    source_document : Union[SourceDocument, dict] = db[DATABASE][SOURCES_COLLECTION].find_one(
-        {"source_path": os.path.relpath(src_path, os.environ["UK_WORKDIR"])}
-    )
+def predict_parse(src_path : str, options : AnalysisOptions) -> bool:
 
-    logger.debug(f"BEFORE update of activated compile blocks\n{source_document}")
+    '''
+    Whether a worker will have to parse the source, the same decision as is_new_source and the parse cache lookup of parse_source
+    but without their logs and cache statistics. A wrong guess only costs a useless parse or a parse by the worker itself.
+    '''
 
-    logger.debug(f"ACTIVATED {activated_block_counters}")
+    # generated sources are skipped by the workers
+    if not os.path.isfile(src_path):
+        return False
+
+    source_document = options.source_documents.get(os.path.relpath(src_path, os.environ["UK_WORKDIR"]))
+
+    if source_document != None:
+
+        latest_commit = git_commit_strategy(src_path)
+
+        if latest_commit != "" and source_document.get(GitCommitStrategy.version_key) == latest_commit:
+            return False
+
+        if latest_commit == "" and source_document.get(SHA1Strategy.version_key) == hash_strategy(src_path):
+            return False
+
+    if options.parse_cache != None and options.parse_cache.contains(f"{hash_strategy(src_path)}-{PARSER_VERSION}"):
+        return False
+
+    return True
+
+
+def prefetch_source_documents(source_paths : list[str]) -> dict[str, Union[SourceDocument, dict]]:
+
+    '''
+    Fetches the existing documents of all the sources of an app with a single query.
+
+    :param source_paths: Source paths relative to UK_WORKDIR
+    '''
+
+    source_documents = get_storage().prefetch_sources(source_paths)
+
+    logger.info(f"Prefetched {len(source_documents)} existing sources out of {len(set(source_paths))}")
+
+    return source_documents
+
+
+def bind_compilation(source_document : Union[SourceDocument, dict], activated_block_counters : list[int], compilation_tag : str, compilation_bit : int) -> int:
+
+    '''
+    Sets the bit of a compilation in the source and in its activated blocks, in memory.
+
+    :return: Lines of the source compiled by the compilation
+    '''
+
+    activated_block_counters = set(activated_block_counters)
 
-    compile_blocks : Union[list[CompilationBlock], list[dict]] = source_document['compile_blocks']
-        
     # maybe we are lucky and made some progress by activating new blocks :)
     # also calculate the number of compiled lines for this particular compilation for this source file
     compiled_lines = source_document["universal_lines"]
-    for existing_block in compile_blocks:
+    for existing_block in source_document['compile_blocks']:
 
         if existing_block['_local_id'] in activated_block_counters:
-            existing_block['triggered_compilations'].append(compilation_tag)
+            set_bit(existing_block[TRIGGERED_BITS_FIELD], compilation_bit)
             compiled_lines += existing_block["lines"]
-        
+
     source_document["compiled_stats"][compilation_tag] = compiled_lines
 
-    updated_source_document = db[DATABASE][SOURCES_COLLECTION].find_one_and_update(
-        filter= {"source_path" : os.path.relpath(src_path, os.environ["UK_WORKDIR"])},
-        update= {"$set" : source_document},
-        return_document=pymongo.ReturnDocument.AFTER
-    )
+    set_bit(source_document[TRIGGERED_BITS_FIELD], compilation_bit)
+
+    return compiled_lines
+
+
+def unbind_compilation(source_document : Union[SourceDocument, dict], compilation_tag : str, compilation_bit : int):
 
-    logger.debug(f"AFTER update of compile regions\n{updated_source_document}")
+    '''
+    Clears the bit of a compilation in the source and in all its blocks, in memory.
+    '''
 
-    return updated_source_document
+    for existing_block in source_document['compile_blocks']:
+        clear_bit(existing_block[TRIGGERED_BITS_FIELD], compilation_bit)
 
-def init_source_in_db(source_status : SourceStatus, src_path : str, real_src_path : str, total_blocks : Union[list[CompilationBlock]], universal_lines : int, compilation_tag : str, lib_name : str) -> bool:
+    source_document["compiled_stats"].pop(compilation_tag, None)
 
-    global db
+    clear_bit(source_document[TRIGGERED_BITS_FIELD], compilation_bit)
 
-    find_children(total_blocks)
+
+def get_checkpoint_fingerprint(version_info : Union[SourceVersionStrategy, dict], compile_command : str, build_fingerprint : str) -> str:
+
+    '''
+    A source done by a previous run of the compilation is skipped while its version, its compilation command and the configuration of the app stay the same.
+    '''
+
+    return hashlib.sha1(
+        "|".join([
+            *[f"{version_key}={version_value}" for version_key, version_value in sorted(version_info.items())],
+            compile_command,
+            build_fingerprint
+        ]).encode()
+    ).hexdigest()
+
+
+def take_stale_source(source_path : str, options : AnalysisOptions) -> bool:
+
+    '''
+    :return: Whether the source was bound to the compilation by a previous run, only once per source
+    '''
+
+    if options.stale_sources == None:
+        return False
+
+    # the caller holds the lock of the source, no other worker looks for the same path
+    if source_path in options.stale_sources:
+        options.stale_sources.remove(source_path)
+        return True
+
+    return False
+
+
+def update_db_activated_compile_blocks(source_status : SourceStatus, source_document : Union[SourceDocument, dict], previous_document : Union[SourceDocument, dict, None], previous_contributions : dict[tuple, list[int]], activated_block_counters : list[int], compilation_tag: str, options : AnalysisOptions) -> Union[SourceDocument, dict]:
+
+    '''
+    Binds the compilation to the source and to its activated blocks, in memory, then queues a single write for the whole source
+    and the summary increments it brings.
+    New and deprecated sources are written whole, existing sources only get the fields touched by this compilation.
+
+    :param previous_document: Stored version of a deprecated source
+    :param previous_contributions: Summary contributions of the stored source, see get_summary_contributions
+    '''
+
+    logger.debug(f"ACTIVATED {activated_block_counters}")
+
+    activated_block_counters = sorted(set(activated_block_counters))
+
+    compiled_lines = bind_compilation(source_document, activated_block_counters, compilation_tag, options.compilation_bit)
+
+    # the source is new so we create a new entry in the database
+    if source_status == SourceStatus.NEW:
+        options.writer.queue_new_source(source_document)
+        queue_summary_deltas(options.writer, previous_contributions, source_document)
+
+    # the source is deprecated, its previous compilation blocks and compilations are replaced
+    elif source_status == SourceStatus.DEPRECATED:
+        options.writer.queue_replaced_source(source_document, previous_document)
+        queue_summary_deltas(options.writer, previous_contributions, source_document)
+
+    # the source is already registered, only this compilation is added to the source and to its activated blocks
+    # the write is dropped if another run replaced the source meanwhile, and its summary increments with it
+    else:
+        options.writer.queue_activation(source_document, activated_block_counters, compilation_tag, options.compilation_bit, compiled_lines, get_summary_deltas(previous_contributions, source_document))
+
+    return source_document
+
+
+def init_source_document(src_path : str, total_blocks : Union[list[CompilationBlock]], universal_lines : int, lib_name : str, version_info : Union[SourceVersionStrategy, dict]) -> Union[SourceDocument, dict]:
 
     # calculate total lines of code
     total_lines = universal_lines
@@ -121,138 +344,320 @@ def init_source_in_db(source_status : SourceStatus, src_path : str, real_src_pat
                 "source_path" :  os.path.relpath(src_path, os.environ["UK_WORKDIR"]),
                 "compile_blocks" : [compile_block.to_mongo_dict() for compile_block in total_blocks],
                 "universal_lines" : universal_lines,
-                "triggered_compilations" : [compilation_tag],
+                TRIGGERED_BITS_FIELD : {},
                 "compiled_stats" : {},
                 "total_lines" : total_lines,
                 "lib" : lib_name
     }
 
     # TODO right now will only have git_commit_id since hashes are employed for generated or out of repo C source files
-    version_info : Union[SourceVersionStrategy, dict] = get_source_version_info(real_src_path)
-
     new_src_document.update(version_info)
 
-    #TODO what to add for real_src_path ? 
+    logger.debug(f"Initialized source document\n{new_src_document}")
 
-    # the source is new so we create a new entry in the database
-    if source_status == SourceStatus.NEW:
+    return new_src_document
 
-        db[DATABASE][SOURCES_COLLECTION].insert_one(new_src_document)
-        
-        logger.debug(f"Initialized source in db\n{new_src_document}")
 
-    # the source is deprecated we need to clear the compilation blocks of the existing entry and update latest git commit id
-    elif source_status == SourceStatus.DEPRECATED:
-        
-        logger.debug(
-            f"BEFORE source update due to deprecated commit\n" + 
-            f"{db[DATABASE][SOURCES_COLLECTION].find_one({'source_path' : os.path.relpath(src_path, os.environ['UK_WORKDIR'])})}"
-        )
+def get_source_compile_coverage(compilation_tag : str, lib_name : str, app_build_dir : str, src_path : str, options : AnalysisOptions) -> Union[SourceDocument, dict]:
 
-        updated_source_document : Union[SourceDocument, dict] = db[DATABASE][SOURCES_COLLECTION].find_one_and_update(
-            filter= {"source_path" : os.path.relpath(src_path, os.environ['UK_WORKDIR'])},
-            update= {"$set" : new_src_document},
-            return_document= ReturnDocument.AFTER
-        )
+    real_src_path = find_real_source_file(src_path, app_build_dir, lib_name)
 
-        logger.debug(f"AFTER source update due to deprecated commit {updated_source_document}")
-    else:
-        logger.critical("Initialization failed since source_status is not NEW or DEPRECATED !")
-        return False
+    # TODO, analysis of c source files that do not exist but are generated by other files is disabled for now 
+    if src_path != real_src_path:
+        logger.warning(f"Found generator file {src_path} which will generate {real_src_path}. Skiping analysis for now ...")
+        return None
     
-    return True
+    # the same source may be listed by multiple libs, only one worker at a time may instrument and register it
+    with get_source_lock(real_src_path):
+        try:
+            return analyze_source_compile_coverage(compilation_tag, lib_name, app_build_dir, src_path, real_src_path, options)
+        finally:
+            # a parse the worker did not need leaves room for the next ones
+            if options.parse_stage != None:
+                options.parse_stage.discard(real_src_path)
 
-def fetch_existing_compilation_blocks(src_path) -> list[CompilationBlock]:
 
-    global db
+def analyze_source_compile_coverage(compilation_tag : str, lib_name : str, app_build_dir : str, src_path : str, real_src_path : str, options : AnalysisOptions) -> Union[SourceDocument, dict]:
 
-    existing_blocks : Union[list[CompilationBlock], dict] = db[DATABASE][SOURCES_COLLECTION].find_one(
-            filter= {"source_path" : os.path.relpath(src_path, os.environ['UK_WORKDIR'])},
-            projection= {"compile_blocks" : 1, "_id" : 0}
-        )
+    # the linemarker engine preprocesses the unmodified source, so there is nothing to instrument, back up or restore
+    if options.engine == ActivationEngine.LINEMARKER:
+        return instrument_and_trigger_source(compilation_tag, lib_name, app_build_dir, src_path, real_src_path, None, options)
 
-    total_blocks = []
-    for raw_block in existing_blocks["compile_blocks"]:
-        total_blocks.append(
-            CompilationBlock(
-                symbol_condition= raw_block["symbol_condition"],
-                start_line= raw_block['start_line'],
-                end_line= raw_block['end_line'],
-                block_counter= raw_block['_local_id'],
-                parent_counter= raw_block['_parent_id'],
-                lines= raw_block['lines']
-            )
-        )
-    logger.debug(f"Fetched compilation blocks from database:\n{total_blocks}")
+    if options.instrumentation == InstrumentationMode.OUT_OF_TREE:
 
-    return total_blocks
+        # every source gets its own private directory, so that quote includes of sibling files (even other .c files)
+        # can never resolve to another instrumented copy, they are resolved from the original directory instead
+        # the copy itself is only written by instrument_source, if gcc is run at all
+        instrumented_src_path = f"{tempfile.mkdtemp(dir=options.scratch_dir)}/{os.path.basename(real_src_path)}"
 
+    else:
+        # mirror the path relative to the workspace so that sources with the same name from different libs do not collide
+        copy_source_path = f"{app_build_dir}/srcs/{os.path.relpath(real_src_path, os.environ['UK_WORKDIR'])}"
 
-def get_source_compile_coverage(compilation_tag : str, lib_name : str, app_build_dir : str, src_path : str) -> Union[SourceDocument, dict]:
+        os.makedirs(os.path.dirname(copy_source_path), exist_ok=True)
 
-    global db
+        # very important !! the source file is copied before code instrumentation, later it will be back to its initial form
+        shutil.copyfile(src_path, copy_source_path)
 
-    real_src_path = find_real_source_file(src_path, app_build_dir, lib_name)
+        instrumented_src_path = real_src_path
 
-    # TODO, analysis of c source files that do not exist but are generated by other files is disabled for now 
-    if src_path != real_src_path:
-        logger.warning(f"Found generator file {src_path} which will generate {real_src_path}. Skiping analysis for now ...")
+    try:
+        return instrument_and_trigger_source(compilation_tag, lib_name, app_build_dir, src_path, real_src_path, instrumented_src_path, options)
+    finally:
+        if options.instrumentation == InstrumentationMode.OUT_OF_TREE:
+            shutil.rmtree(os.path.dirname(instrumented_src_path), ignore_errors=True)
+        else:
+            # go back to source original code without instrumentation
+            shutil.copyfile(copy_source_path, real_src_path)
+
+
+def parse_source(source_buffer : SourceBuffer, source_hash : str, options : AnalysisOptions) -> tuple[list[CompilationBlock], int]:
+
+    parse_key = None
+
+    if options.parse_cache != None:
+
+        # the block structure only depends on the content of the file and on the parser itself
+        parse_key = f"{source_hash}-{PARSER_VERSION}"
+
+        cached_parse = options.parse_cache.get(parse_key)
+
+        if cached_parse != None:
+            logger.debug(f"Parse cache hit for {source_buffer.real_src_path} with key {parse_key}")
+
+            return [CompilationBlock(cb) for cb in cached_parse["compile_blocks"]], cached_parse["universal_lines"]
+
+    parsed_source = options.parse_stage.take(source_buffer.real_src_path) if options.parse_stage != None else None
+
+    # the source changed since the parse process read it
+    if parsed_source != None and source_hash != None and parsed_source.source_hash != source_hash:
+        parsed_source = None
+
+    if parsed_source != None:
+        total_blocks = [unpack_block(packed_block) for packed_block in parsed_source.compile_blocks]
+        universal_lines = parsed_source.universal_lines
+
+        # written as is by the instrumentation step instead of instrumenting the source again
+        source_buffer.instrumented_code = parsed_source.instrumented_code
+
+    else:
+        # comments are removed in memory, the source tree is left untouched
+        total_blocks, universal_lines = find_compilation_blocks_and_lines(source_buffer.get_text())
+
+        find_children(total_blocks)
+
+    if parse_key != None:
+        options.parse_cache.put(parse_key, {
+            "compile_blocks" : [compile_block.to_mongo_dict() for compile_block in total_blocks],
+            "universal_lines" : universal_lines
+        })
+
+    return total_blocks, universal_lines
+
+
+def predict_source_activation(total_blocks : list[CompilationBlock], source_buffer : SourceBuffer, compile_command : str, options : AnalysisOptions) -> Union[list[int], None]:
+
+    real_src_path = source_buffer.real_src_path
+
+    src_lines = source_buffer.get_lines()
+
+    env = get_macro_environment(compile_command, options.config_macros, src_lines, real_src_path)
+
+    activated_block_counters = predict_activated_blocks(total_blocks, src_lines, env)
+
+    if activated_block_counters == None:
+        logger.debug(f"Conditions of {real_src_path} cannot be decided statically, falling back to gcc")
+    else:
+        logger.debug(f"Conditions of {real_src_path} decided statically, activated blocks are {activated_block_counters}")
+
+    return activated_block_counters
+
+
+def get_activated_blocks(total_blocks : list[CompilationBlock], source_buffer : SourceBuffer, instrumented_src_path : str, compile_command : str, options : AnalysisOptions) -> list[int]:
+
+    real_src_path = source_buffer.real_src_path
+
+    if options.static_evaluation:
+        activated_block_counters = predict_source_activation(total_blocks, source_buffer, compile_command, options)
+
+        # gcc is only asked when the conditions could not be decided statically
+        if activated_block_counters != None:
+            return activated_block_counters
+
+    if options.engine == ActivationEngine.LINEMARKER:
+        return trigger_compilation_blocks_linemarkers(total_blocks, compile_command, real_src_path, options.probe_scheduler)
+
+    if instrumented_src_path != real_src_path:
+        compile_command = relocate_compilation_command(compile_command, real_src_path, instrumented_src_path)
+
+    compile_command = get_probe_command(compile_command, options.probe)
+
+    if source_buffer.instrumented_code != None:
+        write_instrumented_source(source_buffer.instrumented_code, instrumented_src_path)
+    else:
+        instrument_source(total_blocks, source_buffer.get_lines(), instrumented_src_path)
+
+    return trigger_compilation_blocks(compile_command, options.probe_scheduler)
+
+
+def instrument_and_trigger_source(compilation_tag : str, lib_name : str, app_build_dir : str, src_path : str, real_src_path : str, instrumented_src_path : str, options : AnalysisOptions) -> Union[SourceDocument, dict]:
+
+    source_path = os.path.relpath(src_path, os.environ["UK_WORKDIR"])
+
+    compile_command = options.command_index.get_compilation_command(lib_name, real_src_path)
+
+    # nothing is written for a source that cannot be compiled
+    if compile_command == None:
+        logger.critical(f"No .o.cmd file which has compilation command for {src_path} in {lib_name}")
         return None
-    
-    real_src_file_name = real_src_path.split("/")[-1]
 
-    copy_source_path = f"{app_build_dir}/srcs/{real_src_file_name}"
+    latest_version : Union[SourceVersionStrategy, dict] = get_source_version_info(real_src_path)
+
+    source_document = options.source_documents.get(source_path)
+
+    checkpoint_fingerprint = get_checkpoint_fingerprint(latest_version, compile_command, options.build_fingerprint)
+
+    # done by a previous run, unless another compilation replaced the source since
+    if options.checkpoints.get((source_path, lib_name)) == checkpoint_fingerprint and source_document != None and compilation_tag in source_document["compiled_stats"]:
+        logger.debug(f"{src_path} of {lib_name} was already done by a previous run of {compilation_tag}, skipping it")
+        return source_document
 
-    # very important !! the source file is copied before code instrumentation, later it will be back to its initial form
-    shutil.copyfile(src_path, copy_source_path)
+    source_status = is_new_source(src_path, source_document, latest_version)
 
-    source_status = is_new_source(src_path)
+    # the source is read at most once, by the first step that needs its content
+    source_buffer = SourceBuffer(real_src_path)
 
-    # the source is already registered, so we can fetch all compilation blocks from the database
+    source_hash = source_buffer.get_hash() if options.cache_dir != None else None
+
+    # the source is already registered, so we can take all compilation blocks from its prefetched document
     # also bind the compilation id to this file since the universal lines of code are compiled
     if source_status == SourceStatus.EXISTING:
-        total_blocks : list[CompilationBlock] = fetch_existing_compilation_blocks(src_path)
-
-        db[DATABASE][SOURCES_COLLECTION].find_one_and_update(
-            filter={"source_path" :  os.path.relpath(src_path, os.environ["UK_WORKDIR"])},
-            update={"$push": {"triggered_compilations" : compilation_tag}}
-        )
+        total_blocks : list[CompilationBlock] = [CompilationBlock(raw_block) for raw_block in source_document["compile_blocks"]]
 
     # the source is not registered so we must parse the source file and find compilation blocks
     # or the source needs to be cleared due to deprecation so we must parse the updated source file and find compilation blocks
     elif source_status == SourceStatus.NEW or source_status == SourceStatus.DEPRECATED:
 
-        total_blocks, universal_lines = find_compilation_blocks_and_lines(real_src_path)
-        init_source_in_db(source_status, src_path, real_src_path, total_blocks, universal_lines, compilation_tag, lib_name)
+        total_blocks, universal_lines = parse_source(source_buffer, source_hash, options)
+        source_document = init_source_document(src_path, total_blocks, universal_lines, lib_name, latest_version)
 
+    else:
+        logger.critical(f"Skipping {src_path} since its status cannot be checked")
+        return None
 
-    compile_command = get_source_compilation_command(app_build_dir, lib_name, real_src_path)
+    activation_key = None
+    activated_block_counters = None
 
-    if compile_command == None:
-        logger.critical(f"No .o.cmd file which has compilation command for {src_path} in {lib_name}")
-        db.find_one_and_delete({"source_path" : os.path.relpath(src_path, os.environ['UK_WORKDIR'])})
-        return None
+    if options.activation_cache != None:
+
+        # sources compiled with the same flags in the same environment always activate the same blocks, no matter the app
+        activation_key = hashlib.sha1(
+            "|".join([
+                source_hash,
+                str(PARSER_VERSION),
+                options.engine.value,
+                options.environment_fingerprint,
+                normalize_compilation_command(compile_command, app_build_dir)
+            ]).encode()
+        ).hexdigest()
+
+        cached_activation = options.activation_cache.get(activation_key)
+
+        if cached_activation != None:
+            activated_block_counters = cached_activation["activated_blocks"]
+            logger.debug(f"Activation cache hit for {real_src_path} with key {activation_key}, activated blocks are {activated_block_counters}")
+
+    if activated_block_counters == None:
+
+        try:
+            activated_block_counters = get_activated_blocks(total_blocks, source_buffer, instrumented_src_path, compile_command, options)
+
+        # nothing is written for the source, the failure is kept in the compilation record and the other sources go on
+        except (ProbeError, CommandRelocationError) as e:
+            logger.critical(f"Skipping {src_path} of {lib_name}: {e}")
+            get_storage().record_source_failure(compilation_tag, source_path, lib_name, str(e))
+            return None
+
+        if activation_key != None:
+            options.activation_cache.put(activation_key, {"activated_blocks" : activated_block_counters})
 
-    instrument_source(total_blocks, real_src_path)
+    # app refresh probes the source again with the same command
+    options.writer.queue_compile_command(compilation_tag, source_path, lib_name, compile_command)
 
-    activated_block_counters = trigger_compilation_blocks(compile_command)
+    # taken before the write since existing documents are updated in place
+    previous_document = options.source_documents.get(source_path)
+    previous_contributions = get_summary_contributions(previous_document)
+
+    # the blocks activated by the previous run may not be activated anymore, a deprecated source is replaced whole anyway
+    if take_stale_source(source_path, options) and source_status == SourceStatus.EXISTING:
+        unbind_compilation(source_document, compilation_tag, options.compilation_bit)
+        options.writer.queue_unbind(source_document, compilation_tag, options.compilation_bit)
 
     updated_src_document = update_db_activated_compile_blocks(
+            source_status= source_status,
+            source_document= source_document,
+            previous_document= previous_document,
+            previous_contributions= previous_contributions,
             activated_block_counters= activated_block_counters,
-            src_path= src_path,
-            compilation_tag= compilation_tag
+            compilation_tag= compilation_tag,
+            options= options
     )
-    
-    # go back to source original code without instrumentation
-    shutil.copyfile(copy_source_path, real_src_path)
+
+    # queued last, so the checkpoint is never stored without the writes of the source
+    options.writer.queue_checkpoint(compilation_tag, source_path, lib_name, checkpoint_fingerprint)
+
+    # later occurrences of the same source in this run see it as existing
+    options.source_documents[source_path] = updated_src_document
 
     return updated_src_document
 
 
+def create_probe_scheduler(options : AnalysisOptions) -> ProbeScheduler:
+
+    return ProbeScheduler(
+        max_probes= options.max_probes if options.max_probes != None else options.jobs,
+        timeout= options.probe_timeout,
+        retries= options.probe_retries,
+        max_load= options.max_load,
+        use_jobserver= options.jobserver
+    )
+
+
+def drop_removed_sources(compilation_tag : str, app_source_paths : set[str], options : AnalysisOptions):
+
+    '''
+    Removes from the compilation the sources done by a previous run that the app no longer compiles.
+    Only sources with a checkpoint are found, compilations registered before checkpoints were stored keep their removed sources.
+    '''
+
+    removed_sources : dict[str, list[str]] = {}
+
+    for source_path, lib_name in options.checkpoints:
+        if source_path not in app_source_paths:
+            removed_sources.setdefault(source_path, []).append(lib_name)
+
+    if removed_sources == {}:
+        return
+
+    logger.info(f"{len(removed_sources)} sources are no longer compiled by {compilation_tag}")
+
+    for source_path, source_document in get_storage().prefetch_sources(list(removed_sources)).items():
 
-def analyze_application_sources(compilation_tag : str, app_build_dir : str, app_path : str):
+        if compilation_tag not in source_document["compiled_stats"]:
+            continue
 
-    global rootTrie, db
+        previous_contributions = get_summary_contributions(source_document)
+
+        unbind_compilation(source_document, compilation_tag, options.compilation_bit)
+        options.writer.queue_unbind(source_document, compilation_tag, options.compilation_bit)
+
+        queue_summary_deltas(options.writer, previous_contributions, source_document)
+
+    for source_path, lib_names in removed_sources.items():
+        options.writer.queue_dropped_source(compilation_tag, source_path, lib_names)
+
+
+def analyze_application_sources(compilation_tag : str, app_build_dir : str, app_path : str, options : AnalysisOptions):
 
     # get all source file using the make print-srcs
     logger.debug(app_path)
@@ -267,9 +672,13 @@ def analyze_application_sources(compilation_tag : str, app_build_dir : str, app_
 
     if lib_str_match == None:
         logger.critical("No lib or app source file dependencies found. Maybe `make print-srcs` was not called correctly")
-        db[DATABASE][COMPILATION_COLLECTION].find_one_and_delete({"tag" : compilation_tag})
+
+        # a compilation registered by a previous run is left as it is
+        if options.registration == RegistrationMode.NEW:
+            get_storage().delete_compilation(compilation_tag)
         exit(1)
 
+    app_sources : list[tuple[str, str]] = []
 
     for lib_and_srcs_match in re.finditer("\s*([a-zA-Z_]+):\s*\n\s*(.*)\n", make_stdout):
 
@@ -283,18 +692,63 @@ def analyze_application_sources(compilation_tag : str, app_build_dir : str, app_
             src_path = src_path_raw.split("|")[0]
 
             if src_path[-2:] == ".c":
-                logger.debug(f"---------------------{src_path}------------------------------------")
+                app_sources.append((lib_name, src_path))
 
-                get_source_compile_coverage(
-                    compilation_tag= compilation_tag, 
-                    lib_name= lib_name, 
-                    app_build_dir= app_build_dir, 
-                    src_path= src_path
-                )
+    options.source_documents = prefetch_source_documents([os.path.relpath(src_path, os.environ["UK_WORKDIR"]) for _, src_path in app_sources])
+
+    options.writer = get_storage().create_writer(options.batch_size, options.split_threshold)
+
+    if options.registration == RegistrationMode.UPDATE:
+        options.stale_sources = {source_path for source_path, source_document in options.source_documents.items() if compilation_tag in source_document["compiled_stats"]}
+
+    # parsing is CPU bound, more processes than cores only add pickling
+    parse_jobs = options.parse_jobs if options.parse_jobs != None else (min(options.jobs, os.cpu_count() or 1) if options.jobs > 1 else 0)
+
+    if parse_jobs > 0:
+        sources_to_parse = [src_path for _, src_path in app_sources if predict_parse(src_path, options)]
+
+        if sources_to_parse != []:
+            options.parse_stage = ParseStage(parse_jobs, sources_to_parse, instrument= options.engine == ActivationEngine.WARNING)
+
+    def analyze_source(lib_name : str, src_path : str):
+        logger.debug(f"---------------------{src_path}------------------------------------")
+
+        return get_source_compile_coverage(
+            compilation_tag= compilation_tag, 
+            lib_name= lib_name, 
+            app_build_dir= app_build_dir, 
+            src_path= src_path,
+            options= options
+        )
+
+    try:
+        if options.jobs <= 1:
+            for lib_name, src_path in app_sources:
+                analyze_source(lib_name, src_path)
+        else:
+            logger.info(f"Analyzing {len(app_sources)} sources with {options.jobs} workers")
+
+            # sources are independent of each other, each worker runs the whole pipeline (version check, parse, instrument, compile, db update) for one source
+            with ThreadPoolExecutor(max_workers=options.jobs) as pool:
+                futures = [pool.submit(analyze_source, lib_name, src_path) for lib_name, src_path in app_sources]
+
+                # propagate the first failure just like the serial run would
+                for future in futures:
+                    future.result()
+
+        if options.registration == RegistrationMode.UPDATE:
+            drop_removed_sources(compilation_tag, {os.path.relpath(src_path, os.environ["UK_WORKDIR"]) for _, src_path in app_sources}, options)
+    finally:
+        # every buffered write belongs to a completely analyzed source, so they are kept even if the analysis failed
+        options.writer.flush()
+
+        if options.parse_stage != None:
+            options.parse_stage.close()
+            options.parse_stage = None
 
 
-    
     # # get the Coverity defects and insert them in a table
+    # from coverity_vuln_scraper import fetch_vulnerabilities
     # defects = fetch_vulnerabilities()
 
     # for defect in defects:
@@ -304,25 +758,79 @@ def analyze_application_sources(compilation_tag : str, app_build_dir : str, app_
     # print(defects)
 
 
-def add_app_subcommand(app_workspace : str, app_build_dir : str, compilation_tag : str):
+def add_app_subcommand(app_workspace : str, app_build_dir : str, compilation_tag : str, options : AnalysisOptions):
 
-    global db
+    # a source instrumented in place is seen by every compilation that includes it, parallel workers would report each other's blocks
+    if options.jobs > 1 and options.instrumentation == InstrumentationMode.IN_PLACE and options.engine == ActivationEngine.WARNING:
+        logger.warning(f"In-place instrumentation is not safe with {options.jobs} workers, instrumenting out of tree instead")
+        options.instrumentation = InstrumentationMode.OUT_OF_TREE
 
-    if not os.path.exists(f"{app_build_dir}/srcs"):
+    if options.instrumentation == InstrumentationMode.IN_PLACE and options.engine == ActivationEngine.WARNING and not os.path.exists(f"{app_build_dir}/srcs"):
         os.mkdir(f"{app_build_dir}/srcs")
 
     # check if an identic compilation occured
 
-    existing_compilation = db[DATABASE][COMPILATION_COLLECTION].find_one(
-                    {"tag" : compilation_tag}
-        )
-    if existing_compilation != None:
-        logger.critical(f"An existing compilation has been previously registered with this tag and app\n{existing_compilation}")
+    existing_compilation = get_storage().find_compilation(compilation_tag)
+    if existing_compilation != None and options.registration == RegistrationMode.NEW:
+        logger.critical(f"An existing compilation has been previously registered with this tag and app\n{existing_compilation}\nUse --resume to finish it or --update to register it again")
         return
-    
-    logger.info(f"No compilation has been found. Proceeding with analyzing source {app_workspace}")
 
-    compilation_id : ObjectId = db[DATABASE][COMPILATION_COLLECTION].insert_one({"tag" : compilation_tag, "app": app_workspace}).inserted_id
-    logger.debug(f"New compilation has now id {compilation_id}")
+    if existing_compilation != None and existing_compilation.get(COMPILATION_BIT_FIELD) == None:
+        logger.critical(f"{compilation_tag} was registered by an older version of the tool, run migrate first")
+        return
+
+    if existing_compilation == None:
+        logger.info(f"No compilation has been found. Proceeding with analyzing source {app_workspace}")
+
+    if options.static_evaluation:
+        options.config_macros = load_config_macros(app_workspace, app_build_dir)
+
+    if options.cache_dir != None:
+        options.parse_cache = ResultCache(options.cache_dir, PARSE_NAMESPACE, options.cache_size)
+        options.activation_cache = ResultCache(options.cache_dir, ACTIVATION_NAMESPACE, options.cache_size)
+        options.environment_fingerprint = get_environment_fingerprint(app_build_dir)
+
+    options.command_index = CompileCommandIndex(app_build_dir)
+
+    options.build_fingerprint = get_build_fingerprint(app_build_dir)
+
+    if existing_compilation == None:
+        compilation_id, options.compilation_bit = get_storage().register_compilation(compilation_tag, app_workspace)
+        logger.debug(f"New compilation has now id {compilation_id} and bit {options.compilation_bit}")
+
+        options.checkpoints = {}
+
+    else:
+        options.compilation_bit = existing_compilation[COMPILATION_BIT_FIELD]
+        options.checkpoints = get_storage().get_checkpoints(compilation_tag)
+
+        # every source that failed is analyzed again
+        get_storage().clear_source_failures(compilation_tag)
+
+        logger.info(f"Running {options.registration.value} of {compilation_tag} with bit {options.compilation_bit}, {len(options.checkpoints)} sources were done by previous runs")
+
+    options.probe_scheduler = create_probe_scheduler(options)
+
+    with options.probe_scheduler:
+
+        # instrumented copies live in a private scratch directory that is removed even if the analysis crashes
+        if options.instrumentation == InstrumentationMode.OUT_OF_TREE and options.engine == ActivationEngine.WARNING:
+            with tempfile.TemporaryDirectory(prefix="uk-coverage-") as scratch_dir:
+                options.scratch_dir = scratch_dir
+                analyze_application_sources(compilation_tag, app_build_dir, app_workspace, options)
+        else:
+            analyze_application_sources(compilation_tag, app_build_dir, app_workspace, options)
+
+    options.command_index.save()
+
+    # a run that died in the middle of a flush may have stored sources without their summary increments, or the other way round
+    if existing_compilation != None:
+        logger.info(f"Recomputed {rebuild_summaries([compilation_tag])} summaries of {compilation_tag}")
+
+    failures = get_storage().get_source_failures(compilation_tag)
+    if failures != []:
+        logger.critical(f"{len(failures)} sources of {compilation_tag} could not be analyzed: {', '.join(failure['source_path'] for failure in failures)}")
 
-    analyze_application_sources(compilation_tag, app_build_dir, app_workspace)
\ No newline at end of file
+    if options.parse_cache != None:
+        logger.info(f"Parse cache: {options.parse_cache.hits} hits, {options.parse_cache.misses} misses")
+        logger.info(f"Activation cache: {options.activation_cache.hits} hits, {options.activation_cache.misses} misses")
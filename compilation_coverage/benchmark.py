@@ -0,0 +1,257 @@
+#!/usr/bin/python3
+
+'''
+Micro benchmarks of the source analysis stages on generated sources, no database or Unikraft tree is needed.
+
+    python3 benchmark.py parse --size 8
+    python3 benchmark.py blocks --blocks 20000
+'''
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from helpers import SourceBuffer, instrument_source, remove_comments
+from symbol_engine import find_compilation_blocks_and_lines, find_children
+
+# a few kinds of blocks, nested, with #elif and #else branches and multiline conditions, between ordinary code
+SOURCE_CHUNK = '''#include <uk/config.h>
+#include <uk/print.h>
+
+/*
+ * Generated code, the comments are removed before scanning.
+ */
+#ifdef CONFIG_LIBUKDEBUG
+static int debug_level = 3;
+#if CONFIG_LIBUKDEBUG_PRINTK && \\
+    defined(CONFIG_LIBUKDEBUG_PRINTD)
+static void debug_print(const char *msg)
+{
+	uk_pr_debug("%s\\n", msg);
+}
+#elif defined(CONFIG_LIBUKDEBUG_ENABLE_ASSERT)
+static void debug_print(const char *msg) { (void) msg; }
+#else
+#define debug_print(msg) do {} while (0)
+#endif
+#else
+static int debug_level = 0;
+#endif
+
+struct item {
+	int key;
+	int value;
+	struct item *next;
+};
+
+static struct item *lookup(struct item *head, int key)
+{
+	struct item *it;
+
+	for (it = head; it; it = it->next) {
+		if (it->key == key)
+			return it;
+	}
+
+	return NULL;
+}
+
+static int insert(struct item **head, struct item *item)
+{
+	if (lookup(*head, item->key))
+		return -1;
+
+	item->next = *head;
+	*head = item;
+
+	return 0;
+}
+
+#ifndef UK_ARCH_X86_64
+int arch_init(void)
+{
+	return -1;
+}
+#endif
+
+int compute(int a, int b)
+{
+	int result = a * b + debug_level;
+
+	if (result < 0)
+		result = -result;
+
+	return result;
+}
+
+'''
+
+# three blocks per chunk, a nested chain like the ones of arch headers pulled into .c files
+BLOCKS_CHUNK = '''#ifdef CONFIG_FEATURE_{0}
+int feature_{0};
+#if CONFIG_FEATURE_{0}_LEVEL > 1 && \\
+    defined(CONFIG_FEATURE_{0}_EXTRA)
+int feature_{0}_extra;
+#else
+int feature_{0}_basic;
+#endif
+#endif
+'''
+
+# a linear stage grows 4 times with 4 times more blocks, a quadratic one 16 times
+LINEAR_SCALING_LIMIT = 10
+
+
+def generate_source(path : str, size_mb : int):
+
+    chunks = (size_mb * 1024 * 1024) // len(SOURCE_CHUNK) + 1
+
+    with open(path, "w") as src_fd:
+        for _ in range(chunks):
+            src_fd.write(SOURCE_CHUNK)
+
+
+def best_time(function, repeat : int) -> float:
+
+    best = None
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+
+        if best == None or elapsed < best:
+            best = elapsed
+
+    return best
+
+
+def benchmark_parse(size_mb : int, repeat : int):
+
+    '''
+    Times reading with comment removal and the directive scanner, every run reads the generated source again.
+    '''
+
+    with tempfile.TemporaryDirectory(prefix="uk-coverage-benchmark-") as work_dir:
+
+        original_path = os.path.join(work_dir, "original.c")
+
+        generate_source(original_path, size_mb)
+
+        def parse():
+            return find_compilation_blocks_and_lines(SourceBuffer(original_path).get_text())
+
+        def strip_comments():
+            SourceBuffer(original_path).get_text()
+
+        blocks, universal_lines = parse()
+
+        parse_time = best_time(parse, repeat)
+        comments_time = best_time(strip_comments, repeat)
+
+        print(f"Source: {os.path.getsize(original_path) / (1024 * 1024):.1f} MB, {len(blocks)} blocks, {universal_lines} universal lines")
+        print(f"Read and comment removal: {comments_time * 1000:.1f} ms")
+        print(f"Read, comment removal and scan: {parse_time * 1000:.1f} ms")
+        print(f"Scan only: {(parse_time - comments_time) * 1000:.1f} ms")
+
+
+def time_block_stages(blocks_count : int, repeat : int, work_dir : str) -> tuple[float, float]:
+
+    src_text = "".join(BLOCKS_CHUNK.format(i) for i in range(blocks_count // 3 + 1))
+    total_blocks, _ = find_compilation_blocks_and_lines(remove_comments(src_text))
+    src_lines = src_text.splitlines(keepends=True)
+
+    instrumented_src_path = os.path.join(work_dir, f"instrumented_{blocks_count}.c")
+
+    def build_hierarchy():
+        for block in total_blocks:
+            block.children = []
+        find_children(total_blocks)
+
+    hierarchy_time = best_time(build_hierarchy, repeat)
+    instrumentation_time = best_time(lambda: instrument_source(total_blocks, src_lines, instrumented_src_path), repeat)
+
+    return hierarchy_time, instrumentation_time
+
+
+def benchmark_blocks(blocks_count : int, repeat : int):
+
+    '''
+    Times find_children and instrument_source on a heavily conditional source and on one with 4 times more blocks.
+    Fails if either stage grows clearly faster than the number of blocks.
+    '''
+
+    with tempfile.TemporaryDirectory(prefix="uk-coverage-benchmark-") as work_dir:
+
+        small_times = time_block_stages(blocks_count, repeat, work_dir)
+        large_times = time_block_stages(4 * blocks_count, repeat, work_dir)
+
+    failed = False
+
+    for stage, small_time, large_time in zip(["find_children", "instrument_source"], small_times, large_times):
+
+        scaling = large_time / small_time
+
+        print(f"{stage}: {small_time * 1000:.1f} ms for {blocks_count} blocks, {large_time * 1000:.1f} ms for {4 * blocks_count} blocks, x{scaling:.1f}")
+
+        if scaling > LINEAR_SCALING_LIMIT:
+            print(f"{stage} is not linear in the number of blocks, x{scaling:.1f} is above x{LINEAR_SCALING_LIMIT}")
+            failed = True
+
+    if failed:
+        sys.exit(1)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmarks of the source analysis stages")
+
+    subparser = parser.add_subparsers(dest='benchmark', help='Available benchmarks')
+
+    parse_parser = subparser.add_parser("parse", help="Directive scanner of symbol_engine")
+
+    parse_parser.add_argument(
+        '-s',
+        '--size',
+        required=False,
+        action='store',
+        help='Size in MB of the generated source. Default is 8',
+        default=8,
+        type=int
+    )
+
+    blocks_parser = subparser.add_parser("blocks", help="Block hierarchy and instrumentation, checks that they stay linear")
+
+    blocks_parser.add_argument(
+        '-n',
+        '--blocks',
+        required=False,
+        action='store',
+        help='Number of blocks of the smaller generated source. Default is 20000',
+        default=20000,
+        type=int
+    )
+
+    parser.add_argument(
+        '-r',
+        '--repeat',
+        required=False,
+        action='store',
+        help='Runs per measurement, the best one is reported. Default is 5',
+        default=5,
+        type=int
+    )
+
+    args = parser.parse_args()
+
+    if args.benchmark == "parse":
+        benchmark_parse(args.size, args.repeat)
+    elif args.benchmark == "blocks":
+        benchmark_blocks(args.blocks, args.repeat)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
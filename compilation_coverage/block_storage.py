@@ -0,0 +1,158 @@
+import logging
+from typing import Union
+from pymongo import InsertOne, UpdateOne, UpdateMany, DeleteMany
+from helpers import SourceDocument
+from compilation_bits import TRIGGERED_BITS_FIELD, has_bit_filter
+
+logger = logging.getLogger(__name__)
+
+# set on sources whose compile blocks live in their own collection instead of the compile_blocks array
+SPLIT_BLOCKS_FIELD = "split_blocks"
+
+# number of blocks of a split source, since it has no array to count
+BLOCK_COUNT_FIELD = "block_count"
+
+# block documents point to their source with this field, (source_id, _local_id) is unique
+SOURCE_ID_FIELD = "source_id"
+
+
+def is_split(source_document : Union[SourceDocument, dict]) -> bool:
+    return source_document.get(SPLIT_BLOCKS_FIELD, False)
+
+
+def should_split(source_document : Union[SourceDocument, dict], split_threshold : Union[int, None]) -> bool:
+
+    '''
+    :param split_threshold: Minimum number of blocks of a split source, None keeps every source embedded
+    '''
+
+    return split_threshold != None and len(source_document["compile_blocks"]) >= split_threshold
+
+
+def attach_split_blocks(blocks_collection, source_documents : list[Union[SourceDocument, dict]], projection : dict = None):
+
+    '''
+    Loads the blocks of the split sources with a single query and puts them in compile_blocks, sorted by _local_id,
+    so that split sources look exactly like embedded ones in memory.
+
+    :param blocks_collection: Collection of the blocks of the split sources
+    '''
+
+    split_sources = {source_document["_id"] : source_document for source_document in source_documents if is_split(source_document)}
+
+    if split_sources == {}:
+        return
+
+    for source_document in split_sources.values():
+        source_document["compile_blocks"] = []
+
+    block_projection = {"_id" : 0}
+    if projection != None:
+        block_projection = dict(projection, _id=0, _local_id=1, **{SOURCE_ID_FIELD : 1})
+
+    block_documents = blocks_collection.find(
+        filter={SOURCE_ID_FIELD : {"$in" : list(split_sources.keys())}},
+        projection=block_projection,
+        sort=[(SOURCE_ID_FIELD, 1), ("_local_id", 1)]
+    )
+
+    for block_document in block_documents:
+        split_sources[block_document.pop(SOURCE_ID_FIELD)]["compile_blocks"].append(block_document)
+
+    logger.debug(f"Attached the blocks of {len(split_sources)} split sources")
+
+
+def get_block_documents(source_document : Union[SourceDocument, dict]) -> list[dict]:
+    return [dict(compile_block, **{SOURCE_ID_FIELD : source_document["_id"]}) for compile_block in source_document["compile_blocks"]]
+
+
+def get_new_source_operations(source_document : Union[SourceDocument, dict], split_threshold : Union[int, None]) -> tuple[InsertOne, list]:
+
+    '''
+    :return: Insert of the source and the operations on the blocks collection
+    '''
+
+    if not should_split(source_document, split_threshold):
+        return InsertOne(source_document), []
+
+    source_document[SPLIT_BLOCKS_FIELD] = True
+
+    source_fields = {key : value for key, value in source_document.items() if key != "compile_blocks"}
+    source_fields[BLOCK_COUNT_FIELD] = len(source_document["compile_blocks"])
+
+    return InsertOne(source_fields), [InsertOne(block_document) for block_document in get_block_documents(source_document)]
+
+
+def get_replaced_source_operations(source_document : Union[SourceDocument, dict], split_threshold : Union[int, None]) -> tuple[dict, list]:
+
+    '''
+    Layout of a deprecated source that is written whole, the layout of its previous version may differ.
+    Block writes are upserts by (source_id, _local_id) plus a delete of the blocks past the new count, they commute,
+    so they can share an unordered batch with each other and with the source write.
+
+    :param source_document: New version of the source, with the _id and the layout of the version it replaces
+    :return: Update of the source and the operations on the blocks collection
+    '''
+
+    was_split = is_split(source_document)
+
+    source_fields = {key : value for key, value in source_document.items() if key != "_id"}
+
+    if not should_split(source_document, split_threshold):
+
+        source_document.pop(SPLIT_BLOCKS_FIELD, None)
+        source_fields.pop(SPLIT_BLOCKS_FIELD, None)
+
+        if not was_split:
+            return {"$set" : source_fields}, []
+
+        return (
+            {"$set" : source_fields, "$unset" : {SPLIT_BLOCKS_FIELD : "", BLOCK_COUNT_FIELD : ""}},
+            [DeleteMany({SOURCE_ID_FIELD : source_document["_id"]})]
+        )
+
+    source_document[SPLIT_BLOCKS_FIELD] = True
+
+    compile_blocks = source_fields.pop("compile_blocks")
+
+    source_fields[SPLIT_BLOCKS_FIELD] = True
+    source_fields[BLOCK_COUNT_FIELD] = len(compile_blocks)
+
+    block_operations = [
+        UpdateOne(
+            {SOURCE_ID_FIELD : source_document["_id"], "_local_id" : block_document["_local_id"]},
+            {"$set" : block_document},
+            upsert=True
+        )
+        for block_document in get_block_documents(source_document)
+    ]
+
+    block_operations.append(DeleteMany({SOURCE_ID_FIELD : source_document["_id"], "_local_id" : {"$gte" : len(compile_blocks)}}))
+
+    return {"$set" : source_fields, "$unset" : {"compile_blocks" : ""}}, block_operations
+
+
+def get_split_unbind_operation(source_document : Union[SourceDocument, dict], compilation_bit : int, word_key : str, mask) -> UpdateMany:
+
+    '''
+    Clears the bit of a compilation on the blocks of a split source it triggered.
+
+    :param mask: Word with every bit set but the one of the compilation
+    '''
+
+    return UpdateMany(
+        {SOURCE_ID_FIELD : source_document["_id"], **has_bit_filter(TRIGGERED_BITS_FIELD, compilation_bit)},
+        {"$bit" : {f"{TRIGGERED_BITS_FIELD}.{word_key}" : {"and" : mask}}}
+    )
+
+
+def get_split_activation_operation(source_document : Union[SourceDocument, dict], activated_block_counters : list[int], word_key : str, word) -> UpdateMany:
+
+    '''
+    Sets the bit of a compilation on the activated blocks of a split source.
+    '''
+
+    return UpdateMany(
+        {SOURCE_ID_FIELD : source_document["_id"], "_local_id" : {"$in" : activated_block_counters}},
+        {"$bit" : {f"{TRIGGERED_BITS_FIELD}.{word_key}" : {"or" : word}}}
+    )
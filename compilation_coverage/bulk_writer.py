@@ -0,0 +1,195 @@
+from __future__ import annotations
+import logging
+import threading
+from pymongo import UpdateOne
+from storage import DEFAULT_BATCH_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+class BulkWriter:
+
+    '''
+    Buffers write operations per collection and sends them as unordered bulk_write batches.
+    Batches are written one at a time, in the order they were filled.
+    A document has at most one pending operation, a second one first flushes the batch so that unordered execution cannot swap them.
+    Increments of the same document are commutative, so they are merged into a single upsert instead.
+    Guarded increments are only merged if their guard still matches a document once the other operations of the batch are written.
+    Collections of progress markers are written after all the other collections of their batch.
+    '''
+
+    database = None
+    batch_size : int = None
+    pending_operations : dict[str, list] = None
+    pending_keys : set = None
+    pending_increments : dict[str, dict] = None
+    pending_guards : list[tuple] = None
+    last_collections : list[str] = None
+    queue_lock : threading.Lock = None
+    flush_lock : threading.Lock = None
+
+    def __init__(self, database, batch_size : int = DEFAULT_BATCH_SIZE, last_collections : list[str] = None) -> None:
+
+        '''
+        :param last_collections: Collections written last in every batch, so that a crash during a flush never keeps their operations without the others
+        '''
+
+        self.database = database
+        self.batch_size = batch_size
+        self.last_collections = last_collections if last_collections != None else []
+        self.pending_operations = {}
+        self.pending_keys = set()
+        self.pending_increments = {}
+        self.pending_guards = []
+        self.queue_lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+
+    def queue(self, collection_name : str, operation, document_key = None):
+
+        '''
+        :param collection_name: Collection the operation is applied to
+        :param operation: pymongo InsertOne, UpdateOne, UpdateMany etc.
+        :param document_key: Identifies the document touched by the operation, None if ordering does not matter
+        '''
+
+        with self.queue_lock:
+            must_flush = document_key != None and (collection_name, document_key) in self.pending_keys
+
+        if must_flush:
+            self.flush()
+
+        with self.queue_lock:
+            self.pending_operations.setdefault(collection_name, []).append(operation)
+
+            if document_key != None:
+                self.pending_keys.add((collection_name, document_key))
+
+            is_full = self.pending_count() >= self.batch_size
+
+        if is_full:
+            self.flush()
+
+    def queue_increment(self, collection_name : str, document_filter : dict, increments : dict):
+
+        '''
+        :param collection_name: Collection of the incremented document
+        :param document_filter: Equality filter that identifies the document, it is created if missing
+        :param increments: field -> value added to the field
+        '''
+
+        with self.queue_lock:
+            merge_increments(self.pending_increments, collection_name, document_filter, increments)
+            is_full = self.pending_count() >= self.batch_size
+
+        if is_full:
+            self.flush()
+
+    def queue_guarded_increments(self, guard_collection_name : str, guard_filter : dict, increments : list[tuple[str, dict, dict]]):
+
+        '''
+        Increments that only hold if an operation was applied, e.g. counters of an update whose filter may no longer match anything.
+        Queued after that operation, they are checked after it is written.
+
+        :param guard_collection_name: Collection of the operation
+        :param guard_filter: Equality filter of the operation, the increments are dropped if no document matches it after the write
+        :param increments: collection name, document filter and increments, as for queue_increment
+        '''
+
+        if increments == []:
+            return
+
+        with self.queue_lock:
+            self.pending_guards.append((guard_collection_name, guard_filter, increments))
+            is_full = self.pending_count() >= self.batch_size
+
+        if is_full:
+            self.flush()
+
+    def pending_count(self) -> int:
+        return sum(len(operations) for operations in self.pending_operations.values()) + sum(len(increments) for increments in self.pending_increments.values()) + len(self.pending_guards)
+
+    def find_matched_guards(self, guards : list[tuple]) -> list[tuple]:
+
+        '''
+        :return: Guards that match a document, with one query per collection
+        '''
+
+        matched_guards = []
+
+        guards_by_collection : dict[str, list[tuple]] = {}
+        for guard in guards:
+            guards_by_collection.setdefault(guard[0], []).append(guard)
+
+        for collection_name, collection_guards in guards_by_collection.items():
+
+            guard_fields = {field for _, guard_filter, _ in collection_guards for field in guard_filter}
+
+            documents = list(self.database[collection_name].find(
+                filter={"$or" : [guard_filter for _, guard_filter, _ in collection_guards]},
+                projection={"_id" : 0, **{field : 1 for field in guard_fields}}
+            ))
+
+            for guard in collection_guards:
+                guard_filter = guard[1]
+                if any(all(document.get(field) == value for field, value in guard_filter.items()) for document in documents):
+                    matched_guards.append(guard)
+
+        if len(matched_guards) != len(guards):
+            logger.warning(f"{len(guards) - len(matched_guards)} writes matched no document, their increments are dropped")
+
+        return matched_guards
+
+    def write_operations(self, batch : dict[str, list]):
+
+        for collection_name, operations in batch.items():
+            if operations == []:
+                continue
+
+            result = self.database[collection_name].bulk_write(operations, ordered=False)
+
+            logger.debug(f"Flushed {len(operations)} operations to {collection_name}: {result.inserted_count} inserted, {result.modified_count} modified, {result.upserted_count} upserted")
+
+    def flush(self):
+
+        with self.flush_lock:
+
+            with self.queue_lock:
+                batch = self.pending_operations
+                increments = self.pending_increments
+                guards = self.pending_guards
+                self.pending_operations = {}
+                self.pending_keys = set()
+                self.pending_increments = {}
+                self.pending_guards = []
+
+            self.write_operations({collection_name : operations for collection_name, operations in batch.items() if collection_name not in self.last_collections})
+
+            if guards != []:
+                for _, _, guarded_increments in self.find_matched_guards(guards):
+                    for collection_name, document_filter, fields in guarded_increments:
+                        merge_increments(increments, collection_name, document_filter, fields)
+
+            self.write_operations({
+                collection_name : [UpdateOne(document_filter, {"$inc" : fields}, upsert=True) for document_filter, fields in collection_increments.values()]
+                for collection_name, collection_increments in increments.items()
+            })
+
+            self.write_operations({collection_name : operations for collection_name, operations in batch.items() if collection_name in self.last_collections})
+
+
+def merge_increments(pending_increments : dict[str, dict], collection_name : str, document_filter : dict, increments : dict):
+
+    '''
+    :param pending_increments: collection name -> document key -> document filter and merged increments
+    '''
+
+    document_key = tuple(sorted(document_filter.items()))
+
+    collection_increments = pending_increments.setdefault(collection_name, {})
+
+    if document_key not in collection_increments:
+        collection_increments[document_key] = (document_filter, {})
+
+    pending_fields = collection_increments[document_key][1]
+    for field, value in increments.items():
+        pending_fields[field] = pending_fields.get(field, 0) + value
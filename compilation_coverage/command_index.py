@@ -0,0 +1,175 @@
+from __future__ import annotations
+import json
+import logging
+import os
+import shlex
+import tempfile
+import threading
+from typing import Union
+
+# kept inside the build directory, so it goes away with a make distclean
+INDEX_FILE_NAME = ".coverage_commands.json"
+
+# bump whenever the layout of the index or the way commands are read changes, older indexes are then rebuilt
+INDEX_VERSION = 1
+
+COMMAND_FILE_SUFFIX = ".o.cmd"
+
+logger = logging.getLogger(__name__)
+
+
+def read_command_file(command_file_path : str) -> tuple[Union[str, None], Union[str, None]]:
+
+    '''
+    Reads the compilation command of a .o.cmd file.
+
+    :return: Source given to -c and the full command, None for both if the file has no -c argument
+    '''
+
+    with open(command_file_path, "r") as cmd_file_fd:
+        # ignore the "$ " before the command
+        make_command = cmd_file_fd.readline()[2:]
+
+    compiled_source = get_compiled_source(make_command)
+
+    if compiled_source == None:
+        logger.debug(f"-c flag not found in {command_file_path}")
+        return None, None
+
+    return compiled_source, make_command
+
+
+def get_compiled_source(compile_command : str) -> Union[str, None]:
+
+    '''
+    :return: Source given to -c, None if the command has no -c argument
+    '''
+
+    try:
+        compile_tokens = shlex.split(compile_command)
+        return compile_tokens[compile_tokens.index("-c") + 1]
+    # unbalanced quotes, no -c or nothing after it
+    except (ValueError, IndexError):
+        return None
+
+
+class CompileCommandIndex:
+
+    '''
+    Compilation commands of a build directory by lib and by the source given to -c.
+    Every lib directory is scanned once per run, only .o.cmd files whose size or modification time changed since the previous run are read again.
+    The index is saved next to the build, so later runs on the same build reuse it.
+    '''
+
+    app_build_dir : str = None
+
+    index_path : str = None
+
+    # lib -> .o.cmd file name -> [modification time in ns, size, source given to -c, command]
+    command_files : dict[str, dict[str, list]] = None
+
+    # lib -> source given to -c -> command, only for the libs scanned in this run
+    commands : dict[str, dict[str, str]] = None
+
+    changed : bool = False
+
+    lock : threading.Lock = None
+
+    def __init__(self, app_build_dir : str) -> None:
+        self.app_build_dir = app_build_dir
+        self.index_path = os.path.join(app_build_dir, INDEX_FILE_NAME)
+        self.command_files = {}
+        self.commands = {}
+        self.changed = False
+        self.lock = threading.Lock()
+
+        try:
+            with open(self.index_path, "r") as index_fd:
+                saved_index = json.load(index_fd)
+
+            if saved_index.get("version") == INDEX_VERSION:
+                self.command_files = saved_index["libs"]
+            else:
+                logger.info(f"Rebuilding {self.index_path} written by another version of the tool")
+
+        except (OSError, ValueError, KeyError):
+            logger.debug(f"No usable command index at {self.index_path}, every lib will be scanned")
+
+    def scan_lib(self, lib_name : str) -> dict[str, str]:
+
+        lib_dir = os.path.join(self.app_build_dir, lib_name)
+
+        previous_files = self.command_files.get(lib_name, {})
+        current_files = {}
+
+        reused = 0
+
+        try:
+            entries = sorted(os.scandir(lib_dir), key= lambda entry : entry.name)
+        except OSError as e:
+            logger.critical(f"Cannot list the command files of {lib_name}: {e}")
+            return {}
+
+        for entry in entries:
+
+            if not entry.name.endswith(COMMAND_FILE_SUFFIX) or not entry.is_file():
+                continue
+
+            entry_stat = entry.stat()
+
+            previous = previous_files.get(entry.name)
+
+            if previous != None and previous[0] == entry_stat.st_mtime_ns and previous[1] == entry_stat.st_size:
+                current_files[entry.name] = previous
+                reused += 1
+                continue
+
+            compiled_source, command = read_command_file(entry.path)
+            current_files[entry.name] = [entry_stat.st_mtime_ns, entry_stat.st_size, compiled_source, command]
+
+        if current_files != previous_files:
+            self.command_files[lib_name] = current_files
+            self.changed = True
+
+        logger.debug(f"Indexed {len(current_files)} command files of {lib_name}, {len(current_files) - reused} of them read again")
+
+        # files are visited by name, the first one that compiles a source wins
+        lib_commands = {}
+        for _, _, compiled_source, command in current_files.values():
+            if compiled_source != None:
+                lib_commands.setdefault(compiled_source, command)
+
+        return lib_commands
+
+    def get_compilation_command(self, lib_name : str, real_src_path : str) -> Union[str, None]:
+
+        '''
+        :return: Command of the .o.cmd file of lib_name whose -c argument is exactly real_src_path, None if there is none
+        '''
+
+        with self.lock:
+            if lib_name not in self.commands:
+                self.commands[lib_name] = self.scan_lib(lib_name)
+
+            return self.commands[lib_name].get(real_src_path)
+
+    def save(self):
+
+        '''
+        Writes the index next to the build if any lib changed, a build directory that cannot be written only loses the reuse.
+        '''
+
+        with self.lock:
+            if not self.changed:
+                return
+
+            try:
+                index_fd, tmp_path = tempfile.mkstemp(dir=self.app_build_dir, suffix=".tmp")
+                with os.fdopen(index_fd, "w") as tmp_fd:
+                    json.dump({"version" : INDEX_VERSION, "libs" : self.command_files}, tmp_fd, separators=(",", ":"))
+
+                os.replace(tmp_path, self.index_path)
+                self.changed = False
+
+            except OSError as e:
+                logger.warning(f"Could not save the command index at {self.index_path}: {e}")
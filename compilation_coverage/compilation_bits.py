@@ -0,0 +1,143 @@
+import logging
+from colorama import Fore
+from storage import get_storage
+
+logger = logging.getLogger(__name__)
+
+# bits per stored word, words are signed 64 bit integers so that MongoDB can update them atomically with $bit
+WORD_BITS = 64
+
+WORD_MASK = (1 << WORD_BITS) - 1
+
+# every compilation is interned to a small integer, its bit in the bitsets of the sources and blocks
+COMPILATION_BIT_FIELD = "bit"
+
+# bitset of the compilations that triggered a source or a block, word index (as string) -> word, missing words are 0
+TRIGGERED_BITS_FIELD = "triggered_bits"
+
+
+def get_word(compilation_bit : int) -> tuple[str, int]:
+
+    '''
+    :return: Key of the word that holds the bit of the compilation and the word with only that bit set
+    '''
+
+    word_index, bit_index = divmod(compilation_bit, WORD_BITS)
+
+    return str(word_index), to_signed_word(1 << bit_index)
+
+
+def to_signed_word(word : int) -> int:
+    return word - (1 << WORD_BITS) if word >= (1 << (WORD_BITS - 1)) else word
+
+
+def set_bit(triggered_bits : dict, compilation_bit : int):
+
+    word_key, word = get_word(compilation_bit)
+
+    triggered_bits[word_key] = to_signed_word((triggered_bits.get(word_key, 0) | word) & WORD_MASK)
+
+
+def clear_bit(triggered_bits : dict, compilation_bit : int):
+
+    word_key, word = get_word(compilation_bit)
+
+    if word_key not in triggered_bits:
+        return
+
+    remaining_word = to_signed_word(triggered_bits[word_key] & ~word & WORD_MASK)
+
+    # a bitset without compilations must stay empty, readers tell never triggered blocks by it
+    if remaining_word == 0:
+        triggered_bits.pop(word_key)
+    else:
+        triggered_bits[word_key] = remaining_word
+
+
+def has_bit(triggered_bits : dict, compilation_bit : int) -> bool:
+
+    word_key, word = get_word(compilation_bit)
+
+    return triggered_bits.get(word_key, 0) & word != 0
+
+
+def is_empty(triggered_bits : dict) -> bool:
+
+    # 0 words are left behind by compilations unbound in MongoDB
+    for word in triggered_bits.values():
+        if word != 0:
+            return False
+
+    return True
+
+
+def has_any_bit(triggered_bits : dict, compilation_bits : list[int]) -> bool:
+
+    for compilation_bit in compilation_bits:
+        if has_bit(triggered_bits, compilation_bit):
+            return True
+
+    return False
+
+
+def iterate_bits(triggered_bits : dict):
+
+    for word_key, word in triggered_bits.items():
+
+        word = word & WORD_MASK
+        base = int(word_key) * WORD_BITS
+
+        while word != 0:
+            lowest = word & -word
+            yield base + lowest.bit_length() - 1
+            word ^= lowest
+
+
+def decode_tags(triggered_bits : dict, tags_by_bit : dict[int, str]) -> list[str]:
+
+    # bits of deleted compilations have no tag anymore
+    return [tags_by_bit[compilation_bit] for compilation_bit in sorted(iterate_bits(triggered_bits)) if compilation_bit in tags_by_bit]
+
+
+def any_bit_filter(field : str, compilation_bits : list[int]) -> dict:
+
+    '''
+    Query that matches documents whose bitset in field has at least one of the given bits.
+    '''
+
+    # word index -> bit positions, a numeric bitmask must fit in 31 bits but bit positions cover the whole word
+    positions : dict[int, list[int]] = {}
+
+    for compilation_bit in compilation_bits:
+        word_index, bit_index = divmod(compilation_bit, WORD_BITS)
+        positions.setdefault(word_index, []).append(bit_index)
+
+    if positions == {}:
+        return {"_id" : {"$exists" : False}}
+
+    return {"$or" : [{f"{field}.{word_index}" : {"$bitsAnySet" : sorted(bit_indexes)}} for word_index, bit_indexes in positions.items()]}
+
+
+def has_bit_filter(field : str, compilation_bit : int) -> dict:
+
+    '''
+    Query that matches documents whose bitset in field has the bit of a compilation.
+    '''
+
+    word_index, bit_index = divmod(compilation_bit, WORD_BITS)
+
+    return {f"{field}.{word_index}" : {"$bitsAllSet" : [bit_index]}}
+
+
+def migrate_subcommand(saved_outfile : str):
+
+    '''
+    Converts a database that stores lists of tags in triggered_compilations to bitsets.
+    '''
+
+    interned_compilations, migrated_sources = get_storage().migrate()
+
+    logger.info(f"Interned {interned_compilations} compilations, migrated {migrated_sources} sources")
+
+    with open(saved_outfile, "a") as out:
+        out.write(Fore.GREEN + f"Interned {interned_compilations} compilations, migrated {migrated_sources} sources\n" + Fore.RESET)
@@ -0,0 +1,664 @@
+from __future__ import annotations
+import logging
+import os
+import re
+import shlex
+import threading
+from helpers import CompilationBlock
+from typing import Union
+
+# a condition that cannot be decided, a macro might be defined by some header for example
+UNDECIDED = None
+
+TOKEN_REGEX = re.compile(r"""\s*(?:
+    (?P<number>(?:0[xX][0-9a-fA-F]+|[0-9]+))(?P<suffix>[uUlL]*)
+    | (?P<char>'(?:\\.|[^\\'])+')
+    | (?P<identifier>[A-Za-z_][A-Za-z0-9_]*)
+    | (?P<operator>&&|\|\||<<|>>|<=|>=|==|!=|[-+*/%<>&|^!~?:(),])
+    )""", re.VERBOSE)
+
+DIRECTIVE_REGEX = re.compile(r"^\s*#\s*(ifdef|ifndef|if|elif|else)\b")
+
+IDENTIFIER_REGEX = re.compile(r"\s*([A-Za-z_][A-Za-z0-9_]*)")
+
+DEFINITION_REGEX = re.compile(r"^\s*#\s*(?:define|undef)\s+([A-Za-z_][A-Za-z0-9_]*)")
+
+CONFIG_DEFINE_REGEX = re.compile(r"^\s*#\s*define\s+([A-Za-z_][A-Za-z0-9_]*)(?:\s+(.*?))?\s*$")
+
+KCONFIG_REGEX = re.compile(r"^(CONFIG_[A-Za-z0-9_]+)=(.*)$")
+
+# macros that are always known to be undefined if they are absent from the configuration
+CONFIG_PREFIX = "CONFIG_"
+
+# flags that add a directory to the include search path
+INCLUDE_DIR_FLAGS = ("-I", "-iquote", "-isystem", "-idirafter")
+
+# Kconfig style helpers, IS_ENABLED(CONFIG_X) is 1 if CONFIG_X or CONFIG_X_MODULE is set to 1
+KCONFIG_HELPERS = {"IS_ENABLED" : ("", "_MODULE"), "IS_BUILTIN" : ("",), "IS_MODULE" : ("_MODULE",)}
+
+# the preprocessor computes in intmax_t and uintmax_t
+INTMAX_BITS = 64
+
+INTMAX_MAX = (1 << (INTMAX_BITS - 1)) - 1
+
+INTMAX_MIN = -(1 << (INTMAX_BITS - 1))
+
+UINTMAX_MASK = (1 << INTMAX_BITS) - 1
+
+COMPARISON_OPERATORS = ("==", "!=", "<", "<=", ">", ">=")
+
+BINARY_PRECEDENCE = {
+    "||" : 1, "&&" : 2, "|" : 3, "^" : 4, "&" : 5,
+    "==" : 6, "!=" : 6,
+    "<" : 7, "<=" : 7, ">" : 7, ">=" : 7,
+    "<<" : 8, ">>" : 8,
+    "+" : 9, "-" : 9,
+    "*" : 10, "/" : 10, "%" : 10
+}
+
+
+class UndecidableCondition(Exception):
+    pass
+
+
+class UnsignedValue(int):
+
+    '''
+    Value of type uintmax_t, plain ints are intmax_t.
+    '''
+
+    pass
+
+
+def to_intmax(value : int) -> int:
+
+    # gcc only warns and wraps around, the build may still fail on the warning
+    if value < INTMAX_MIN or value > INTMAX_MAX:
+        raise UndecidableCondition(f"Integer overflow in {value}")
+
+    return value
+
+
+def to_uintmax(value : int) -> UnsignedValue:
+    return UnsignedValue(value & UINTMAX_MASK)
+
+
+def is_unsigned(value) -> bool:
+    return isinstance(value, UnsignedValue)
+
+
+class MacroEnvironment:
+
+    '''
+    Macros known before a source is preprocessed: the configuration of the app and the -D/-U flags of its compilation command.
+    Macros that are not known are undecided, unless they are CONFIG_ options that no reachable header defines and the configuration of the app was loaded.
+    '''
+
+    macros : dict[str, str] = None
+    closed_config : bool = False
+    undecided_names : set[str] = None
+
+    def __init__(self, macros : dict[str, str], closed_config : bool, undecided_names : set[str]) -> None:
+        self.macros = macros
+        self.closed_config = closed_config
+        self.undecided_names = undecided_names
+
+    def is_defined(self, name : str) -> Union[int, None]:
+
+        if name in self.undecided_names:
+            return UNDECIDED
+
+        if name in self.macros:
+            return 1
+
+        if self.closed_config and name.startswith(CONFIG_PREFIX):
+            return 0
+
+        return UNDECIDED
+
+
+def load_config_macros(app_path : str, app_build_dir : str) -> Union[dict[str, str], None]:
+
+    '''
+    Loads the CONFIG_ macros of an app, from the generated config header of the build directory or else from the .config of the app.
+
+    :param app_path: App workspace, may be None
+    :param app_build_dir: Build directory of the app
+    '''
+
+    logger = logging.getLogger(__name__)
+
+    config_macros = {}
+
+    config_header = f"{app_build_dir}/include/uk/_config.h"
+
+    if os.path.isfile(config_header):
+        with open(config_header, "r") as config_fd:
+            for line in config_fd:
+                definition = CONFIG_DEFINE_REGEX.match(line)
+                if definition != None:
+                    config_macros[definition.group(1)] = definition.group(2) if definition.group(2) != None else ""
+
+        logger.info(f"Loaded {len(config_macros)} macros from {config_header}")
+        return config_macros
+
+    kconfig_file = f"{app_path}/.config" if app_path != None else f"{app_build_dir}/../.config"
+
+    if os.path.isfile(kconfig_file):
+        with open(kconfig_file, "r") as config_fd:
+            for line in config_fd:
+                option = KCONFIG_REGEX.match(line.strip())
+                if option == None:
+                    continue
+
+                name, value = option.group(1), option.group(2)
+
+                # same translation as the Kconfig header generator
+                if value == "y":
+                    config_macros[name] = "1"
+                elif value == "m":
+                    config_macros[name + "_MODULE"] = "1"
+                elif value != "n":
+                    config_macros[name] = value
+
+        logger.info(f"Loaded {len(config_macros)} macros from {kconfig_file}")
+        return config_macros
+
+    logger.warning(f"No configuration found in {app_build_dir} or {app_path}, CONFIG_ macros will be undecided")
+    return None
+
+
+# include directory -> CONFIG_ names its headers define or undefine, most sources of an app share their include directories
+include_dir_config_names : dict[str, frozenset[str]] = {}
+
+include_dir_config_names_lock = threading.Lock()
+
+
+def find_header_config_names(header_paths : list[str]) -> set[str]:
+
+    config_names = set()
+
+    for header_path in header_paths:
+        try:
+            with open(header_path, "r", errors="replace") as header_fd:
+                for line in header_fd:
+                    definition = DEFINITION_REGEX.match(line)
+                    if definition != None and definition.group(1).startswith(CONFIG_PREFIX):
+                        config_names.add(definition.group(1))
+        except OSError:
+            continue
+
+    return config_names
+
+
+def get_include_dir_config_names(include_dir : str) -> frozenset[str]:
+
+    '''
+    :return: CONFIG_ names defined or undefined by any header of an include directory or of its subdirectories
+    '''
+
+    include_dir = os.path.realpath(include_dir)
+
+    with include_dir_config_names_lock:
+        if include_dir in include_dir_config_names:
+            return include_dir_config_names[include_dir]
+
+    header_paths = [os.path.join(dir_path, file_name) for dir_path, _, file_names in os.walk(include_dir) for file_name in file_names if file_name.endswith(".h")]
+
+    config_names = frozenset(find_header_config_names(header_paths))
+
+    with include_dir_config_names_lock:
+        include_dir_config_names[include_dir] = config_names
+
+    return config_names
+
+
+def get_macro_environment(compile_command : str, config_macros : Union[dict[str, str], None], src_lines : list[str], src_path : str = None) -> MacroEnvironment:
+
+    '''
+    :param compile_command: Compilation command of the source, its -D and -U flags are applied in order on top of the configuration
+    :param config_macros: Macros returned by load_config_macros
+    :param src_lines: Lines of the source, macros that it defines or undefines itself are undecided
+    :param src_path: Path of the source, its directory is searched for quote includes
+    '''
+
+    macros = dict(config_macros) if config_macros != None else {}
+
+    include_dirs = [os.path.dirname(src_path)] if src_path != None else []
+    forced_includes = []
+
+    compile_tokens = shlex.split(compile_command)
+
+    i = 0
+    while i < len(compile_tokens):
+
+        flag = next((flag for flag in ("-D", "-U", "-include", "-imacros") + INCLUDE_DIR_FLAGS if compile_tokens[i].startswith(flag)), None)
+
+        if flag != None:
+
+            argument = compile_tokens[i][len(flag):]
+            if argument == "" and i + 1 < len(compile_tokens):
+                i += 1
+                argument = compile_tokens[i]
+
+            if flag == "-D":
+                name, _, value = argument.partition("=")
+                macros[name] = value if "=" in argument else "1"
+            elif flag == "-U":
+                macros.pop(argument, None)
+            elif flag == "-include" or flag == "-imacros":
+                forced_includes.append(argument)
+            else:
+                include_dirs.append(argument)
+
+        i += 1
+
+    undecided_names = set()
+    for line in src_lines:
+        definition = DEFINITION_REGEX.match(line)
+        if definition != None:
+            undecided_names.add(definition.group(1))
+
+    # a CONFIG_ option missing from the configuration is only known to be undefined if no header the source may include defines it
+    # options of the configuration keep their value, the generated config header defines all of them
+    if config_macros != None:
+
+        header_config_names = find_header_config_names(forced_includes)
+
+        for include_dir in include_dirs:
+            if os.path.isdir(include_dir):
+                header_config_names |= get_include_dir_config_names(include_dir)
+
+        undecided_names |= header_config_names - config_macros.keys()
+
+    return MacroEnvironment(macros, config_macros != None, undecided_names)
+
+
+def tokenize(condition : str) -> list[tuple[str, Union[str, int, None]]]:
+
+    tokens = []
+
+    position = 0
+    condition = condition.rstrip()
+
+    while position < len(condition):
+
+        token = TOKEN_REGEX.match(condition, position)
+
+        if token == None:
+            raise UndecidableCondition(f"Unexpected character in {condition} at {position}")
+
+        position = token.end()
+
+        if token.group("number") != None:
+            number = token.group("number")
+            if number[:2] in ("0x", "0X"):
+                value = int(number, 16)
+            elif len(number) > 1 and number[0] == "0":
+                value = int(number, 8)
+            else:
+                value = int(number)
+
+            if value > UINTMAX_MASK:
+                raise UndecidableCondition(f"Integer constant {number} is too large")
+
+            # like gcc, a constant too large for intmax_t is unsigned even without the u suffix
+            if "u" in token.group("suffix").lower() or value > INTMAX_MAX:
+                value = UnsignedValue(value)
+
+            tokens.append(("value", value))
+        elif token.group("char") != None:
+            literal = token.group("char")[1:-1].encode().decode("unicode_escape")
+            if len(literal) != 1:
+                raise UndecidableCondition(f"Multi character literal in {condition}")
+            # the sign of char depends on the target
+            if ord(literal) > 127:
+                raise UndecidableCondition(f"Non ASCII character literal in {condition}")
+            tokens.append(("value", ord(literal)))
+        elif token.group("identifier") != None:
+            tokens.append(("identifier", token.group("identifier")))
+        else:
+            tokens.append(("operator", token.group("operator")))
+
+    return tokens
+
+
+def expand_macros(tokens : list[tuple], env : MacroEnvironment, hidden : frozenset = frozenset()) -> list[tuple]:
+
+    '''
+    Replaces defined(), Kconfig helpers and identifiers with values, just like the preprocessor does before evaluating a condition.
+    Identifiers that are known to be undefined become 0, the undecided ones become UNDECIDED.
+    '''
+
+    expanded = []
+
+    i = 0
+    while i < len(tokens):
+
+        kind, text = tokens[i]
+
+        if kind != "identifier":
+            expanded.append(tokens[i])
+            i += 1
+            continue
+
+        has_arguments = i + 1 < len(tokens) and tokens[i + 1] == ("operator", "(")
+
+        if text == "defined" or (text in KCONFIG_HELPERS and has_arguments):
+
+            # defined X, defined(X), IS_ENABLED(X)
+            if has_arguments:
+                if i + 3 >= len(tokens) or tokens[i + 2][0] != "identifier" or tokens[i + 3] != ("operator", ")"):
+                    raise UndecidableCondition(f"Malformed {text} in {tokens}")
+                name = tokens[i + 2][1]
+                i += 4
+            else:
+                if i + 1 >= len(tokens) or tokens[i + 1][0] != "identifier":
+                    raise UndecidableCondition(f"Malformed defined in {tokens}")
+                name = tokens[i + 1][1]
+                i += 2
+
+            if text == "defined":
+                expanded.append(("value", env.is_defined(name)))
+                continue
+
+            enabled = 0
+            for suffix in KCONFIG_HELPERS[text]:
+                if env.is_defined(name + suffix) == UNDECIDED:
+                    enabled = UNDECIDED
+                    break
+                if env.macros.get(name + suffix) == "1":
+                    enabled = 1
+            expanded.append(("value", enabled))
+            continue
+
+        # function-like macros other than the Kconfig helpers are not supported
+        if has_arguments:
+            raise UndecidableCondition(f"Function-like macro {text}")
+
+        defined = env.is_defined(text)
+
+        if defined == 1 and text not in hidden:
+            expansion = tokenize(env.macros[text])
+            if expansion == []:
+                raise UndecidableCondition(f"{text} expands to nothing")
+            expanded += expand_macros(expansion, env, hidden | {text})
+        elif defined == 0 or text in hidden:
+            # an undefined identifier is 0 in a preprocessor condition
+            expanded.append(("value", 0))
+        else:
+            expanded.append(("value", UNDECIDED))
+
+        i += 1
+
+    return expanded
+
+
+def apply_binary_operator(operator : str, left, right, evaluated : bool = True):
+
+    '''
+    :param evaluated: False for operands C never evaluates, e.g. the right side of 0 &&, only the type of their result matters
+    '''
+
+    if operator == "&&":
+        if left == 0 or right == 0:
+            return 0
+        return UNDECIDED if left == UNDECIDED or right == UNDECIDED else 1
+
+    if operator == "||":
+        if (left != UNDECIDED and left != 0) or (right != UNDECIDED and right != 0):
+            return 1
+        return UNDECIDED if left == UNDECIDED or right == UNDECIDED else 0
+
+    if left == UNDECIDED or right == UNDECIDED:
+        return UNDECIDED
+
+    # usual arithmetic conversions, a shift has the type of its left operand
+    if operator in ("<<", ">>"):
+        is_unsigned_result = is_unsigned(left)
+    else:
+        is_unsigned_result = is_unsigned(left) or is_unsigned(right)
+
+    try:
+        return apply_arithmetic_operator(operator, left, right, is_unsigned_result)
+
+    except UndecidableCondition:
+        if evaluated:
+            raise
+        return UnsignedValue(0) if is_unsigned_result and operator not in COMPARISON_OPERATORS else 0
+
+
+def apply_arithmetic_operator(operator : str, left : int, right : int, is_unsigned_result : bool):
+
+    if operator in ("<<", ">>"):
+
+        shift = right & UINTMAX_MASK if is_unsigned(right) else right
+
+        # gcc shifts the other way for negative counts, let it decide these
+        if shift < 0 or shift >= INTMAX_BITS:
+            raise UndecidableCondition(f"Shift by {shift}")
+
+        if operator == ">>":
+            # right shifts of negative values are arithmetic in gcc
+            return to_uintmax(left >> shift) if is_unsigned_result else left >> shift
+
+        return to_uintmax(left << shift) if is_unsigned_result else to_intmax(left << shift)
+
+    if is_unsigned_result:
+        left, right = left & UINTMAX_MASK, right & UINTMAX_MASK
+
+    if operator in COMPARISON_OPERATORS:
+        return {
+            "==" : lambda: int(left == right), "!=" : lambda: int(left != right),
+            "<" : lambda: int(left < right), "<=" : lambda: int(left <= right),
+            ">" : lambda: int(left > right), ">=" : lambda: int(left >= right)
+        }[operator]()
+
+    if operator in ("/", "%"):
+        if right == 0:
+            raise UndecidableCondition("Division by zero")
+        # C division truncates towards zero
+        quotient = abs(left) // abs(right) * (1 if (left >= 0) == (right >= 0) else -1)
+        result = quotient if operator == "/" else left - quotient * right
+    else:
+        result = {
+            "|" : lambda: left | right, "^" : lambda: left ^ right, "&" : lambda: left & right,
+            "+" : lambda: left + right, "-" : lambda: left - right, "*" : lambda: left * right
+        }[operator]()
+
+    return to_uintmax(result) if is_unsigned_result else to_intmax(result)
+
+
+class ExpressionParser:
+
+    '''
+    Precedence climbing evaluator over expanded tokens, with a third UNDECIDED value that only && and || can get rid of.
+    '''
+
+    tokens : list[tuple] = None
+    position : int = 0
+
+    def __init__(self, tokens : list[tuple]) -> None:
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self) -> Union[tuple, None]:
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def expect(self, operator : str):
+        if self.peek() != ("operator", operator):
+            raise UndecidableCondition(f"Expected {operator} in {self.tokens}")
+        self.position += 1
+
+    def parse(self):
+        value = self.parse_conditional(True)
+        if self.peek() != None:
+            raise UndecidableCondition(f"Trailing tokens in {self.tokens}")
+        return value
+
+    def parse_conditional(self, evaluated : bool):
+
+        '''
+        :param evaluated: False inside operands that C never evaluates, their errors do not count
+        '''
+
+        condition = self.parse_binary(1, evaluated)
+
+        if self.peek() != ("operator", "?"):
+            return condition
+
+        self.position += 1
+        if_true = self.parse_conditional(evaluated and condition != 0)
+        self.expect(":")
+        if_false = self.parse_conditional(evaluated and (condition == UNDECIDED or condition == 0))
+
+        # the result has the type of both branches, even of the one that is not taken, and an undecided one may be unsigned
+        if if_true == UNDECIDED or if_false == UNDECIDED:
+            return UNDECIDED
+
+        if is_unsigned(if_true) or is_unsigned(if_false):
+            if_true, if_false = to_uintmax(if_true), to_uintmax(if_false)
+
+        if condition == UNDECIDED:
+            return if_true if if_true == if_false else UNDECIDED
+
+        return if_true if condition != 0 else if_false
+
+    def parse_binary(self, min_precedence : int, evaluated : bool):
+
+        left = self.parse_unary(evaluated)
+
+        while True:
+            token = self.peek()
+            if token == None or token[0] != "operator" or BINARY_PRECEDENCE.get(token[1], 0) < min_precedence:
+                return left
+
+            self.position += 1
+
+            # 0 && x and 1 || x never evaluate x
+            is_short_circuit = (token[1] == "&&" and left == 0) or (token[1] == "||" and left != UNDECIDED and left != 0)
+
+            right = self.parse_binary(BINARY_PRECEDENCE[token[1]] + 1, evaluated and not is_short_circuit)
+            left = apply_binary_operator(token[1], left, right, evaluated)
+
+    def parse_unary(self, evaluated : bool):
+
+        token = self.peek()
+
+        if token == None:
+            raise UndecidableCondition(f"Unexpected end of {self.tokens}")
+
+        self.position += 1
+
+        if token[0] == "value":
+            return token[1]
+
+        if token == ("operator", "("):
+            value = self.parse_conditional(evaluated)
+            self.expect(")")
+            return value
+
+        if token[0] == "operator" and token[1] in ("!", "~", "-", "+"):
+            value = self.parse_unary(evaluated)
+            if value == UNDECIDED:
+                return UNDECIDED
+            if token[1] == "!":
+                return int(value == 0)
+            if token[1] == "+":
+                return value
+            result = ~value if token[1] == "~" else -value
+            if is_unsigned(value):
+                return to_uintmax(result)
+            try:
+                return to_intmax(result)
+            except UndecidableCondition:
+                if evaluated:
+                    raise
+                return 0
+
+        raise UndecidableCondition(f"Unexpected {token[1]} in {self.tokens}")
+
+
+def evaluate_condition(condition : str, env : MacroEnvironment):
+
+    '''
+    Evaluates the condition of a #if/#elif. Returns 1, 0 or UNDECIDED.
+    '''
+
+    try:
+        return ExpressionParser(expand_macros(tokenize(condition), env)).parse()
+    except (UndecidableCondition, RecursionError, ValueError):
+        return UNDECIDED
+
+
+def and3(left, right):
+    return apply_binary_operator("&&", left, right)
+
+
+def or3(left, right):
+    return apply_binary_operator("||", left, right)
+
+
+def not3(value):
+    return UNDECIDED if value == UNDECIDED else int(value == 0)
+
+
+def predict_activated_blocks(total_blocks : list[CompilationBlock], src_lines : list[str], env : MacroEnvironment) -> Union[list[int], None]:
+
+    '''
+    Decides which compilation blocks are activated without running gcc.
+    A block is activated if its parent is activated, no previous branch of its #if/#elif/#else chain was taken and its own condition holds.
+
+    :param total_blocks: All compilation blocks of the source
+    :param src_lines: Lines of the source, used to tell #ifdef/#ifndef/#if/#elif/#else apart
+    :param env: Macro environment of the compilation
+    :return: Block counters of activated blocks, None if any block is undecided and gcc has to be asked
+    '''
+
+    logger = logging.getLogger(__name__)
+
+    # branches of the same chain share the parent and the next branch starts on the line the previous one ends
+    chain_ends = {(block.parent_counter, block.end_line) : block for block in total_blocks}
+
+    activated : dict[int, Union[int, None]] = {}
+
+    # some branch of the chain up to (and including) this block was taken
+    chain_taken : dict[int, Union[int, None]] = {}
+
+    for block in sorted(total_blocks, key= lambda cb : cb.block_counter):
+
+        directive_idx = block.start_line - 1
+        directive = DIRECTIVE_REGEX.match(src_lines[directive_idx]) if 0 <= directive_idx < len(src_lines) else None
+
+        if directive == None:
+            logger.debug(f"No directive found at line {block.start_line} for block {block.block_counter}")
+            return None
+
+        kind = directive.group(1)
+
+        parent_activated = 1 if block.parent_counter == -1 else activated.get(block.parent_counter, UNDECIDED)
+
+        previous_branch = chain_ends.get((block.parent_counter, block.start_line)) if kind in ("elif", "else") else None
+        previous_taken = chain_taken.get(previous_branch.block_counter, UNDECIDED) if previous_branch != None else 0
+
+        # gcc does not even look at conditions of skipped branches
+        if parent_activated == 0 or previous_taken == 1:
+            condition = 0
+        elif kind == "else":
+            condition = 1
+        elif kind in ("ifdef", "ifndef"):
+            macro = IDENTIFIER_REGEX.match(src_lines[directive_idx], directive.end())
+            condition = env.is_defined(macro.group(1)) if macro != None else UNDECIDED
+            if kind == "ifndef":
+                condition = not3(condition)
+        else:
+            condition = evaluate_condition(block.symbol_condition, env)
+
+        chain_taken[block.block_counter] = or3(previous_taken, condition)
+        activated[block.block_counter] = and3(parent_activated, and3(not3(previous_taken), condition))
+
+        if activated[block.block_counter] == UNDECIDED:
+            logger.debug(f"Block {block.block_counter} with condition {block.symbol_condition} is undecided")
+            return None
+
+    return [block_counter for block_counter, is_activated in activated.items() if is_activated == 1]
@@ -1,28 +1,46 @@
 #!/usr/bin/python3
 
 import argparse
-import pymongo
 import logging
 import os
 import time
 from colorama import Fore, Back
 
-DATABASE = "Unikraft-Static-Analysis"
-SOURCES_COLLECTION = "Sources"
-COMPILATION_COLLECTION = "Compilations"
-COVERITY_DEFECTS_COLLECTION = "Coverity-Defects"
-
-import add_app
-import list_app
-import view_app
+# subcommand modules are imported by the subcommands that use them, so that light commands start fast
+import coverage_cache
+import storage
 
 default_log_file = "./coverage_logs.log"
 default_out_file = "./coverage_out.ansi"
 saved_verbose = None
 saved_logfile = None
 saved_outfile = None
+saved_cache_dir = None
+saved_cache_size = None
+saved_backend = None
+saved_database = None
+
+def positive_int(value : str) -> int:
+
+    '''
+    argparse type of the counts that must be at least 1, e.g. workers or batch sizes
+    '''
+
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive integer")
+    return number
+
+def non_negative_int(value : str) -> int:
 
-db = pymongo.MongoClient("mongodb://localhost:27017/")
+    '''
+    argparse type of the counts where 0 has a meaning, e.g. no parse processes or no retries
+    '''
+
+    number = int(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"{value} is not a non-negative integer")
+    return number
 
 def main():
 
@@ -70,6 +88,47 @@ def main():
         type=str
     )
 
+    init_parser.add_argument(
+        '-c',
+        '--cache-dir',
+        required=False,
+        action='store',
+        help=f'Directory of the on-disk cache shared by all runs (parsed sources etc.). Default is {coverage_cache.DEFAULT_CACHE_DIR}',
+        default=coverage_cache.DEFAULT_CACHE_DIR,
+        type=str
+    )
+
+    init_parser.add_argument(
+        '-s',
+        '--cache-size',
+        required=False,
+        action='store',
+        help=f'Maximum size in MB of every cache namespace, least recently used entries are evicted. Default is {coverage_cache.DEFAULT_CACHE_SIZE}',
+        default=coverage_cache.DEFAULT_CACHE_SIZE,
+        type=positive_int
+    )
+
+    init_parser.add_argument(
+        '-b',
+        '--backend',
+        required=False,
+        action='store',
+        help=f'Database engine. mongo needs a running MongoDB server, sqlite keeps everything in a single local file. Default is {storage.StorageBackend.MONGO.value}',
+        choices=[backend.value for backend in storage.StorageBackend],
+        default=storage.StorageBackend.MONGO.value,
+        type=str
+    )
+
+    init_parser.add_argument(
+        '-d',
+        '--database',
+        required=False,
+        action='store',
+        help=f'MongoDB URI or SQLite file path. Default is {storage.DEFAULT_MONGO_URI} for mongo and {storage.DEFAULT_SQLITE_PATH} for sqlite',
+        default=None,
+        type=str
+    )
+
     app_parser = subparser.add_parser(
         description='App-related operations such as registering an app compilation etc.', 
         name='app', 
@@ -111,6 +170,214 @@ def main():
         help="A new unique tag that identifies an app's compilation process"
     )
 
+    add_app_parser.add_argument(
+        '-j',
+        '--jobs',
+        required=False,
+        action='store',
+        help='Number of sources analyzed in parallel (version check, parsing, instrumentation, compilation, db update). Default is 1',
+        default=1,
+        type=positive_int
+    )
+
+    add_app_parser.add_argument(
+        '-i',
+        '--instrumentation',
+        required=False,
+        action='store',
+        help='Where instrumented sources are compiled. in-place rewrites the source inside the Unikraft tree and restores it afterwards, out-of-tree compiles a private copy and never touches the source tree. in-place is only used with a single worker, see --jobs. Default is in-place',
+        choices=["in-place", "out-of-tree"],
+        default="in-place"
+    )
+
+    add_app_parser.add_argument(
+        '-p',
+        '--probe',
+        required=False,
+        action='store',
+        help='How far gcc goes when probing activated compilation blocks. compile runs the full .o.cmd command, preprocess stops after preprocessing (-E), syntax skips code generation (-fsyntax-only). Default is compile',
+        choices=["compile", "preprocess", "syntax"],
+        default="compile"
+    )
+
+    add_app_parser.add_argument(
+        '-e',
+        '--engine',
+        required=False,
+        action='store',
+        help='How activated compilation blocks are found. warning instruments the source with #warning directives, linemarker preprocesses the unmodified source and follows its linemarkers (no instrumentation, --instrumentation and --probe are ignored). Default is warning',
+        choices=["warning", "linemarker"],
+        default="warning"
+    )
+
+    add_app_parser.add_argument(
+        '-s',
+        '--static-eval',
+        required=False,
+        action='store_true',
+        help='Evaluate #if conditions from the app configuration and the -D flags of each source, gcc is only run for sources with undecidable conditions',
+        default=False
+    )
+
+    add_app_parser.add_argument(
+        '--batch-size',
+        required=False,
+        action='store',
+        help=f'Number of buffered source writes sent to the database in a single bulk write. Default is {storage.DEFAULT_BATCH_SIZE}',
+        default=storage.DEFAULT_BATCH_SIZE,
+        type=positive_int
+    )
+
+    add_app_parser.add_argument(
+        '--parse-jobs',
+        required=False,
+        action='store',
+        help='Number of processes parsing new and deprecated sources ahead of the workers, so that parsing overlaps with the compiler probes. 0 lets every worker parse its own sources. Default is one per worker, at most one per core, when --jobs is above 1, 0 otherwise',
+        default=None,
+        type=non_negative_int
+    )
+
+    add_app_parser.add_argument(
+        '--max-probes',
+        required=False,
+        action='store',
+        help='Number of compilers (gcc probes) running at the same time. Default is one per worker (--jobs)',
+        default=None,
+        type=positive_int
+    )
+
+    add_app_parser.add_argument(
+        '--probe-timeout',
+        required=False,
+        action='store',
+        help='Seconds a single compiler run may take before it is killed, 0 waits forever. Default is 300',
+        default=300,
+        type=float
+    )
+
+    add_app_parser.add_argument(
+        '--probe-retries',
+        required=False,
+        action='store',
+        help='How many times a compiler run that timed out or could not start is retried, then the source is recorded as failed and skipped. Default is 1',
+        default=1,
+        type=non_negative_int
+    )
+
+    add_app_parser.add_argument(
+        '-l',
+        '--max-load',
+        required=False,
+        action='store',
+        help='Do not start a new compiler while the load average is at or above this value, like make -l. By default the load is not checked',
+        default=None,
+        type=float
+    )
+
+    add_app_parser.add_argument(
+        '--jobserver',
+        required=False,
+        action='store_true',
+        help='Take a token of the GNU make jobserver for every compiler, for runs started from a make -j recipe marked with +',
+        default=False
+    )
+
+    add_app_parser.add_argument(
+        '--split-blocks',
+        required=False,
+        action='store',
+        help='Store the compilation blocks of sources with at least this many blocks in their own collection instead of inside the source document, for very large or generated sources (mongo backend only). By default all blocks stay inside the source documents',
+        default=None,
+        type=positive_int
+    )
+
+    registration_group = add_app_parser.add_mutually_exclusive_group()
+
+    registration_group.add_argument(
+        '--resume',
+        required=False,
+        action='store_true',
+        help='Finish the registration of a tag whose previous run did not complete, sources already done with the same version, compilation command and configuration are skipped',
+        default=False
+    )
+
+    registration_group.add_argument(
+        '--update',
+        required=False,
+        action='store_true',
+        help='Register an existing tag again in place, only sources whose version, compilation command or configuration changed are analyzed again and sources the app no longer compiles are removed from the tag',
+        default=False
+    )
+
+    add_app_parser.add_argument(
+        '--no-cache',
+        required=False,
+        action='store_true',
+        help='Do not use the on-disk cache for this run',
+        default=False
+    )
+
+    refresh_app_parser = app_sub_parser.add_parser(
+        description="Analyze again the registered sources that changed in the Unikraft tree and in the libs, for every compilation that compiled them, with the compilation commands stored when the apps were added",
+        name="refresh",
+        help="Analyze again the registered sources that changed since a git revision, for all registered compilations"
+    )
+
+    refresh_app_parser.add_argument(
+        '--since',
+        required=True,
+        action='store',
+        help='Git revision the Unikraft tree and the libs are compared with, uncommitted changes included, e.g. ORIG_HEAD after a merge. Repositories without this revision are skipped'
+    )
+
+    refresh_app_parser.add_argument(
+        '-j',
+        '--jobs',
+        required=False,
+        action='store',
+        help='Number of sources parsed and compilers run in parallel. Default is 1',
+        default=1,
+        type=positive_int
+    )
+
+    refresh_app_parser.add_argument(
+        '-p',
+        '--probe',
+        required=False,
+        action='store',
+        help='How far gcc goes when probing activated compilation blocks, see app add. Default is compile',
+        choices=["compile", "preprocess", "syntax"],
+        default="compile"
+    )
+
+    refresh_app_parser.add_argument(
+        '-e',
+        '--engine',
+        required=False,
+        action='store',
+        help='How activated compilation blocks are found, see app add. Sources are always instrumented out of tree. Default is warning',
+        choices=["warning", "linemarker"],
+        default="warning"
+    )
+
+    refresh_app_parser.add_argument(
+        '--probe-timeout',
+        required=False,
+        action='store',
+        help='Seconds a single compiler run may take before it is killed, 0 waits forever. Default is 300',
+        default=300,
+        type=float
+    )
+
+    refresh_app_parser.add_argument(
+        '--probe-retries',
+        required=False,
+        action='store',
+        help='How many times a compiler run that timed out or could not start is retried, then the source keeps its stored version. Default is 1',
+        default=1,
+        type=non_negative_int
+    )
+
     list_app_parser = app_sub_parser.add_parser(
         description="List all apps and their compilation process",
         name="list",
@@ -137,8 +404,57 @@ def main():
         help="Delete a specific app and its analysis statistics"
     )
 
+    cache_parser = subparser.add_parser(
+        description="Inspect or clear the on-disk cache shared by all runs",
+        name="cache",
+        help="Inspect or clear the on-disk cache shared by all runs"
+    )
+
+    cache_sub_parser = cache_parser.add_subparsers(dest="cache_operations", help="Available cache operations")
+
+    cache_sub_parser.add_parser(
+        description="Show number of entries and size of every cache namespace",
+        name="stats",
+        help="Show number of entries and size of every cache namespace"
+    )
+
+    cache_sub_parser.add_parser(
+        description="Remove all cache entries",
+        name="clear",
+        help="Remove all cache entries"
+    )
+
+    summaries_parser = subparser.add_parser(
+        description="Maintain the precomputed coverage summaries of every compilation, by lib and by directory",
+        name="summaries",
+        help="Maintain the precomputed coverage summaries of every compilation, by lib and by directory"
+    )
+
+    summaries_sub_parser = summaries_parser.add_subparsers(dest="summaries_operations", help="Available summaries operations")
+
+    summaries_sub_parser.add_parser(
+        description="Recompute all summaries from the registered sources, e.g. for a database filled by an older version of the tool",
+        name="rebuild",
+        help="Recompute all summaries from the registered sources"
+    )
+
+    subparser.add_parser(
+        description="Convert a database filled by an older version of the tool, tag lists of sources and blocks become compilation bitsets",
+        name="migrate",
+        help="Convert a database filled by an older version of the tool to the current schema"
+    )
+
     show_subparser = subparser.add_parser("status", help="See global status of the compilation analysis coverage for your local Unikraft environment")
 
+    show_subparser.add_argument(
+        '-d',
+        '--details',
+        required=False,
+        action='store_true',
+        help='Also list every never compiled source and every never triggered compilation block',
+        default=False
+    )
+
     args = parser.parse_args()
     
     if args.operations == "init":
@@ -148,7 +464,11 @@ def main():
                 {
                     "logfile" : args.logfile,
                     "outfile" : args.outfile,
-                    "verbose" : args.verbose
+                    "verbose" : args.verbose,
+                    "cache_dir" : args.cache_dir,
+                    "cache_size" : args.cache_size,
+                    "backend" : args.backend,
+                    "database" : args.database
                 },
                 indent=4
             )
@@ -161,6 +481,10 @@ def main():
             saved_verbose = info["verbose"]
             saved_logfile = info["logfile"]
             saved_outfile = info["outfile"]
+            saved_cache_dir = info.get("cache_dir", coverage_cache.DEFAULT_CACHE_DIR)
+            saved_cache_size = info.get("cache_size", coverage_cache.DEFAULT_CACHE_SIZE)
+            saved_backend = info.get("backend", storage.StorageBackend.MONGO.value)
+            saved_database = info.get("database", None)
         
 
 
@@ -175,21 +499,75 @@ def main():
         out.writelines(f"-----------------------------------------------{time.ctime()}------------------------------------------")
         out.writelines("----------------------------------------------------------------------------------------------------\n")
     
+    # the database is opened by the first subcommand that needs it
+    storage.configure_storage(storage.StorageBackend(saved_backend), saved_database)
+
 
     if args.operations == "app":
 
         if args.app_operations == "add":
+            import add_app
             build_dir = args.build if args.build != None else args.app + "/build"
-            add_app.add_app_subcommand(args.app, build_dir, args.tag)
+            options = add_app.AnalysisOptions(
+                jobs= args.jobs,
+                instrumentation= add_app.InstrumentationMode(args.instrumentation),
+                probe= add_app.ProbeMode(args.probe),
+                engine= add_app.ActivationEngine(args.engine),
+                static_evaluation= args.static_eval,
+                cache_dir= None if args.no_cache else saved_cache_dir,
+                cache_size= saved_cache_size,
+                batch_size= args.batch_size,
+                parse_jobs= args.parse_jobs,
+                max_probes= args.max_probes,
+                probe_timeout= args.probe_timeout if args.probe_timeout > 0 else None,
+                probe_retries= args.probe_retries,
+                max_load= args.max_load,
+                jobserver= args.jobserver,
+                split_threshold= args.split_blocks,
+                registration= add_app.RegistrationMode.RESUME if args.resume else (add_app.RegistrationMode.UPDATE if args.update else add_app.RegistrationMode.NEW)
+            )
+            add_app.add_app_subcommand(args.app, build_dir, args.tag, options)
+
+        if args.app_operations == "refresh":
+            import refresh_app
+            options = refresh_app.AnalysisOptions(
+                jobs= args.jobs,
+                probe= refresh_app.ProbeMode(args.probe),
+                engine= refresh_app.ActivationEngine(args.engine),
+                probe_timeout= args.probe_timeout if args.probe_timeout > 0 else None,
+                probe_retries= args.probe_retries
+            )
+            refresh_app.refresh_app_subcommand(args.since, options, saved_outfile)
 
         if args.app_operations == "list":
+            import list_app
             list_app.list_app_subcommand(saved_outfile)
 
         if args.app_operations == "view":
+            import view_app
             view_app.view_app_subcommand(args.tags, saved_outfile)
 
+    elif args.operations == "cache":
+
+        if args.cache_operations == "stats":
+            coverage_cache.cache_stats_subcommand(saved_cache_dir, saved_cache_size, saved_outfile)
+
+        if args.cache_operations == "clear":
+            coverage_cache.cache_clear_subcommand(saved_cache_dir, saved_outfile)
+
+    elif args.operations == "summaries":
+
+        if args.summaries_operations == "rebuild":
+            import summaries
+            summaries.rebuild_summaries_subcommand(saved_outfile)
+
+    elif args.operations == "migrate":
+        import compilation_bits
+        compilation_bits.migrate_subcommand(saved_outfile)
+
     elif args.operations == "status":
-        status_subcommand()
+        import status
+        status.status_subcommand(saved_outfile, args.details)
     else:
         logging.critical("Unknown " + str(args.operations) + " operation")
 
@@ -0,0 +1,183 @@
+from __future__ import annotations
+import json
+import logging
+import os
+import tempfile
+import threading
+from colorama import Fore
+from typing import Union
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "unikraft-coverage")
+
+# in MB
+DEFAULT_CACHE_SIZE = 512
+
+# after an eviction the cache is left at this fraction of its maximum size, so that evictions do not happen on every write
+EVICTION_WATERMARK = 0.9
+
+PARSE_NAMESPACE = "parse"
+
+ACTIVATION_NAMESPACE = "activation"
+
+logger = logging.getLogger(__name__)
+
+
+class ResultCache:
+
+    '''
+    On-disk cache of JSON documents, one file per key, shared by all the runs of the tool.
+    The modification time of an entry is its last use, the least recently used entries are evicted when the cache grows over its size.
+    Safe to use from multiple threads and multiple processes since entries are replaced atomically.
+    '''
+
+    namespace_dir : str = None
+    max_size : int = None
+    current_size : int = None
+    hits : int = 0
+    misses : int = 0
+    lock : threading.Lock = None
+
+    def __init__(self, cache_dir : str, namespace : str, max_size_mb : int) -> None:
+        self.namespace_dir = os.path.join(cache_dir, namespace)
+        self.max_size = max_size_mb * 1024 * 1024
+        self.current_size = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        os.makedirs(self.namespace_dir, exist_ok=True)
+
+    def get_entry_path(self, key : str) -> str:
+        return os.path.join(self.namespace_dir, key[:2], key + ".json")
+
+    def contains(self, key : str) -> bool:
+
+        # neither counts as a hit or a miss nor marks the entry as used
+        return os.path.isfile(self.get_entry_path(key))
+
+    def get(self, key : str) -> Union[dict, None]:
+
+        entry_path = self.get_entry_path(key)
+
+        try:
+            with open(entry_path, "r") as entry_fd:
+                value = json.load(entry_fd)
+
+            # mark as recently used
+            os.utime(entry_path)
+
+        except (OSError, ValueError):
+            with self.lock:
+                self.misses += 1
+            return None
+
+        with self.lock:
+            self.hits += 1
+
+        return value
+
+    def put(self, key : str, value : dict):
+
+        entry_path = self.get_entry_path(key)
+
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+
+        entry_fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(entry_path), suffix=".tmp")
+        with os.fdopen(entry_fd, "w") as tmp_fd:
+            json.dump(value, tmp_fd, separators=(",", ":"))
+
+        entry_size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, entry_path)
+
+        with self.lock:
+            if self.current_size == None:
+                self.current_size = sum(size for _, size, _ in iterate_entries(self.namespace_dir))
+            else:
+                self.current_size += entry_size
+
+            over_size = self.current_size > self.max_size
+
+        if over_size:
+            self.evict()
+
+    def evict(self):
+
+        with self.lock:
+            entries = sorted(iterate_entries(self.namespace_dir), key= lambda entry : entry[2])
+
+            self.current_size = sum(size for _, size, _ in entries)
+
+            for entry_path, size, _ in entries:
+                if self.current_size <= self.max_size * EVICTION_WATERMARK:
+                    break
+
+                try:
+                    os.remove(entry_path)
+                    self.current_size -= size
+                except OSError:
+                    pass
+
+        logger.debug(f"Cache {self.namespace_dir} evicted down to {self.current_size} bytes")
+
+
+def iterate_entries(namespace_dir : str):
+
+    '''
+    Yields (path, size, last use) for every entry of a cache namespace.
+    '''
+
+    for bucket in os.scandir(namespace_dir):
+        if not bucket.is_dir():
+            continue
+
+        for entry in os.scandir(bucket.path):
+            if entry.name.endswith(".json"):
+                try:
+                    entry_stat = entry.stat()
+                except OSError:
+                    continue
+                yield entry.path, entry_stat.st_size, entry_stat.st_mtime
+
+
+def cache_stats_subcommand(cache_dir : str, cache_size : int, saved_outfile : str):
+
+    with open(saved_outfile, "a") as out:
+        out.write(f"Cache: {cache_dir}\n")
+        out.write(f"\tMaximum size per namespace: {cache_size} MB\n")
+
+        if not os.path.isdir(cache_dir):
+            out.write(Fore.YELLOW + "\tEmpty\n" + Fore.RESET)
+            return
+
+        for namespace in sorted(os.listdir(cache_dir)):
+
+            namespace_dir = os.path.join(cache_dir, namespace)
+            if not os.path.isdir(namespace_dir):
+                continue
+
+            entries = list(iterate_entries(namespace_dir))
+            total_size = sum(size for _, size, _ in entries)
+
+            out.write(f"\t{namespace}: {len(entries)} entries, {total_size / (1024 * 1024):.2f} MB\n")
+
+
+def cache_clear_subcommand(cache_dir : str, saved_outfile : str):
+
+    removed_entries = 0
+
+    if os.path.isdir(cache_dir):
+        for namespace in os.listdir(cache_dir):
+
+            namespace_dir = os.path.join(cache_dir, namespace)
+            if not os.path.isdir(namespace_dir):
+                continue
+
+            for entry_path, _, _ in list(iterate_entries(namespace_dir)):
+                os.remove(entry_path)
+                removed_entries += 1
+
+    logger.info(f"Removed {removed_entries} cache entries from {cache_dir}")
+
+    with open(saved_outfile, "a") as out:
+        out.write(f"Cache: {cache_dir}\n")
+        out.write(Fore.GREEN + f"\tRemoved {removed_entries} entries\n" + Fore.RESET)
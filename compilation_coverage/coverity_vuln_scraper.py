@@ -1,19 +1,6 @@
-#from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.wait import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.common.action_chains import ActionChains
-from selenium.webdriver.firefox.options import Options
-from selenium.webdriver.firefox.service import Service
-from selenium.webdriver.firefox.firefox_binary import FirefoxBinary
-from seleniumwire import webdriver
-from seleniumwire.utils import decode
 import os
 import time
 import json
-USER_EMAIL = os.environ["COVERITY_SCRAPER_USER_EMAIL"]
-USER_PASS = os.environ["COVERITY_SCRAPER_PASS"]
-PROJECT_NAME = os.environ["COVERITY_PROJECT_NAME"]
 FIREFOX_PATH = "/usr/bin/firefox"
 
 
@@ -24,6 +11,19 @@ gecko_path = "/snap/bin/geckodriver"
 
 def fetch_vulnerabilities() -> list | None:
 
+    # selenium is heavy and only needed here, the credentials are only required when the scraper actually runs
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.wait import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.webdriver.firefox.options import Options
+    from selenium.webdriver.firefox.service import Service
+    from seleniumwire import webdriver
+    from seleniumwire.utils import decode
+
+    USER_EMAIL = os.environ["COVERITY_SCRAPER_USER_EMAIL"]
+    USER_PASS = os.environ["COVERITY_SCRAPER_PASS"]
+    PROJECT_NAME = os.environ["COVERITY_PROJECT_NAME"]
+
     try:
         options = Options()
         #options.add_argument("--headless")
@@ -3,31 +3,177 @@ import subprocess
 import logging
 import os
 import re
+import shlex
 import logging
 import hashlib
-from bson.objectid import ObjectId
+import io
+import threading
 from dataclasses import dataclass
-from typing import Union
+from enum import Enum
+from typing import Union, TYPE_CHECKING
+from command_index import get_compiled_source
 
-def git_commit_strategy(real_src_path : str) -> ObjectId:
-    src_tokens = real_src_path.split("/")
+# only for annotations, asyncio is not loaded by the commands that never run a compiler
+if TYPE_CHECKING:
+    from probe_scheduler import ProbeScheduler
 
-    src_sub_path = "/".join(src_tokens[:-1])
+def walk_git_log(root : str, log_options : list[str]) -> list[tuple[str, list[str]]]:
 
-    src_name = src_tokens[-1]
-    
-    proc = subprocess.Popen(f"cd {src_sub_path} && git log -n 1 --pretty=format:%H {src_name}", shell=True, stdout=subprocess.PIPE)
+    '''
+    :return: Every commit printed by git log with its changed files, newest first
+    '''
+
+    proc = subprocess.Popen(
+        ["git", "-C", root, "-c", "core.quotePath=false", "log", *log_options, "--name-only", "--pretty=format:%x00%H"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL
+    )
+
+    log_raw, _ = proc.communicate()
+
+    commits = []
+
+    for line in log_raw.decode(errors="replace").splitlines():
+        if line.startswith("\x00"):
+            commits.append((line[1:], []))
+        elif line != "" and commits != []:
+            commits[-1][1].append(line)
+
+    return commits
+
+
+class GitVersionIndex:
+
+    '''
+    Latest commit of every tracked file, built once per repository (the Unikraft tree and every lib submodule) with two git log walks.
+    Lookups are then served from memory instead of spawning git for every source, and agree with git log -n 1 -- <file>.
+    '''
+
+    # repository root -> path relative to the root -> latest commit touching it
+    repositories : dict[str, dict[str, str]] = None
+
+    # repository root -> paths that differ between a merge and one of its parents, not resolved by git log -n 1 yet
+    merge_paths : dict[str, set[str]] = None
+
+    # directory -> root of the repository it belongs to, None if it is not in a repository
+    roots : dict[str, Union[str, None]] = None
+
+    lock : threading.Lock = None
+
+    def __init__(self) -> None:
+        self.repositories = {}
+        self.merge_paths = {}
+        self.roots = {}
+        self.lock = threading.Lock()
+
+    def get_repository_root(self, dir_path : str) -> Union[str, None]:
+
+        visited = []
+
+        current = dir_path
+        while current not in self.roots:
+
+            visited.append(current)
+
+            # .git is a directory for a repository and a file for a submodule
+            if os.path.exists(os.path.join(current, ".git")):
+                root = current
+                break
+
+            parent = os.path.dirname(current)
+            if parent == current:
+                root = None
+                break
+
+            current = parent
+        else:
+            root = self.roots[current]
+
+        for visited_dir in visited:
+            self.roots[visited_dir] = root
+
+        return root
+
+    def index_repository(self, root : str) -> tuple[dict[str, str], set[str]]:
+
+        '''
+        git log -- <file> only follows, at a merge, a parent the file is the same in, and shows the merge itself if there is none.
+        For a file that is the same in every merge and all of their parents, that is the first parent chain, where merges change nothing.
+        Only the files some merge changes relative to one of its parents need the per file lookup.
+        '''
+
+        logger = logging.getLogger(__name__)
+
+        latest_commits = {}
+
+        # commits come newest first, so the first commit listing a file is its latest one
+        for commit_id, file_names in walk_git_log(root, ["--first-parent"]):
+            for file_name in file_names:
+                latest_commits.setdefault(file_name, commit_id)
+
+        merge_paths = set()
+
+        # -m lists the files of a merge against each parent it differs from
+        for _, file_names in walk_git_log(root, ["--merges", "-m"]):
+            merge_paths.update(file_names)
+
+        logger.info(f"Indexed {len(latest_commits)} files of git repository {root}, {len(merge_paths)} of them are looked up on their own since merges changed them")
+
+        return latest_commits, merge_paths
+
+    def get_latest_commit(self, real_src_path : str) -> str:
+
+        real_path = os.path.realpath(real_src_path)
+
+        with self.lock:
+            root = self.get_repository_root(os.path.dirname(real_path))
+
+            if root == None:
+                return ""
 
-    latest_commit_id_raw, _ = proc.communicate()
+            if root not in self.repositories:
+                self.repositories[root], self.merge_paths[root] = self.index_repository(root)
 
-    latest_commit_id = latest_commit_id_raw.decode()
+            relative_path = os.path.relpath(real_path, root)
 
-    return latest_commit_id
+            # files that are not tracked have no commit, just like git log would print nothing for them
+            if relative_path not in self.merge_paths[root]:
+                return self.repositories[root].get(relative_path, "")
 
+        latest_commit = subprocess.run(
+            ["git", "--literal-pathspecs", "-C", root, "log", "-n", "1", "--pretty=format:%H", "--", relative_path],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL
+        ).stdout.decode().strip()
 
-def remove_comments(cpy_src : str):
+        with self.lock:
+            self.repositories[root][relative_path] = latest_commit
+            self.merge_paths[root].discard(relative_path)
 
-    # C comment remover, courtesy to https://gist.github.com/ChunMinChang/88bfa5842396c1fbbc5b
+        return latest_commit
+
+
+git_version_index = GitVersionIndex()
+
+
+def git_commit_strategy(real_src_path : str) -> str:
+
+    return git_version_index.get_latest_commit(real_src_path)
+
+
+# C comment remover, courtesy to https://gist.github.com/ChunMinChang/88bfa5842396c1fbbc5b
+# string and character literals are matched too, so that comment markers inside them are left alone
+COMMENT_REGEX = re.compile(
+    r'//.*?$|/\*.*?\*/|\'(?:\\.|[^\\\'])*\'|"(?:\\.|[^\\"])*"',
+    re.DOTALL | re.MULTILINE
+)
+
+
+def remove_comments(text : str) -> str:
+
+    '''
+    Every comment is replaced by the new lines it spans, so that line numbers stay the same.
+    '''
 
     def replacer(match):
         s = match.group(0)
@@ -35,18 +181,9 @@ def remove_comments(cpy_src : str):
             return "\n" * s.count( "\n" )
         else:
             return s
-    pattern = re.compile(
-        r'//.*?$|/\*.*?\*/|\'(?:\\.|[^\\\'])*\'|"(?:\\.|[^\\"])*"',
-        re.DOTALL | re.MULTILINE
-    )
-
-    with open(cpy_src, "rt") as fdr:
-        text = fdr.read()
 
-    with open(cpy_src, "wt") as fdw:
-        fdw.write(re.sub(pattern, replacer, text))
+    return COMMENT_REGEX.sub(replacer, text)
 
-    return 
 
 def hash_strategy(real_src_path) -> str:
     sha1 = hashlib.sha1()
@@ -60,6 +197,60 @@ def hash_strategy(real_src_path) -> str:
 
     return sha1.hexdigest()
 
+class SourceBuffer:
+
+    '''
+    A source read from disk at most once, its hash, comment free text and lines are derived in memory when first needed.
+    Parsing, static evaluation and instrumentation share the same buffer, nothing is written back until the instrumented source.
+    '''
+
+    real_src_path : str = None
+
+    raw : bytes = None
+
+    text : str = None
+
+    lines : list[str] = None
+
+    # set when a parse process already instrumented the source, see parse_stage
+    instrumented_code : str = None
+
+    def __init__(self, real_src_path : str) -> None:
+        self.real_src_path = real_src_path
+
+    def get_raw(self) -> bytes:
+
+        if self.raw == None:
+            with open(self.real_src_path, "rb") as src_fd:
+                self.raw = src_fd.read()
+
+        return self.raw
+
+    def get_hash(self) -> str:
+
+        # same digest as hash_strategy, without reading the file again
+        return hashlib.sha1(self.get_raw()).hexdigest()
+
+    def get_text(self) -> str:
+
+        if self.text == None:
+            # undecodable bytes are kept as surrogates and written back unchanged, new lines are translated like a text mode read
+            text = self.get_raw().decode("utf-8", errors="surrogateescape")
+            if "\r" in text:
+                text = text.replace("\r\n", "\n").replace("\r", "\n")
+
+            self.text = remove_comments(text)
+
+        return self.text
+
+    def get_lines(self) -> list[str]:
+
+        if self.lines == None:
+            self.lines = io.StringIO(self.get_text()).readlines()
+
+        return self.lines
+
+
 class BackendMongoInterface:
     def to_mongo_dict(self) -> dict:
         pass
@@ -108,7 +299,9 @@ class SHA1Strategy(SourceVersionStrategy, BackendMongoInterface):
 class CompilationBlock(BackendMongoInterface):
 
     symbol_condition : str
-    triggered_compilations : list[ObjectId]
+
+    # bitset of the compilations that activated the block, see compilation_bits
+    triggered_bits : dict
     start_line : int
     end_line : int
     block_counter : int
@@ -122,10 +315,10 @@ class CompilationBlock(BackendMongoInterface):
         self.symbol_condition = mongo_dict["symbol_condition"]
         
 
-        if "triggered_compilations" in mongo_dict:
-            self.triggered_compilations = mongo_dict["triggered_compilations"]
+        if "triggered_bits" in mongo_dict:
+            self.triggered_bits = mongo_dict["triggered_bits"]
         else:
-            self.triggered_compilations = []
+            self.triggered_bits = {}
         
         self.start_line = mongo_dict["start_line"]
         self.end_line = mongo_dict["end_line"]
@@ -144,7 +337,7 @@ class CompilationBlock(BackendMongoInterface):
         ans = {}
 
         ans["symbol_condition"] = self.symbol_condition
-        ans["triggered_compilations"] = self.triggered_compilations
+        ans["triggered_bits"] = self.triggered_bits
         ans["start_line"] = self.start_line
         ans["end_line"] = self.end_line
         ans["_local_id"] = self.block_counter
@@ -159,7 +352,9 @@ class CompilationBlock(BackendMongoInterface):
 class SourceDocument(BackendMongoInterface):
 
     source_path : str
-    triggered_compilations : list[ObjectId]
+
+    # bitset of the compilations that compiled the source, see compilation_bits
+    triggered_bits : dict
     universal_lines : int
     source_version : SourceVersionStrategy
     lib : str
@@ -175,10 +370,10 @@ class SourceDocument(BackendMongoInterface):
         
         self.source_path = mongo_dict["source_path"]
 
-        if "triggered_compilations" in mongo_dict:
-            self.triggered_compilations = mongo_dict["triggered_compilations"]
+        if "triggered_bits" in mongo_dict:
+            self.triggered_bits = mongo_dict["triggered_bits"]
         else:
-            self.triggered_compilations = []
+            self.triggered_bits = {}
         
         if "git_commit_id" in mongo_dict:
             self.source_version = GitCommitStrategy()
@@ -205,7 +400,7 @@ class SourceDocument(BackendMongoInterface):
         ans = {}
 
         ans["source_path"] = self.source_path
-        ans["triggered_compilations"] = self.triggered_compilations
+        ans["triggered_bits"] = self.triggered_bits
         
         ans.update(self.source_version.to_mongo_dict())
 
@@ -230,22 +425,28 @@ def get_source_version_info(real_src_path) -> Union[SourceVersionStrategy, dict]
     return {SHA1Strategy.version_key : hash_strategy(real_src_path)}
 
 
-def trigger_compilation_blocks(activation_cmd : str) -> list[int]:
+def trigger_compilation_blocks(activation_cmd : str, probe_scheduler : "ProbeScheduler") -> list[int]:
+
+    '''
+    :raise ProbeError: If the compiler could not be run or did not finish in time
+    '''
 
     logger = logging.getLogger(__name__)
 
-    proc = subprocess.Popen(activation_cmd, shell=True, stderr = subprocess.PIPE)
+    warnings = probe_scheduler.run(activation_cmd).stderr.decode()
 
-    _, warnings_raw = proc.communicate()
-    
-    warnings = warnings_raw.decode()
+    # workers may compile in parallel, so the raw compiler output goes to the (thread safe) log instead of a shared dump file
+    logger.debug(f"Compiler output:\n{warnings}")
 
-    f = open("dorel","a")
-    f.write(warnings)
-    f.close()
+    probed_src_path = os.path.realpath(get_compiled_source(activation_cmd))
 
-    # return the numbers of compilation blocks found in warning directives
-    activated_blocks = [int(block_match) for block_match in re.findall("warning: #warning COMPILATION_COVERAGE_([0-9]+)", warnings)]
+    # return the numbers of compilation blocks found in warning directives of the probed source
+    # warnings of any other instrumented file it includes belong to the blocks of that file
+    activated_blocks = [
+        int(block_counter)
+        for warning_src_path, block_counter in re.findall(r"^(.+?):[0-9]+(?::[0-9]+)?: warning: #warning COMPILATION_COVERAGE_([0-9]+)", warnings, re.MULTILINE)
+        if os.path.realpath(warning_src_path) == probed_src_path
+    ]
 
     logger.debug(f"Compilation blocks triggered are {activated_blocks}")
 
@@ -315,64 +516,269 @@ def find_real_source_file(src_path : str, app_build_dir : str, lib_name : str) -
     return real_src_path
 
 
-def instrument_source(parsed_compilation_bocks : list[CompilationBlock], copy_src_path):
+def get_directive_end_index(lines : list[str], directive_idx : int) -> int:
+
+    # a directive may continue on the next lines with a backslash, return the index of its last line
+    end_idx = directive_idx
+    while end_idx < len(lines) - 1 and lines[end_idx].rstrip().endswith("\\"):
+        end_idx += 1
+
+    return end_idx
 
-    copy_src_fd = open(copy_src_path, 'r')
+
+def get_instrumented_code(parsed_compilation_bocks : list[CompilationBlock], src_lines : list[str]) -> str:
+
+    '''
+    Builds the instrumented source from the in-memory lines of the source.
+
+    :param src_lines: Comment free lines of the source, see SourceBuffer
+    '''
 
     instrumented_code = []
 
-    lines = copy_src_fd.readlines()
+    # start_line is the 1-based line of the #if/#elif/#else directive, the warning goes right after the (possibly multiline) directive
+    warning_after_idx = {}
+    for block in parsed_compilation_bocks:
+        warning_after_idx.setdefault(get_directive_end_index(src_lines, block.start_line - 1), block)
 
-    for i in range(len(lines)):
-        instrumented_code.append(lines[i])
-        
-        current_block = [block for block in parsed_compilation_bocks if block.start_line == i]
+    # the lines between two warnings are copied as whole slices, so the Python work grows with the blocks, not with the lines
+    copied_lines = 0
 
-        if current_block != []:
-            instrumented_code.append(f"#warning COMPILATION_COVERAGE_{current_block[0].block_counter}\n")
-    
-    copy_src_fd.close()
+    for warning_idx in sorted(warning_after_idx):
 
-    instr_copy_src_fd = open(copy_src_path, "r+")
+        if warning_idx >= len(src_lines):
+            break
 
-    instr_copy_src_fd.writelines(instrumented_code)
+        instrumented_code.extend(src_lines[copied_lines : warning_idx + 1])
+        copied_lines = warning_idx + 1
 
-    instr_copy_src_fd.close()
+        # the last line of a file might not end with a new line
+        if not instrumented_code[-1].endswith("\n"):
+            instrumented_code[-1] += "\n"
+        instrumented_code.append(f"#warning COMPILATION_COVERAGE_{warning_after_idx[warning_idx].block_counter}\n")
 
+    instrumented_code.extend(src_lines[copied_lines : ])
 
+    return "".join(instrumented_code)
 
-def get_source_compilation_command(app_build_dir, lib_name, real_src_path) -> str | None:
 
-    # the source is a c file, we need .o.cmd extension, but there might be files that do not respect the naming convention
-    # iterate through .o.cmd files
+def write_instrumented_source(instrumented_code : str, instrumented_src_path : str):
 
-    src_file_name = real_src_path.split("/")[-1]
+    '''
+    :param instrumented_src_path: Where gcc will find the instrumented source
+    '''
 
-    logger = logging.getLogger(__name__)
+    with open(instrumented_src_path, "w", encoding="utf-8", errors="surrogateescape") as instr_src_fd:
+        instr_src_fd.write(instrumented_code)
 
-    for compile_command_file in os.listdir(f"{app_build_dir}/{lib_name}"):
 
-        if src_file_name[:-2] in compile_command_file and ".o.cmd" in compile_command_file:
-            
-            logger.debug(f"Searching compilation command for {src_file_name} in {compile_command_file}")
+def instrument_source(parsed_compilation_bocks : list[CompilationBlock], src_lines : list[str], instrumented_src_path : str):
 
-            cmd_file_fd = open(f"{app_build_dir}/{lib_name}/{compile_command_file}", "r")
+    # written in one go, nothing but the instrumented source touches the disk
+    write_instrumented_source(get_instrumented_code(parsed_compilation_bocks, src_lines), instrumented_src_path)
 
-            # ignore the "" from the command
-            make_command = cmd_file_fd.readline()[2:]
 
-            make_tokens = make_command.split()
+# gcc flags that make the compiler write a dependency file next to the build objects, followed by the number of arguments they take
+DEPENDENCY_FLAGS = {"-MD" : 0, "-MMD" : 0, "-MP" : 0, "-MF" : 1, "-MT" : 1, "-MQ" : 1}
 
-            try:
-                gcc_source_flag_idx = make_tokens.index("-c")
-                if real_src_path == make_tokens[gcc_source_flag_idx + 1]:
-                    cmd_file_fd.close()
-                    return make_command
-                else:
-                    logger.debug(f"-c flag found but source is not correct: {real_src_path} VS {make_tokens[gcc_source_flag_idx + 1]}")
-                    cmd_file_fd.close()
-            except:
-                logger.debug("-c flag not found. Continue...")
-                cmd_file_fd.close()
-        
-    return None
\ No newline at end of file
+
+def strip_dependency_flags(compile_tokens : list[str]) -> list[str]:
+
+    stripped_tokens = []
+
+    i = 0
+    while i < len(compile_tokens):
+
+        token = compile_tokens[i]
+
+        if token in DEPENDENCY_FLAGS:
+            i += 1 + DEPENDENCY_FLAGS[token]
+            continue
+
+        # -Wp,-MD,<file> or -Wp,-MMD,<file> as used by the Unikraft build system
+        if token.startswith("-Wp,-MD,") or token.startswith("-Wp,-MMD,"):
+            i += 1
+            continue
+
+        stripped_tokens.append(token)
+        i += 1
+
+    return stripped_tokens
+
+
+def strip_output_flag(compile_tokens : list[str]) -> list[str]:
+
+    stripped_tokens = []
+
+    i = 0
+    while i < len(compile_tokens):
+
+        if compile_tokens[i] == "-o" and i + 1 < len(compile_tokens):
+            i += 2
+            continue
+
+        stripped_tokens.append(compile_tokens[i])
+        i += 1
+
+    return stripped_tokens
+
+
+class ProbeMode(Enum):
+    # run the whole compilation command from the .o.cmd file, object file included
+    COMPILE = "compile"
+    # stop after preprocessing, #warning directives are reported by the preprocessor
+    PREPROCESS = "preprocess"
+    # parse and type check, but skip code generation and optimisation
+    SYNTAX = "syntax"
+
+
+def get_probe_command(compile_command : str, probe_mode : ProbeMode) -> str:
+
+    '''
+    Changes a compilation command so that gcc stops as early as possible while still reporting the COMPILATION_COVERAGE_<n> warnings.
+
+    :param compile_command: Compilation command taken from the .o.cmd file (relocated or not)
+    :param probe_mode: How far gcc should go
+    '''
+
+    if probe_mode == ProbeMode.COMPILE:
+        return compile_command
+
+    # nothing is written anymore, the output is dropped
+    probe_tokens = strip_output_flag(strip_dependency_flags(shlex.split(compile_command)))
+
+    if probe_mode == ProbeMode.PREPROCESS:
+        probe_tokens += ["-E", "-o", "/dev/null"]
+    else:
+        probe_tokens += ["-fsyntax-only"]
+
+    return shlex.join(probe_tokens)
+
+
+class CommandRelocationError(Exception):
+
+    '''
+    A compilation command does not compile the source it was found for, so it cannot be pointed to the instrumented copy.
+    '''
+
+    pass
+
+
+def relocate_compilation_command(compile_command : str, real_src_path : str, instrumented_src_path : str) -> str:
+
+    '''
+    Rewrites a compilation command so that it compiles an instrumented copy instead of the real source.
+    The original directory stays first on the quote include path, the object and dependency files are not written in the build directory.
+
+    :param compile_command: Compilation command taken from the .o.cmd file of the real source
+    :param real_src_path: Path of the source inside the Unikraft tree, as found after the -c flag
+    :param instrumented_src_path: Path of the instrumented copy
+    :raise CommandRelocationError: If the command has no -c real_src_path, it would compile the real source instead of the copy
+    '''
+
+    # quoted arguments, e.g. -DUK_CODENAME='"Name with spaces"', are kept whole
+    compile_tokens = strip_dependency_flags(shlex.split(compile_command))
+
+    relocated_tokens = []
+    relocated = False
+
+    i = 0
+    while i < len(compile_tokens):
+
+        if compile_tokens[i] == "-c" and i + 1 < len(compile_tokens) and compile_tokens[i + 1] == real_src_path:
+            relocated_tokens += ["-iquote", os.path.dirname(real_src_path), "-c", instrumented_src_path]
+            relocated = True
+            i += 2
+            continue
+
+        # the object file of the instrumented copy is useless, keep it out of the build directory
+        if compile_tokens[i] == "-o" and i + 1 < len(compile_tokens):
+            relocated_tokens += ["-o", os.path.splitext(instrumented_src_path)[0] + ".o"]
+            i += 2
+            continue
+
+        relocated_tokens.append(compile_tokens[i])
+        i += 1
+
+    if not relocated:
+        raise CommandRelocationError(f"-c {real_src_path} not found in {compile_command.strip()}")
+
+    return shlex.join(relocated_tokens)
+
+
+def normalize_compilation_command(compile_command : str, app_build_dir : str) -> str:
+
+    '''
+    Removes everything from a compilation command that does not change which blocks get activated:
+    the object and dependency file paths, extra whitespace and the build directory of the app (generated headers are fingerprinted separately).
+    '''
+
+    normalized_tokens = strip_output_flag(strip_dependency_flags(compile_command.split()))
+
+    build_dir = os.path.abspath(app_build_dir)
+
+    return " ".join(normalized_tokens).replace(build_dir, "$BUILD")
+
+
+def get_source_repositories() -> list[str]:
+
+    '''
+    :return: The Unikraft tree and every lib under UK_LIBS, the git repositories the sources of the apps come from
+    '''
+
+    repositories = []
+    if "UK_ROOT" in os.environ:
+        repositories.append(os.environ["UK_ROOT"])
+    if "UK_LIBS" in os.environ and os.path.isdir(os.environ["UK_LIBS"]):
+        repositories += [os.path.join(os.environ["UK_LIBS"], lib) for lib in sorted(os.listdir(os.environ["UK_LIBS"]))]
+
+    return repositories
+
+
+def hash_generated_includes(fingerprint, app_build_dir : str):
+
+    '''
+    Adds the generated headers of the build directory, the configuration among them, to a hashlib object.
+    '''
+
+    generated_includes = f"{app_build_dir}/include"
+
+    for dir_path, dir_names, file_names in os.walk(generated_includes):
+        dir_names.sort()
+        for file_name in sorted(file_names):
+            file_path = os.path.join(dir_path, file_name)
+            fingerprint.update(os.path.relpath(file_path, generated_includes).encode())
+            fingerprint.update(hash_strategy(file_path).encode())
+
+
+def get_build_fingerprint(app_build_dir : str) -> str:
+
+    '''
+    Fingerprint of the generated headers of the build directory, unlike get_environment_fingerprint it does not change with the commits of the trees.
+    '''
+
+    fingerprint = hashlib.sha1()
+
+    hash_generated_includes(fingerprint, app_build_dir)
+
+    return fingerprint.hexdigest()
+
+
+def get_environment_fingerprint(app_build_dir : str) -> str:
+
+    '''
+    Fingerprint of what the activation of a source depends on besides the source and its compilation command:
+    the generated headers of the build directory (the configuration among them) and the commits of the Unikraft tree and of the libs.
+    Uncommitted changes to headers of the Unikraft tree are not part of the fingerprint.
+    '''
+
+    fingerprint = hashlib.sha1()
+
+    hash_generated_includes(fingerprint, app_build_dir)
+
+    for repository in get_source_repositories():
+        proc = subprocess.Popen(["git", "-C", repository, "rev-parse", "HEAD"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        head_raw, _ = proc.communicate()
+        fingerprint.update(f"{repository}:{head_raw.decode().strip()}".encode())
+
+    return fingerprint.hexdigest()
@@ -0,0 +1,123 @@
+from __future__ import annotations
+import bisect
+import logging
+import os
+import re
+import shlex
+from helpers import CompilationBlock, strip_dependency_flags, strip_output_flag
+from probe_scheduler import ProbeScheduler, ProbeError
+
+# # <line> "<file>" <flags>, as printed by the gcc preprocessor
+LINEMARKER_REGEX = re.compile(r'^#\s*(?:line\s+)?([0-9]+)\s+"((?:\\.|[^"\\])*)"(.*)$')
+
+# flag of a linemarker that enters an included file
+ENTER_FILE_FLAG = "1"
+
+
+def get_preprocess_command(compile_command : str) -> str:
+
+    '''
+    Changes a compilation command so that the unmodified source is only preprocessed, to stdout.
+    -dD keeps #define/#undef and -dI keeps #include directives in the output, so blocks that only define macros or include headers still leave a trace.
+
+    :param compile_command: Compilation command taken from the .o.cmd file
+    '''
+
+    preprocess_tokens = strip_output_flag(strip_dependency_flags(shlex.split(compile_command)))
+
+    return shlex.join(preprocess_tokens + ["-E", "-dD", "-dI"])
+
+
+def find_surviving_lines(preprocessed_code : str) -> dict[str, set[int]]:
+
+    '''
+    Follows the linemarkers of the preprocessor output and returns, for every file that took part in the preprocessing,
+    the original line numbers (1-based) that still produced some code.
+
+    :param preprocessed_code: Output of gcc -E
+    '''
+
+    surviving_lines : dict[str, set[int]] = {}
+
+    current_file = None
+    current_line = 0
+
+    for output_line in preprocessed_code.splitlines():
+
+        linemarker = LINEMARKER_REGEX.match(output_line)
+
+        if linemarker != None:
+
+            # entering a header, the #include line of the current file survived
+            if ENTER_FILE_FLAG in linemarker.group(3).split() and current_file != None:
+                surviving_lines.setdefault(current_file, set()).add(current_line)
+
+            current_line = int(linemarker.group(1))
+            current_file = linemarker.group(2)
+            continue
+
+        if current_file != None and output_line.strip() != "":
+            surviving_lines.setdefault(current_file, set()).add(current_line)
+
+        current_line += 1
+
+    return surviving_lines
+
+
+def find_activated_blocks(total_blocks : list[CompilationBlock], source_surviving_lines : set[int]) -> list[int]:
+
+    '''
+    A block is activated if at least one line between its directive and the next #elif/#else/#endif survived preprocessing.
+    Lines of nested blocks are inside the range of their parents, so an activated child always activates its parents.
+    Blocks without any code, defines or includes cannot be detected and are reported as not activated.
+
+    :param total_blocks: All compilation blocks of the source
+    :param source_surviving_lines: Surviving lines of the source, as returned by find_surviving_lines
+    '''
+
+    sorted_lines = sorted(source_surviving_lines)
+
+    activated_blocks = []
+
+    for block in total_blocks:
+
+        # first surviving line after the directive of the block
+        first_after_directive = bisect.bisect_right(sorted_lines, block.start_line)
+
+        if first_after_directive < len(sorted_lines) and sorted_lines[first_after_directive] < block.end_line:
+            activated_blocks.append(block.block_counter)
+
+    return activated_blocks
+
+
+def trigger_compilation_blocks_linemarkers(total_blocks : list[CompilationBlock], compile_command : str, real_src_path : str, probe_scheduler : ProbeScheduler) -> list[int]:
+
+    '''
+    :raise ProbeError: If the preprocessor could not be run, did not finish in time or failed
+    '''
+
+    logger = logging.getLogger(__name__)
+
+    result = probe_scheduler.run(get_preprocess_command(compile_command), capture_stdout=True)
+
+    # the output stops at the error, the blocks after it would look never activated
+    if result.returncode != 0:
+        raise ProbeError(f"Preprocessing {real_src_path} failed with code {result.returncode}\n{result.stderr.decode(errors='replace').strip()}")
+
+    surviving_lines = find_surviving_lines(result.stdout.decode(errors="replace"))
+
+    # linemarkers use the path exactly as given to gcc, compare real paths to be safe
+    real_src_realpath = os.path.realpath(real_src_path)
+
+    source_surviving_lines = set()
+    for marked_file, lines in surviving_lines.items():
+        if os.path.realpath(marked_file) == real_src_realpath:
+            source_surviving_lines |= lines
+
+    logger.debug(f"Preprocessing touched {len(surviving_lines)} files, {len(source_surviving_lines)} lines of {real_src_path} survived")
+
+    activated_blocks = find_activated_blocks(total_blocks, source_surviving_lines)
+
+    logger.debug(f"Compilation blocks triggered are {activated_blocks}")
+
+    return activated_blocks
@@ -1,37 +1,25 @@
 import logging
-import pymongo
 from colorama import Fore
 import os
+from storage import get_storage
 
 logger = logging.getLogger(__name__)
 
-def get_app_coverage(compilation_id) -> tuple[int, ...]:
+def get_apps_coverage() -> list[tuple[str, int, int]]:
 
-    from coverage import DATABASE, db, SOURCES_COLLECTION, COMPILATION_COLLECTION, COVERITY_DEFECTS_COLLECTION
+    '''
+    Reads compiled and total lines of every registered compilation from the precomputed summaries, in a single query.
+    Compilations without a summary (no source triggered, or a database that predates the summaries) are reported with 0 lines.
 
-    total_lines = 0
-    compiled_lines = 0
+    :return: (tag, compiled lines, total lines) in registration order
+    '''
 
-    for source_document in db[DATABASE][SOURCES_COLLECTION].find(filter={"triggered_compilations" : {"$elemMatch" : {"$eq" : compilation_id}}}):
+    return get_storage().get_apps_coverage()
 
-        total_lines += source_document["universal_lines"]
-        compiled_lines += source_document["universal_lines"]
 
-        for compile_block in source_document["compile_blocks"]:
+def print_app_coverage(compilation_tag, compiled_lines, total_lines, saved_outfile):
 
-            total_lines += compile_block["lines"]
-
-            if compilation_id in compile_block["triggered_compilations"]:
-                compiled_lines += compile_block["lines"]
-
-    return compiled_lines, total_lines
-
-
-def print_app_coverage(compilation_id, compilation_tag, saved_outfile):
-
-    logger.debug(f"Found app with tag {compilation_tag} and id {compilation_id}")
-
-    compiled_lines, total_lines = get_app_coverage(compilation_id)
+    logger.debug(f"Found app with tag {compilation_tag}")
 
     logger.info(f"Total lines {total_lines} with compiled lines {compiled_lines}")
 
@@ -42,7 +30,7 @@ def print_app_coverage(compilation_id, compilation_tag, saved_outfile):
 
         out.write(f"\tCompiled lines: {compiled_lines}\n")
 
-        ratio = (compiled_lines / total_lines) * 100
+        ratio = (compiled_lines / total_lines) * 100 if total_lines != 0 else 0
 
         if ratio == 100:
             out.write(Fore.GREEN + f"\tRatio:{ratio}\n" + Fore.RESET)
@@ -53,10 +41,8 @@ def print_app_coverage(compilation_id, compilation_tag, saved_outfile):
 
 def list_app_subcommand(saved_outfile : str):
 
-    from coverage import DATABASE, db, SOURCES_COLLECTION, COMPILATION_COLLECTION, COVERITY_DEFECTS_COLLECTION
-
-    for compilation_document in db[DATABASE][COMPILATION_COLLECTION].find({}):
-        print_app_coverage(compilation_document["_id"], compilation_document["tag"], saved_outfile)
+    for compilation_tag, compiled_lines, total_lines in get_apps_coverage():
+        print_app_coverage(compilation_tag, compiled_lines, total_lines, saved_outfile)
     
     return
     
@@ -0,0 +1,589 @@
+import hashlib
+import logging
+import pymongo
+from typing import Union
+from bson.int64 import Int64
+from bson.objectid import ObjectId
+from pymongo import UpdateOne, DeleteOne
+from pymongo.errors import DuplicateKeyError
+from helpers import SourceDocument, GitCommitStrategy, SHA1Strategy
+from bulk_writer import BulkWriter
+from storage import CoverageStorage, SourceWriter
+from compilation_bits import COMPILATION_BIT_FIELD, TRIGGERED_BITS_FIELD, WORD_MASK, get_word, set_bit, to_signed_word, any_bit_filter, has_bit_filter
+from block_storage import SPLIT_BLOCKS_FIELD, SOURCE_ID_FIELD, is_split, attach_split_blocks, get_new_source_operations, get_replaced_source_operations, get_split_activation_operation, get_split_unbind_operation
+from summaries import TOTAL_SCOPE, SUMMARY_KEY_FIELDS
+
+DATABASE = "Unikraft-Static-Analysis"
+SOURCES_COLLECTION = "Sources"
+COMPILATION_COLLECTION = "Compilations"
+COVERITY_DEFECTS_COLLECTION = "Coverity-Defects"
+SUMMARIES_COLLECTION = "Summaries"
+BLOCKS_COLLECTION = "Compile-Blocks"
+COMPILE_COMMANDS_COLLECTION = "Compile-Commands"
+
+# sources the compilation could not analyze, with the reason, kept in its document
+FAILED_SOURCES_FIELD = "failed_sources"
+
+# sources done by the compilation, kept in its document, checkpoint key -> source_path, lib and fingerprint
+CHECKPOINTS_FIELD = "checkpoints"
+
+logger = logging.getLogger(__name__)
+
+
+def get_checkpoint_key(source_path : str, lib_name : str) -> str:
+
+    # source paths have dots, which cannot be part of a field name
+    return hashlib.sha1(f"{source_path}\0{lib_name}".encode()).hexdigest()
+
+
+def to_bson_words(triggered_bits : dict) -> dict:
+
+    # pymongo would store small words as 32 bit ints, words are always longs so that they have the same type in every document
+    return {word_key : Int64(word) for word_key, word in triggered_bits.items()}
+
+
+def encode_bitsets(source_document : Union[SourceDocument, dict]):
+
+    '''
+    Stores the bitsets of a source and of its blocks as BSON longs, in place.
+    '''
+
+    source_document[TRIGGERED_BITS_FIELD] = to_bson_words(source_document[TRIGGERED_BITS_FIELD])
+
+    for compile_block in source_document["compile_blocks"]:
+        compile_block[TRIGGERED_BITS_FIELD] = to_bson_words(compile_block[TRIGGERED_BITS_FIELD])
+
+
+def get_has_word_expression(bitset_expression : str) -> dict:
+
+    '''
+    Aggregation expression that is true when a bitset has a compilation, 0 words left by an unbind do not count.
+    '''
+
+    return {
+        "$gt" : [
+            {"$size" : {"$filter" : {"input" : {"$objectToArray" : {"$ifNull" : [bitset_expression, {}]}}, "as" : "word", "cond" : {"$ne" : ["$$word.v", 0]}}}},
+            0
+        ]
+    }
+
+
+class MongoSourceWriter(SourceWriter):
+
+    '''
+    One operation per source write, sent through a BulkWriter as unordered bulk batches.
+    '''
+
+    writer : BulkWriter = None
+    split_threshold : int = None
+
+    def __init__(self, database, batch_size : int, split_threshold : Union[int, None]) -> None:
+        # checkpoints live in the compilation documents, a checkpoint must never be stored before the writes of its source
+        self.writer = BulkWriter(database, batch_size, last_collections=[COMPILATION_COLLECTION])
+        self.split_threshold = split_threshold
+
+    def queue_source_operations(self, source_document : Union[SourceDocument, dict], operation, block_operations : list):
+
+        self.writer.queue(SOURCES_COLLECTION, operation, source_document["source_path"])
+
+        # blocks of a source are only touched by the write of that source, which is already ordered by the source key
+        for block_operation in block_operations:
+            self.writer.queue(BLOCKS_COLLECTION, block_operation)
+
+    def queue_new_source(self, source_document : Union[SourceDocument, dict]):
+
+        # blocks stored in their own collection point to the source by its id, so it is known before the source is written
+        source_document["_id"] = ObjectId()
+
+        encode_bitsets(source_document)
+
+        operation, block_operations = get_new_source_operations(source_document, self.split_threshold)
+
+        self.queue_source_operations(source_document, operation, block_operations)
+
+    def queue_replaced_source(self, source_document : Union[SourceDocument, dict], previous_document : Union[SourceDocument, dict]):
+
+        # the id is kept across versions, the new version also starts with the layout of the one it replaces
+        source_document["_id"] = previous_document["_id"]
+        if is_split(previous_document):
+            source_document[SPLIT_BLOCKS_FIELD] = True
+
+        encode_bitsets(source_document)
+
+        update, block_operations = get_replaced_source_operations(source_document, self.split_threshold)
+
+        self.queue_source_operations(source_document, UpdateOne(filter= {"source_path" : source_document["source_path"]}, update= update), block_operations)
+
+    def queue_activation(self, source_document : Union[SourceDocument, dict], activated_block_counters : list[int], compilation_tag : str, compilation_bit : int, compiled_lines : int, summary_deltas : dict[tuple, dict[str, int]]):
+
+        # $bit or keeps the update idempotent and safe next to other runs registering the same source
+        operation = build_activation_update(source_document, activated_block_counters, compilation_tag, compilation_bit, compiled_lines)
+        block_operations = []
+
+        if is_split(source_document) and activated_block_counters != []:
+            word_key, word = get_word(compilation_bit)
+            block_operations.append(get_split_activation_operation(source_document, activated_block_counters, word_key, Int64(word)))
+
+        self.queue_source_operations(source_document, operation, block_operations)
+
+        # the summaries only change if the version filter of the activation matched
+        self.writer.queue_guarded_increments(
+            SOURCES_COLLECTION,
+            get_version_filter(source_document),
+            [
+                (SUMMARIES_COLLECTION, {"tag" : tag, "scope" : scope, "key" : key}, increments)
+                for (tag, scope, key), increments in summary_deltas.items()
+            ]
+        )
+
+    def queue_unbind(self, source_document : Union[SourceDocument, dict], compilation_tag : str, compilation_bit : int):
+
+        word_key, word = get_word(compilation_bit)
+        mask = Int64(to_signed_word(~word & WORD_MASK))
+
+        update = {
+            "$bit" : {f"{TRIGGERED_BITS_FIELD}.{word_key}" : {"and" : mask}},
+            "$unset" : {f"compiled_stats.{compilation_tag}" : ""}
+        }
+        array_filters = None
+        block_operations = []
+
+        # only the blocks the compilation triggered are touched, $bit on a missing word would store a 0 word
+        if is_split(source_document):
+            block_operations.append(get_split_unbind_operation(source_document, compilation_bit, word_key, mask))
+        elif source_document["compile_blocks"] != []:
+            update["$bit"][f"compile_blocks.$[block].{TRIGGERED_BITS_FIELD}.{word_key}"] = {"and" : mask}
+            array_filters = [has_bit_filter(f"block.{TRIGGERED_BITS_FIELD}", compilation_bit)]
+
+        self.queue_source_operations(
+            source_document,
+            UpdateOne(filter= {"source_path" : source_document["source_path"]}, update= update, array_filters= array_filters),
+            block_operations
+        )
+
+    def queue_summary_increment(self, tag : str, scope : str, key : str, increments : dict[str, int]):
+        self.writer.queue_increment(SUMMARIES_COLLECTION, {"tag" : tag, "scope" : scope, "key" : key}, increments)
+
+    def queue_compile_command(self, compilation_tag : str, source_path : str, lib_name : str, compile_command : str):
+
+        self.writer.queue(
+            COMPILE_COMMANDS_COLLECTION,
+            UpdateOne(
+                filter= {"source_path" : source_path, "tag" : compilation_tag},
+                update= {"$set" : {"lib" : lib_name, "command" : compile_command}},
+                upsert= True
+            ),
+            (source_path, compilation_tag)
+        )
+
+    def queue_checkpoint(self, compilation_tag : str, source_path : str, lib_name : str, fingerprint : str):
+
+        # checkpoints of different sources never touch the same field, so their order does not matter
+        self.writer.queue(
+            COMPILATION_COLLECTION,
+            UpdateOne(
+                filter= {"tag" : compilation_tag},
+                update= {"$set" : {f"{CHECKPOINTS_FIELD}.{get_checkpoint_key(source_path, lib_name)}" : {"source_path" : source_path, "lib" : lib_name, "fingerprint" : fingerprint}}}
+            )
+        )
+
+    def queue_dropped_source(self, compilation_tag : str, source_path : str, lib_names : list[str]):
+
+        self.writer.queue(
+            COMPILATION_COLLECTION,
+            UpdateOne(
+                filter= {"tag" : compilation_tag},
+                update= {"$unset" : {f"{CHECKPOINTS_FIELD}.{get_checkpoint_key(source_path, lib_name)}" : "" for lib_name in lib_names}}
+            )
+        )
+
+        self.writer.queue(COMPILE_COMMANDS_COLLECTION, DeleteOne({"source_path" : source_path, "tag" : compilation_tag}), (source_path, compilation_tag))
+
+    def flush(self):
+        self.writer.flush()
+
+
+def get_version_filter(source_document : Union[SourceDocument, dict]) -> dict:
+
+    version_filter = {"source_path" : source_document["source_path"]}
+
+    for version_key in [GitCommitStrategy.version_key, SHA1Strategy.version_key]:
+        if version_key in source_document:
+            version_filter[version_key] = source_document[version_key]
+
+    return version_filter
+
+
+def build_activation_update(source_document : Union[SourceDocument, dict], activated_block_counters : list[int], compilation_tag : str, compilation_bit : int, compiled_lines : int) -> UpdateOne:
+
+    '''
+    Targeted update that adds a compilation to an already registered source without rewriting its blocks.
+    The filter also matches the version of the source, block ids of another version are meaningless, so if another run
+    replaced the source in the meantime nothing is written.
+    '''
+
+    version_filter = get_version_filter(source_document)
+
+    word_key, word = get_word(compilation_bit)
+    word = Int64(word)
+
+    update = {
+        "$bit" : {f"{TRIGGERED_BITS_FIELD}.{word_key}" : {"or" : word}},
+        "$set" : {f"compiled_stats.{compilation_tag}" : compiled_lines}
+    }
+
+    # an array filter must be used by the update, so it is only added when some block was activated
+    # split sources have no compile_blocks array, their blocks are updated in their own collection
+    if activated_block_counters == [] or is_split(source_document):
+        return UpdateOne(filter= version_filter, update= update)
+
+    update["$bit"][f"compile_blocks.$[block].{TRIGGERED_BITS_FIELD}.{word_key}"] = {"or" : word}
+
+    return UpdateOne(
+        filter= version_filter,
+        update= update,
+        array_filters= [{"block._local_id" : {"$in" : activated_block_counters}}]
+    )
+
+
+class MongoStorage(CoverageStorage):
+
+    client : pymongo.MongoClient = None
+    database = None
+
+    def __init__(self, uri : str) -> None:
+        self.client = pymongo.MongoClient(uri)
+        self.database = self.client[DATABASE]
+
+    def ensure_schema(self):
+
+        # prefetching and updating sources by path
+        self.database[SOURCES_COLLECTION].create_index("source_path")
+
+        self.database[COMPILATION_COLLECTION].create_index("tag")
+
+        # blocks of split sources, fetched and updated by source
+        self.database[BLOCKS_COLLECTION].create_index([(SOURCE_ID_FIELD, pymongo.ASCENDING), ("_local_id", pymongo.ASCENDING)], unique=True)
+
+        # compilations are interned to bits, concurrent registrations must not get the same bit
+        self.database[COMPILATION_COLLECTION].create_index(COMPILATION_BIT_FIELD, unique=True, sparse=True)
+
+        # one command per source and compilation, looked up by source for app refresh
+        self.database[COMPILE_COMMANDS_COLLECTION].create_index([("source_path", pymongo.ASCENDING), ("tag", pymongo.ASCENDING)], unique=True)
+
+        # one summary per compilation, scope and key, upserted with $inc
+        self.database[SUMMARIES_COLLECTION].create_index([(field, pymongo.ASCENDING) for field in SUMMARY_KEY_FIELDS], unique=True)
+
+    def find_compilation(self, compilation_tag : str) -> Union[dict, None]:
+        return self.database[COMPILATION_COLLECTION].find_one({"tag" : compilation_tag})
+
+    def find_last_bit(self) -> Union[int, None]:
+
+        last_compilation = self.database[COMPILATION_COLLECTION].find_one(
+            {COMPILATION_BIT_FIELD : {"$exists" : True}},
+            projection={COMPILATION_BIT_FIELD : 1},
+            sort=[(COMPILATION_BIT_FIELD, -1)]
+        )
+
+        return None if last_compilation == None else last_compilation[COMPILATION_BIT_FIELD]
+
+    def register_compilation(self, compilation_tag : str, app_workspace : str) -> tuple[ObjectId, int]:
+
+        # the unique index on the bit settles races between concurrent registrations, bits of deleted compilations are not reused
+        while True:
+
+            last_bit = self.find_last_bit()
+            compilation_bit = 0 if last_bit == None else last_bit + 1
+
+            try:
+                compilation_id = self.database[COMPILATION_COLLECTION].insert_one(
+                    {"tag" : compilation_tag, "app" : app_workspace, COMPILATION_BIT_FIELD : compilation_bit}
+                ).inserted_id
+            except DuplicateKeyError:
+                logger.debug(f"Bit {compilation_bit} was taken by a concurrent registration, retrying")
+                continue
+
+            return compilation_id, compilation_bit
+
+    def delete_compilation(self, compilation_tag : str):
+        self.database[COMPILATION_COLLECTION].find_one_and_delete({"tag" : compilation_tag})
+        self.database[COMPILE_COMMANDS_COLLECTION].delete_many({"tag" : compilation_tag})
+
+    def record_source_failure(self, compilation_tag : str, source_path : str, lib_name : str, reason : str):
+
+        self.database[COMPILATION_COLLECTION].update_one(
+            {"tag" : compilation_tag},
+            {"$push" : {FAILED_SOURCES_FIELD : {"source_path" : source_path, "lib" : lib_name, "reason" : reason}}}
+        )
+
+    def clear_source_failures(self, compilation_tag : str):
+        self.database[COMPILATION_COLLECTION].update_one({"tag" : compilation_tag}, {"$unset" : {FAILED_SOURCES_FIELD : ""}})
+
+    def get_checkpoints(self, compilation_tag : str) -> dict[tuple[str, str], str]:
+
+        compilation_document = self.database[COMPILATION_COLLECTION].find_one({"tag" : compilation_tag}, projection={CHECKPOINTS_FIELD : 1})
+
+        if compilation_document == None:
+            return {}
+
+        return {
+            (checkpoint["source_path"], checkpoint["lib"]) : checkpoint["fingerprint"]
+            for checkpoint in compilation_document.get(CHECKPOINTS_FIELD, {}).values()
+        }
+
+    def get_source_failures(self, compilation_tag : str) -> list[dict]:
+
+        compilation_document = self.database[COMPILATION_COLLECTION].find_one({"tag" : compilation_tag}, projection={FAILED_SOURCES_FIELD : 1})
+
+        if compilation_document == None:
+            return []
+
+        return compilation_document.get(FAILED_SOURCES_FIELD, [])
+
+    def count_compilations(self) -> int:
+        return self.database[COMPILATION_COLLECTION].count_documents({})
+
+    def get_compilation_bits(self, compilation_tags : list[str] = None) -> dict[str, int]:
+
+        compilation_filter = {COMPILATION_BIT_FIELD : {"$exists" : True}}
+        if compilation_tags != None:
+            compilation_filter["tag"] = {"$in" : compilation_tags}
+
+        return {
+            compilation_document["tag"] : compilation_document[COMPILATION_BIT_FIELD]
+            for compilation_document in self.database[COMPILATION_COLLECTION].find(compilation_filter, projection={"tag" : 1, COMPILATION_BIT_FIELD : 1})
+        }
+
+    def get_compile_commands(self, source_paths : list[str]) -> dict[str, dict[str, dict]]:
+
+        compile_commands = {}
+
+        for command_document in self.database[COMPILE_COMMANDS_COLLECTION].find({"source_path" : {"$in" : list(set(source_paths))}}):
+            compile_commands.setdefault(command_document["source_path"], {})[command_document["tag"]] = {
+                "lib" : command_document["lib"],
+                "command" : command_document["command"]
+            }
+
+        return compile_commands
+
+    def prefetch_sources(self, source_paths : list[str]) -> dict[str, Union[SourceDocument, dict]]:
+
+        source_documents = {}
+
+        for source_document in self.database[SOURCES_COLLECTION].find({"source_path" : {"$in" : list(set(source_paths))}}):
+            source_documents[source_document["source_path"]] = source_document
+
+        attach_split_blocks(self.database[BLOCKS_COLLECTION], list(source_documents.values()))
+
+        return source_documents
+
+    def find_sources_by_bits(self, compilation_bits : list[int]) -> list[Union[SourceDocument, dict]]:
+
+        source_documents = list(self.database[SOURCES_COLLECTION].find(
+            filter=any_bit_filter(TRIGGERED_BITS_FIELD, compilation_bits),
+            sort=[("source_path", pymongo.ASCENDING)]
+        ))
+
+        attach_split_blocks(self.database[BLOCKS_COLLECTION], source_documents)
+
+        return source_documents
+
+    def create_writer(self, batch_size : int, split_threshold : Union[int, None]) -> MongoSourceWriter:
+        return MongoSourceWriter(self.database, batch_size, split_threshold)
+
+    def get_apps_coverage(self) -> list[tuple[str, int, int]]:
+
+        # a single round trip whatever the number of compilations
+        pipeline = [
+            {"$sort" : {"_id" : pymongo.ASCENDING}},
+            {"$lookup" : {
+                "from" : SUMMARIES_COLLECTION,
+                "let" : {"tag" : "$tag"},
+                "pipeline" : [
+                    {"$match" : {"scope" : TOTAL_SCOPE, "$expr" : {"$eq" : ["$tag", "$$tag"]}}},
+                    {"$project" : {"_id" : 0, "compiled_lines" : 1, "total_lines" : 1}}
+                ],
+                "as" : "summary"
+            }}
+        ]
+
+        apps_coverage = []
+
+        for compilation_document in self.database[COMPILATION_COLLECTION].aggregate(pipeline):
+
+            if compilation_document["summary"] == []:
+                logger.warning(f"No summary for {compilation_document['tag']}, run `summaries rebuild` if the database was filled by an older version")
+                apps_coverage.append((compilation_document["tag"], 0, 0))
+                continue
+
+            summary = compilation_document["summary"][0]
+            apps_coverage.append((compilation_document["tag"], summary["compiled_lines"], summary["total_lines"]))
+
+        return apps_coverage
+
+    def get_summaries(self, compilation_tags : list[str], scope : str) -> list[dict]:
+
+        return list(self.database[SUMMARIES_COLLECTION].find(
+            filter={"tag" : {"$in" : compilation_tags}, "scope" : scope},
+            projection={"_id" : 0},
+            sort=[("tag", 1), ("key", 1)]
+        ))
+
+    def iterate_source_stats(self):
+
+        return self.database[SOURCES_COLLECTION].find(
+            filter={},
+            projection={"_id" : 0, "source_path" : 1, "lib" : 1, "total_lines" : 1, "compiled_stats" : 1}
+        )
+
+    def replace_summaries(self, summaries : list[dict], compilation_tags : list[str] = None):
+
+        self.database[SUMMARIES_COLLECTION].delete_many({} if compilation_tags == None else {"tag" : {"$in" : compilation_tags}})
+
+        if summaries != []:
+            self.database[SUMMARIES_COLLECTION].insert_many(summaries)
+
+    def get_global_status(self, details : bool) -> dict:
+
+        never_triggered_blocks = {
+            "$filter" : {
+                "input" : "$compile_blocks",
+                "as" : "block",
+                "cond" : {"$not" : [get_has_word_expression("$$block." + TRIGGERED_BITS_FIELD)]}
+            }
+        }
+
+        triggered_blocks = {
+            "$filter" : {
+                "input" : "$compile_blocks",
+                "as" : "block",
+                "cond" : get_has_word_expression("$$block." + TRIGGERED_BITS_FIELD)
+            }
+        }
+
+        source_projection = {
+            "_id" : 0,
+            "source_path" : 1,
+            "lib" : 1,
+            "total_lines" : 1,
+            "compiled_lines" : {
+                "$cond" : [
+                    get_has_word_expression("$" + TRIGGERED_BITS_FIELD),
+                    {"$reduce" : {"input" : triggered_blocks, "initialValue" : "$universal_lines", "in" : {"$add" : ["$$value", "$$this.lines"]}}},
+                    0
+                ]
+            },
+            "blocks" : {"$size" : "$compile_blocks"},
+            "never_triggered_blocks" : {"$size" : never_triggered_blocks}
+        }
+
+        facets = {
+            "libs" : [
+                {"$group" : {
+                    "_id" : "$lib",
+                    "compiled_lines" : {"$sum" : "$compiled_lines"},
+                    "total_lines" : {"$sum" : "$total_lines"},
+                    "sources" : {"$sum" : 1},
+                    "blocks" : {"$sum" : "$blocks"},
+                    "never_triggered_blocks" : {"$sum" : "$never_triggered_blocks"}
+                }},
+                {"$sort" : {"_id" : 1}}
+            ]
+        }
+
+        # the block list is only shipped when asked for
+        if details:
+            source_projection["never_triggered_block_list"] = {
+                "$map" : {
+                    "input" : never_triggered_blocks,
+                    "as" : "block",
+                    "in" : {"start_line" : "$$block.start_line", "symbol_condition" : "$$block.symbol_condition"}
+                }
+            }
+
+            facets["never_triggered_block_list"] = [
+                {"$match" : {"never_triggered_blocks" : {"$gt" : 0}}},
+                {"$project" : {"source_path" : 1, "never_triggered_block_list" : 1}},
+                {"$sort" : {"source_path" : 1}}
+            ]
+
+        pipeline = [
+            # split sources keep their blocks in their own collection, the join is served by the (source_id, _local_id) index
+            {"$lookup" : {"from" : BLOCKS_COLLECTION, "localField" : "_id", "foreignField" : SOURCE_ID_FIELD, "as" : "split_compile_blocks"}},
+            {"$addFields" : {"compile_blocks" : {"$concatArrays" : [{"$ifNull" : ["$compile_blocks", []]}, "$split_compile_blocks"]}}},
+            {"$project" : source_projection},
+            {"$facet" : facets}
+        ]
+
+        global_status = next(self.database[SOURCES_COLLECTION].aggregate(pipeline))
+
+        libs = [dict(lib, lib=lib.pop("_id")) for lib in global_status["libs"]]
+
+        # streamed by their own cursor, a facet would have to fit all the paths in a single document
+        compiled_sources = self.database[SOURCES_COLLECTION].find(
+            {"$expr" : get_has_word_expression("$" + TRIGGERED_BITS_FIELD)},
+            {"_id" : 0, "source_path" : 1}
+        )
+
+        return {
+            "libs" : libs,
+            "compiled_source_paths" : (source_document["source_path"] for source_document in compiled_sources),
+            "never_triggered_block_list" : global_status.get("never_triggered_block_list", [])
+        }
+
+    def migrate(self) -> tuple[int, int]:
+
+        '''
+        Interns compilations registered before compilation bits existed and converts the tag lists of their sources and blocks to bitsets.
+        '''
+
+        interned_compilations = 0
+
+        for compilation_document in self.database[COMPILATION_COLLECTION].find({COMPILATION_BIT_FIELD : {"$exists" : False}}, sort=[("_id", 1)]):
+
+            last_bit = self.find_last_bit()
+            compilation_bit = 0 if last_bit == None else last_bit + 1
+
+            self.database[COMPILATION_COLLECTION].update_one({"_id" : compilation_document["_id"]}, {"$set" : {COMPILATION_BIT_FIELD : compilation_bit}})
+
+            interned_compilations += 1
+
+        bits_by_tag = self.get_compilation_bits()
+
+        writer = BulkWriter(self.database)
+
+        migrated_sources = 0
+
+        for source_document in self.database[SOURCES_COLLECTION].find({"triggered_compilations" : {"$exists" : True}}):
+
+            source_bits = {}
+            for compilation_tag in source_document["triggered_compilations"]:
+                if compilation_tag in bits_by_tag:
+                    set_bit(source_bits, bits_by_tag[compilation_tag])
+
+            for compile_block in source_document["compile_blocks"]:
+
+                block_bits = {}
+                for compilation_tag in compile_block.pop("triggered_compilations", []):
+                    if compilation_tag in bits_by_tag:
+                        set_bit(block_bits, bits_by_tag[compilation_tag])
+
+                compile_block[TRIGGERED_BITS_FIELD] = to_bson_words(block_bits)
+
+            writer.queue(
+                SOURCES_COLLECTION,
+                UpdateOne(
+                    {"_id" : source_document["_id"]},
+                    {
+                        "$set" : {TRIGGERED_BITS_FIELD : to_bson_words(source_bits), "compile_blocks" : source_document["compile_blocks"]},
+                        "$unset" : {"triggered_compilations" : ""}
+                    }
+                ),
+                source_document["_id"]
+            )
+
+            migrated_sources += 1
+
+        writer.flush()
+
+        return interned_compilations, migrated_sources
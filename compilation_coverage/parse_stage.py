@@ -0,0 +1,188 @@
+from __future__ import annotations
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Union
+from helpers import CompilationBlock, SourceBuffer, get_instrumented_code
+from symbol_engine import find_compilation_blocks_and_lines, find_children
+
+# sources parsed ahead of the workers, per parse process, a parsed source keeps its instrumented code in memory until it is taken
+RUN_AHEAD_PER_PROCESS = 4
+
+# in seconds, how often the feeder checks if the stage was closed while the run ahead window is full
+FEEDER_POLL_INTERVAL = 0.5
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ParsedSource:
+
+    source_hash : str
+
+    # see pack_block, tuples pickle much smaller than block dicts
+    compile_blocks : list[tuple]
+
+    universal_lines : int
+
+    # None unless the warning engine instruments the source
+    instrumented_code : Union[str, None]
+
+
+def pack_block(compile_block : CompilationBlock) -> tuple:
+    return (compile_block.symbol_condition, compile_block.start_line, compile_block.end_line, compile_block.block_counter, compile_block.parent_counter, compile_block.lines, compile_block.children)
+
+
+def unpack_block(packed_block : tuple) -> CompilationBlock:
+
+    symbol_condition, start_line, end_line, block_counter, parent_counter, lines, children = packed_block
+
+    return CompilationBlock({
+        "symbol_condition" : symbol_condition,
+        "start_line" : start_line,
+        "end_line" : end_line,
+        "_local_id" : block_counter,
+        "_parent_id" : parent_counter,
+        "lines" : lines,
+        "children" : children
+    })
+
+
+def parse_source_file(real_src_path : str, instrument : bool) -> ParsedSource:
+
+    '''
+    Runs in a parse process: reads the source, removes its comments, finds its blocks and their hierarchy and instruments it.
+    '''
+
+    source_buffer = SourceBuffer(real_src_path)
+
+    total_blocks, universal_lines = find_compilation_blocks_and_lines(source_buffer.get_text())
+
+    find_children(total_blocks)
+
+    return ParsedSource(
+        source_hash= source_buffer.get_hash(),
+        compile_blocks= [pack_block(compile_block) for compile_block in total_blocks],
+        universal_lines= universal_lines,
+        instrumented_code= get_instrumented_code(total_blocks, source_buffer.get_lines()) if instrument else None
+    )
+
+
+class ParseStage:
+
+    '''
+    Parses the sources that the analysis workers will have to parse in a pool of processes, in the order the workers take them,
+    so that the pure Python parsing runs next to the compiler probes instead of taking turns with them under the GIL.
+    A feeder thread keeps at most RUN_AHEAD_PER_PROCESS sources per process parsed or being parsed and not taken yet.
+
+    Workers take the parse of a source with take, or give it up with discard, a source that was never scheduled is parsed by the worker itself.
+    '''
+
+    pool : ProcessPoolExecutor = None
+
+    instrument : bool = False
+
+    # scheduled sources not submitted yet, in order
+    pending : list[str] = None
+    pending_set : set[str] = None
+
+    # submitted sources that were not taken yet
+    futures : dict[str, Future] = None
+
+    window : threading.Semaphore = None
+
+    lock : threading.Lock = None
+
+    closed : threading.Event = None
+
+    feeder : threading.Thread = None
+
+    def __init__(self, processes : int, real_src_paths : list[str], instrument : bool) -> None:
+
+        '''
+        :param real_src_paths: Sources to parse, in the order the workers will reach them
+        :param instrument: Also build the instrumented code of every source
+        '''
+
+        # the workers run threads, so the parse processes start from a clean interpreter instead of a fork
+        self.pool = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"))
+        self.instrument = instrument
+
+        self.pending = list(dict.fromkeys(real_src_paths))
+        self.pending_set = set(self.pending)
+        self.futures = {}
+
+        self.window = threading.Semaphore(processes * RUN_AHEAD_PER_PROCESS)
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+
+        self.feeder = threading.Thread(target=self.feed, name="parse-feeder", daemon=True)
+        self.feeder.start()
+
+        logger.info(f"Parsing {len(self.pending)} sources ahead of the workers with {processes} processes")
+
+    def feed(self):
+
+        for real_src_path in self.pending:
+
+            while not self.window.acquire(timeout=FEEDER_POLL_INTERVAL):
+                if self.closed.is_set():
+                    return
+
+            with self.lock:
+
+                if self.closed.is_set():
+                    return
+
+                # a worker reached the source first and parsed it itself
+                if real_src_path not in self.pending_set:
+                    self.window.release()
+                    continue
+
+                self.pending_set.remove(real_src_path)
+                self.futures[real_src_path] = self.pool.submit(parse_source_file, real_src_path, self.instrument)
+
+    def take(self, real_src_path : str) -> Union[ParsedSource, None]:
+
+        '''
+        Waits for the parse of a source.
+
+        :return: None if the source was not submitted yet (or not scheduled at all) or its parse failed, the worker then parses it itself
+        '''
+
+        with self.lock:
+            self.pending_set.discard(real_src_path)
+            future = self.futures.pop(real_src_path, None)
+
+        if future == None:
+            return None
+
+        self.window.release()
+
+        try:
+            return future.result()
+        except Exception as e:
+            logger.warning(f"Parse process failed for {real_src_path}, parsing it again in the worker: {e}")
+            return None
+
+    def discard(self, real_src_path : str):
+
+        '''
+        The worker is done with a source without taking its parse, e.g. the source had no compilation command.
+        '''
+
+        with self.lock:
+            self.pending_set.discard(real_src_path)
+            future = self.futures.pop(real_src_path, None)
+
+        if future != None:
+            future.cancel()
+            self.window.release()
+
+    def close(self):
+
+        self.closed.set()
+        self.feeder.join()
+        self.pool.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,308 @@
+from __future__ import annotations
+import asyncio
+import collections
+import logging
+import os
+import re
+import signal
+import subprocess
+import threading
+from dataclasses import dataclass
+from typing import Union
+
+# in seconds, a probe is a single gcc run on a single source
+DEFAULT_PROBE_TIMEOUT = 300
+
+DEFAULT_PROBE_RETRIES = 1
+
+# in seconds, multiplied by the number of the failed attempt
+RETRY_DELAY = 1
+
+# in seconds, how often the load average is checked while it is too high
+LOAD_POLL_INTERVAL = 0.5
+
+# --jobserver-auth=R,W (--jobserver-fds=R,W before make 4.2) or --jobserver-auth=fifo:PATH since make 4.4
+JOBSERVER_REGEX = re.compile(r"--jobserver-(?:auth|fds)=(?:fifo:(\S+)|(\d+),(\d+))")
+
+logger = logging.getLogger(__name__)
+
+
+class ProbeError(Exception):
+
+    '''
+    A probe could not be run or did not finish in time, after all its attempts.
+    '''
+
+    pass
+
+
+@dataclass
+class ProbeResult:
+
+    returncode : int
+
+    # None unless the output was captured
+    stdout : Union[bytes, None]
+
+    stderr : bytes
+
+
+class Jobserver:
+
+    '''
+    Client side of the GNU make jobserver, every probe but one needs a token of the make that started the tool.
+    Only used from the event loop of the scheduler. At most one blocking read of the pipe is pending, for the first waiting probe,
+    and a token that is no longer needed when the read returns goes straight back to make.
+    '''
+
+    read_fd : int = None
+
+    write_fd : int = None
+
+    # the job make started us with, it is always ours and never goes back to the pipe
+    implicit_token_free : bool = True
+
+    # probes waiting for a token, each gets its token (None for the implicit one) through its future
+    waiters : collections.deque = None
+
+    pending_read : asyncio.Task = None
+
+    def __init__(self, read_fd : int, write_fd : int) -> None:
+        self.read_fd = read_fd
+        self.write_fd = write_fd
+        self.implicit_token_free = True
+        self.waiters = collections.deque()
+        self.pending_read = None
+
+    async def acquire(self) -> Union[bytes, None]:
+
+        if self.implicit_token_free:
+            self.implicit_token_free = False
+            return None
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        self.read_for_waiters()
+
+        return await waiter
+
+    def release(self, token : Union[bytes, None]):
+
+        if self.waiters:
+            self.waiters.popleft().set_result(token)
+        elif token == None:
+            self.implicit_token_free = True
+        else:
+            os.write(self.write_fd, token)
+
+    def read_for_waiters(self):
+
+        if self.pending_read == None and self.waiters:
+            self.pending_read = asyncio.ensure_future(self.read_token())
+
+    async def read_token(self):
+
+        # reading a token blocks until make has one, the pipe is shared with make so it must stay blocking
+        try:
+            token = await asyncio.to_thread(os.read, self.read_fd, 1)
+        except OSError as e:
+            self.pending_read = None
+            while self.waiters:
+                self.waiters.popleft().set_exception(ProbeError(f"No token from the make jobserver: {e}"))
+            return
+
+        self.pending_read = None
+
+        # the waiter may have been served by a released token in the meantime
+        if token != b"":
+            self.release(token)
+
+        self.read_for_waiters()
+
+    async def drain(self):
+
+        # a token read after the last probe finished must not be lost for make
+        if self.pending_read != None:
+            await self.pending_read
+
+
+def find_jobserver() -> Union[Jobserver, None]:
+
+    jobserver_match = JOBSERVER_REGEX.search(os.environ.get("MAKEFLAGS", ""))
+
+    if jobserver_match == None:
+        return None
+
+    fifo_path, read_fd, write_fd = jobserver_match.groups()
+
+    try:
+        if fifo_path != None:
+            fifo_fd = os.open(fifo_path, os.O_RDWR)
+            return Jobserver(fifo_fd, fifo_fd)
+
+        # make only passes the pipe to recipes marked with +, otherwise the descriptors are closed or something else
+        os.fstat(int(read_fd))
+        os.fstat(int(write_fd))
+
+        return Jobserver(int(read_fd), int(write_fd))
+
+    except OSError as e:
+        logger.warning(f"The make jobserver in MAKEFLAGS cannot be used ({e}), run the tool from a recipe starting with +")
+        return None
+
+
+class ProbeScheduler:
+
+    '''
+    Runs the compiler probes of all analysis workers as subprocesses of a single asyncio event loop, in a thread of its own.
+    At most max_probes compilers run at once, a new one is only started while the load average is below max_load
+    and, inside a make -j, while the jobserver has a token for it. A probe that times out is killed with all its children and retried.
+
+    Workers call run, which blocks until the probe is done.
+    '''
+
+    max_probes : int = None
+
+    timeout : Union[float, None] = None
+
+    retries : int = None
+
+    max_load : Union[float, None] = None
+
+    jobserver : Union[Jobserver, None] = None
+
+    # probes started and not finished yet, only touched by the event loop
+    running : int = 0
+
+    slots : asyncio.Semaphore = None
+
+    loop : asyncio.AbstractEventLoop = None
+
+    thread : threading.Thread = None
+
+    def __init__(self, max_probes : int, timeout : Union[float, None] = DEFAULT_PROBE_TIMEOUT, retries : int = DEFAULT_PROBE_RETRIES, max_load : Union[float, None] = None, use_jobserver : bool = False) -> None:
+
+        '''
+        :param max_probes: Compilers running at the same time
+        :param timeout: Seconds a single attempt may take, None waits forever
+        :param retries: Attempts after the first one for a probe that timed out or could not be started
+        :param max_load: No new compiler is started while the 1 minute load average is at or above it, except when none is running
+        :param use_jobserver: Take a token of the GNU make jobserver from MAKEFLAGS for every compiler
+        '''
+
+        self.max_probes = max_probes
+        self.timeout = timeout
+        self.retries = retries
+        self.max_load = max_load
+        self.jobserver = find_jobserver() if use_jobserver else None
+        self.running = 0
+
+        if use_jobserver and self.jobserver == None:
+            logger.warning("No make jobserver found, probes are only limited by the number of probes and the load")
+
+    def __enter__(self) -> ProbeScheduler:
+
+        self.loop = asyncio.new_event_loop()
+        self.slots = asyncio.Semaphore(self.max_probes)
+
+        self.thread = threading.Thread(target=self.loop.run_forever, name="probe-scheduler", daemon=True)
+        self.thread.start()
+
+        return self
+
+    def __exit__(self, *exc_info):
+
+        if self.jobserver != None:
+            asyncio.run_coroutine_threadsafe(self.jobserver.drain(), self.loop).result()
+
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def run(self, command : str, capture_stdout : bool = False) -> ProbeResult:
+
+        '''
+        Runs a shell command as a probe, safe to call from any thread.
+        The exit code is not checked, the caller knows what the output of its compiler means.
+
+        :raise ProbeError: If every attempt timed out or could not start the command
+        '''
+
+        return asyncio.run_coroutine_threadsafe(self.run_probe(command, capture_stdout), self.loop).result()
+
+    async def run_probe(self, command : str, capture_stdout : bool) -> ProbeResult:
+
+        failure = None
+
+        for attempt in range(1, self.retries + 2):
+
+            if attempt > 1:
+                logger.warning(f"Probe attempt {attempt - 1} failed ({failure}), retrying: {command.strip()}")
+                await asyncio.sleep(RETRY_DELAY * (attempt - 1))
+
+            async with self.slots:
+
+                await self.wait_for_load()
+
+                token = await self.acquire_token()
+                self.running += 1
+
+                try:
+                    return await self.run_attempt(command, capture_stdout)
+
+                except asyncio.TimeoutError:
+                    failure = f"timed out after {self.timeout} seconds"
+
+                except OSError as e:
+                    failure = f"could not be started: {e}"
+
+                finally:
+                    self.running -= 1
+                    self.release_token(token)
+
+        raise ProbeError(f"Probe {failure}, gave up after {self.retries + 1} attempts")
+
+    async def run_attempt(self, command : str, capture_stdout : bool) -> ProbeResult:
+
+        # the compiler gets a session of its own, so that a timeout kills the shell and everything it started
+        process = await asyncio.create_subprocess_shell(
+            command,
+            stdout=subprocess.PIPE if capture_stdout else None,
+            stderr=subprocess.PIPE,
+            start_new_session=True
+        )
+
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), self.timeout)
+
+        except asyncio.TimeoutError:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+            await process.wait()
+            raise
+
+        return ProbeResult(process.returncode, stdout, stderr)
+
+    async def wait_for_load(self):
+
+        if self.max_load == None:
+            return
+
+        # like make -l, one compiler may always run so that the analysis cannot stall
+        while self.running > 0 and os.getloadavg()[0] >= self.max_load:
+            await asyncio.sleep(LOAD_POLL_INTERVAL)
+
+    async def acquire_token(self) -> Union[bytes, None]:
+
+        if self.jobserver == None:
+            return None
+
+        return await self.jobserver.acquire()
+
+    def release_token(self, token : Union[bytes, None]):
+
+        if self.jobserver != None:
+            self.jobserver.release(token)
@@ -0,0 +1,244 @@
+import logging
+import os
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Union
+from colorama import Fore
+from symbol_engine import find_compilation_blocks_and_lines, find_children
+from helpers import SourceBuffer, SourceDocument, CompilationBlock, SourceVersionStrategy, get_source_version_info, get_source_repositories
+from helpers import ProbeMode, get_instrumented_code, write_instrumented_source, relocate_compilation_command, get_probe_command, trigger_compilation_blocks, CommandRelocationError
+from linemarker_engine import trigger_compilation_blocks_linemarkers
+from command_index import get_compiled_source
+from probe_scheduler import ProbeError
+from add_app import AnalysisOptions, ActivationEngine, init_source_document, bind_compilation, create_probe_scheduler
+from storage import get_storage
+from summaries import get_summary_contributions, queue_summary_deltas
+from compilation_bits import TRIGGERED_BITS_FIELD, decode_tags
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ChangedSource:
+
+    source_path : str
+
+    real_src_path : str
+
+    total_blocks : list[CompilationBlock]
+
+    universal_lines : int
+
+    version_info : Union[SourceVersionStrategy, dict]
+
+    # None for the linemarker engine, which preprocesses the unmodified source
+    instrumented_src_path : Union[str, None]
+
+
+def get_changed_sources(since : str) -> list[str]:
+
+    '''
+    Finds the C sources that changed in the Unikraft tree and in the libs since a revision, uncommitted changes included.
+    Repositories in which the revision does not exist are skipped.
+
+    :param since: Any git revision, e.g. ORIG_HEAD after a merge or HEAD@{yesterday}
+    :return: Paths of the changed sources relative to UK_WORKDIR, deleted sources excluded
+    '''
+
+    changed_sources = []
+
+    diffed_repositories = 0
+
+    for repository in get_source_repositories():
+
+        revision_check = subprocess.run(
+            ["git", "-C", repository, "rev-parse", "--verify", "--quiet", f"{since}^{{commit}}"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+
+        if revision_check.returncode != 0:
+            logger.info(f"{since} is not a revision of {repository}, skipping it")
+            continue
+
+        # --relative keeps the paths relative to the repository even if it lives inside a bigger one
+        diff = subprocess.run(
+            ["git", "-C", repository, "diff", "--relative", "--name-only", "--diff-filter=d", "-z", since, "--", "*.c"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL
+        )
+
+        diffed_repositories += 1
+
+        repository_sources = [file_name for file_name in diff.stdout.decode(errors="surrogateescape").split("\0") if file_name != ""]
+
+        logger.info(f"{len(repository_sources)} sources changed in {repository} since {since}")
+
+        changed_sources += [os.path.relpath(os.path.join(repository, file_name), os.environ["UK_WORKDIR"]) for file_name in repository_sources]
+
+    if diffed_repositories == 0:
+        logger.critical(f"{since} is not a revision of the Unikraft tree nor of any lib")
+
+    # the same source is reached twice when a lib lives inside the Unikraft tree
+    return list(dict.fromkeys(changed_sources))
+
+
+def parse_changed_source(source_path : str, options : AnalysisOptions) -> ChangedSource:
+
+    '''
+    Parses the current version of a source and instruments it once for all the compilations that probe it.
+    '''
+
+    real_src_path = os.path.join(os.environ["UK_WORKDIR"], source_path)
+
+    source_buffer = SourceBuffer(real_src_path)
+
+    total_blocks, universal_lines = find_compilation_blocks_and_lines(source_buffer.get_text())
+
+    find_children(total_blocks)
+
+    instrumented_src_path = None
+
+    if options.engine == ActivationEngine.WARNING:
+        # a private directory per source, like the out-of-tree instrumentation of app add
+        instrumented_src_path = f"{tempfile.mkdtemp(dir=options.scratch_dir)}/{os.path.basename(real_src_path)}"
+        write_instrumented_source(get_instrumented_code(total_blocks, source_buffer.get_lines()), instrumented_src_path)
+
+    return ChangedSource(
+        source_path= source_path,
+        real_src_path= real_src_path,
+        total_blocks= total_blocks,
+        universal_lines= universal_lines,
+        version_info= get_source_version_info(real_src_path),
+        instrumented_src_path= instrumented_src_path
+    )
+
+
+def probe_changed_source(changed_source : ChangedSource, compile_command : str, options : AnalysisOptions) -> list[int]:
+
+    '''
+    :param compile_command: Command stored by app add for one compilation of the source
+    :raise ProbeError: If the compiler could not be run or did not finish in time
+    :raise CommandRelocationError: If the command does not compile the source with -c
+    '''
+
+    # the command names the source exactly as the build did
+    compiled_source = get_compiled_source(compile_command)
+
+    if options.engine == ActivationEngine.LINEMARKER:
+        return trigger_compilation_blocks_linemarkers(changed_source.total_blocks, compile_command, compiled_source, options.probe_scheduler)
+
+    probe_command = get_probe_command(relocate_compilation_command(compile_command, compiled_source, changed_source.instrumented_src_path), options.probe)
+
+    return trigger_compilation_blocks(probe_command, options.probe_scheduler)
+
+
+def queue_refreshed_source(changed_source : ChangedSource, previous_document : Union[SourceDocument, dict], activations : dict[str, list[int]], compilation_bits : dict[str, int], options : AnalysisOptions):
+
+    source_document = init_source_document(changed_source.real_src_path, changed_source.total_blocks, changed_source.universal_lines, previous_document["lib"], changed_source.version_info)
+
+    for compilation_tag, activated_block_counters in activations.items():
+        bind_compilation(source_document, activated_block_counters, compilation_tag, compilation_bits[compilation_tag])
+
+    options.writer.queue_replaced_source(source_document, previous_document)
+
+    queue_summary_deltas(options.writer, get_summary_contributions(previous_document), source_document)
+
+
+def refresh_app_subcommand(since : str, options : AnalysisOptions, saved_outfile : str):
+
+    '''
+    Parses again the registered sources that changed since a revision and probes them again for every compilation that compiled them,
+    with the compilation commands stored by app add. The apps are not built again, but the commands still need their build directories.
+    Compilations registered before the commands were stored cannot be probed again and lose the changed sources.
+    '''
+
+    changed_source_paths = get_changed_sources(since)
+
+    source_documents = get_storage().prefetch_sources(changed_source_paths) if changed_source_paths != [] else {}
+
+    logger.info(f"{len(source_documents)} of the {len(changed_source_paths)} sources changed since {since} are registered")
+
+    if source_documents == {}:
+        with open(saved_outfile, "a") as out:
+            out.write(Fore.GREEN + f"No registered source changed since {since}\n" + Fore.RESET)
+        return
+
+    compile_commands = get_storage().get_compile_commands(list(source_documents))
+
+    compilation_bits = get_storage().get_compilation_bits()
+    tags_by_bit = {compilation_bit : compilation_tag for compilation_tag, compilation_bit in compilation_bits.items()}
+
+    # compilation tag -> command, for every source, commands of deleted compilations are ignored
+    source_commands : dict[str, dict[str, str]] = {}
+
+    for source_path, previous_document in source_documents.items():
+
+        source_commands[source_path] = {
+            compilation_tag : stored_command["command"]
+            for compilation_tag, stored_command in compile_commands.get(source_path, {}).items()
+            if compilation_tag in compilation_bits
+        }
+
+        unknown_tags = [compilation_tag for compilation_tag in decode_tags(previous_document[TRIGGERED_BITS_FIELD], tags_by_bit) if compilation_tag not in source_commands[source_path]]
+
+        if unknown_tags != []:
+            logger.warning(f"No compilation command stored for {source_path} by {', '.join(unknown_tags)}, the refreshed source will not be bound to them")
+
+    options.writer = get_storage().create_writer(options.batch_size, options.split_threshold)
+    options.probe_scheduler = create_probe_scheduler(options)
+
+    failed_source_paths = []
+    probes = 0
+
+    try:
+        with options.probe_scheduler, tempfile.TemporaryDirectory(prefix="uk-coverage-") as scratch_dir, ThreadPoolExecutor(max_workers=options.jobs) as pool:
+
+            options.scratch_dir = scratch_dir
+
+            # every source is parsed and instrumented once, then all of its compilations probe the same instrumented copy
+            parse_futures = {source_path : pool.submit(parse_changed_source, source_path, options) for source_path in sorted(source_documents)}
+            changed_sources = {source_path : future.result() for source_path, future in parse_futures.items()}
+
+            probe_futures = {
+                (source_path, compilation_tag) : pool.submit(probe_changed_source, changed_sources[source_path], compile_command, options)
+                for source_path, compilation_commands in source_commands.items()
+                for compilation_tag, compile_command in compilation_commands.items()
+            }
+
+            for source_path, changed_source in changed_sources.items():
+
+                previous_document = source_documents[source_path]
+
+                activations = {}
+
+                for compilation_tag in source_commands[source_path]:
+                    try:
+                        activations[compilation_tag] = probe_futures[(source_path, compilation_tag)].result()
+                        probes += 1
+
+                    # the stored version of the source is kept, a partially refreshed source would mix two versions
+                    except (ProbeError, CommandRelocationError) as e:
+                        logger.critical(f"Cannot refresh {source_path} for {compilation_tag}: {e}")
+                        get_storage().record_source_failure(compilation_tag, source_path, previous_document["lib"], str(e))
+
+                if len(activations) != len(source_commands[source_path]):
+                    failed_source_paths.append(source_path)
+                    continue
+
+                queue_refreshed_source(changed_source, previous_document, activations, compilation_bits, options)
+
+    finally:
+        options.writer.flush()
+
+    refreshed_sources = len(source_documents) - len(failed_source_paths)
+
+    logger.info(f"Refreshed {refreshed_sources} sources with {probes} probes")
+
+    with open(saved_outfile, "a") as out:
+        out.write(Fore.GREEN + f"Refreshed {refreshed_sources} sources changed since {since} with {probes} compiler probes\n" + Fore.RESET)
+
+        if failed_source_paths != []:
+            out.write(Fore.RED + f"{len(failed_source_paths)} sources could not be refreshed: {', '.join(failed_source_paths)}\n" + Fore.RESET)
@@ -0,0 +1,617 @@
+import logging
+import os
+import json
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Union
+from helpers import SourceDocument, GitCommitStrategy, SHA1Strategy
+from storage import CoverageStorage, SourceWriter
+from compilation_bits import TRIGGERED_BITS_FIELD, set_bit, iterate_bits
+from summaries import TOTAL_SCOPE
+
+logger = logging.getLogger(__name__)
+
+# a source document is spread over these tables, the triggered bits of a source or block are its rows in the *_compilations tables
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS compilations (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        tag TEXT NOT NULL UNIQUE,
+        app TEXT,
+        bit INTEGER UNIQUE
+    )''',
+    '''CREATE TABLE IF NOT EXISTS sources (
+        source_path TEXT PRIMARY KEY,
+        lib TEXT NOT NULL,
+        universal_lines INTEGER NOT NULL,
+        total_lines INTEGER NOT NULL,
+        version_key TEXT NOT NULL,
+        version_value TEXT NOT NULL
+    ) WITHOUT ROWID''',
+    '''CREATE TABLE IF NOT EXISTS source_compilations (
+        source_path TEXT NOT NULL,
+        tag TEXT NOT NULL,
+        bit INTEGER NOT NULL,
+        compiled_lines INTEGER NOT NULL,
+        PRIMARY KEY (source_path, tag)
+    ) WITHOUT ROWID''',
+    # sources compiled by a set of compilations, used by app view
+    '''CREATE INDEX IF NOT EXISTS source_compilations_bit ON source_compilations (bit, source_path)''',
+    '''CREATE TABLE IF NOT EXISTS blocks (
+        source_path TEXT NOT NULL,
+        local_id INTEGER NOT NULL,
+        parent_id INTEGER NOT NULL,
+        symbol_condition TEXT NOT NULL,
+        start_line INTEGER NOT NULL,
+        end_line INTEGER NOT NULL,
+        lines INTEGER NOT NULL,
+        children TEXT NOT NULL,
+        PRIMARY KEY (source_path, local_id)
+    ) WITHOUT ROWID''',
+    '''CREATE TABLE IF NOT EXISTS block_compilations (
+        source_path TEXT NOT NULL,
+        local_id INTEGER NOT NULL,
+        bit INTEGER NOT NULL,
+        PRIMARY KEY (source_path, local_id, bit)
+    ) WITHOUT ROWID''',
+    # command of every source in every compilation, used by app refresh
+    '''CREATE TABLE IF NOT EXISTS compile_commands (
+        source_path TEXT NOT NULL,
+        tag TEXT NOT NULL,
+        lib TEXT NOT NULL,
+        command TEXT NOT NULL,
+        PRIMARY KEY (source_path, tag)
+    ) WITHOUT ROWID''',
+    # sources done by a compilation, app add --resume and --update skip them while their fingerprint does not change
+    '''CREATE TABLE IF NOT EXISTS checkpoints (
+        tag TEXT NOT NULL,
+        source_path TEXT NOT NULL,
+        lib TEXT NOT NULL,
+        fingerprint TEXT NOT NULL,
+        PRIMARY KEY (tag, source_path, lib)
+    ) WITHOUT ROWID''',
+    # sources of a compilation that could not be analyzed, e.g. a compiler that hung
+    '''CREATE TABLE IF NOT EXISTS source_failures (
+        tag TEXT NOT NULL,
+        source_path TEXT NOT NULL,
+        lib TEXT NOT NULL,
+        reason TEXT NOT NULL,
+        PRIMARY KEY (tag, source_path, lib)
+    ) WITHOUT ROWID''',
+    '''CREATE TABLE IF NOT EXISTS summaries (
+        tag TEXT NOT NULL,
+        scope TEXT NOT NULL,
+        key TEXT NOT NULL,
+        compiled_lines INTEGER NOT NULL,
+        total_lines INTEGER NOT NULL,
+        sources INTEGER NOT NULL,
+        PRIMARY KEY (tag, scope, key)
+    ) WITHOUT ROWID'''
+]
+
+SUMMARY_FIELDS = ["compiled_lines", "total_lines", "sources"]
+
+
+def get_version(source_document : Union[SourceDocument, dict]) -> tuple[str, str]:
+
+    for version_key in [GitCommitStrategy.version_key, SHA1Strategy.version_key]:
+        if version_key in source_document:
+            return version_key, source_document[version_key]
+
+    raise ValueError(f"{source_document['source_path']} has no version")
+
+
+def get_source_rows(source_document : Union[SourceDocument, dict], compilation_bits : dict[str, int]) -> tuple:
+
+    '''
+    Rows of a whole source document, taken when the write is queued since the document keeps changing in memory.
+
+    :param compilation_bits: tag -> bit of the compilations in the compiled_stats of the source
+    :return: source row, source compilation rows, block rows, block compilation rows
+    '''
+
+    source_path = source_document["source_path"]
+
+    source_row = (source_path, source_document["lib"], source_document["universal_lines"], source_document["total_lines"], *get_version(source_document))
+
+    source_compilation_rows = [
+        (source_path, tag, compilation_bits[tag], compiled_lines)
+        for tag, compiled_lines in source_document["compiled_stats"].items()
+    ]
+
+    block_rows = []
+    block_compilation_rows = []
+
+    for compile_block in source_document["compile_blocks"]:
+
+        block_rows.append((
+            source_path,
+            compile_block["_local_id"],
+            compile_block["_parent_id"],
+            compile_block["symbol_condition"],
+            compile_block["start_line"],
+            compile_block["end_line"],
+            compile_block["lines"],
+            json.dumps(compile_block["children"])
+        ))
+
+        for compilation_bit in iterate_bits(compile_block[TRIGGERED_BITS_FIELD]):
+            block_compilation_rows.append((source_path, compile_block["_local_id"], compilation_bit))
+
+    return source_row, source_compilation_rows, block_rows, block_compilation_rows
+
+
+class SQLiteSourceWriter(SourceWriter):
+
+    '''
+    Queued writes are applied in order, a batch is a single transaction.
+    Increments of the same summary are merged until the next flush.
+    '''
+
+    storage = None
+    batch_size : int = None
+    compilation_bits : dict[str, int] = None
+    pending_writes : list = None
+    pending_increments : dict[tuple, list[int]] = None
+    queue_lock : threading.Lock = None
+    flush_lock : threading.Lock = None
+
+    def __init__(self, storage, batch_size : int) -> None:
+        self.storage = storage
+        self.batch_size = batch_size
+        self.compilation_bits = {}
+        self.pending_writes = []
+        self.pending_increments = {}
+        self.queue_lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+
+    def queue_write(self, write, *rows):
+
+        with self.queue_lock:
+            self.pending_writes.append((write, rows))
+            is_full = len(self.pending_writes) + len(self.pending_increments) >= self.batch_size
+
+        if is_full:
+            self.flush()
+
+    def get_compilation_bits(self, source_document : Union[SourceDocument, dict]) -> dict[str, int]:
+
+        # compilations are only looked up again when a source names one registered since the last lookup
+        with self.queue_lock:
+            if not source_document["compiled_stats"].keys() <= self.compilation_bits.keys():
+                self.compilation_bits = self.storage.get_compilation_bits()
+
+            return self.compilation_bits
+
+    def queue_new_source(self, source_document : Union[SourceDocument, dict]):
+        self.queue_write(write_source, *get_source_rows(source_document, self.get_compilation_bits(source_document)))
+
+    def queue_replaced_source(self, source_document : Union[SourceDocument, dict], previous_document : Union[SourceDocument, dict]):
+        self.queue_write(write_source, *get_source_rows(source_document, self.get_compilation_bits(source_document)))
+
+    def queue_activation(self, source_document : Union[SourceDocument, dict], activated_block_counters : list[int], compilation_tag : str, compilation_bit : int, compiled_lines : int, summary_deltas : dict[tuple, dict[str, int]]):
+
+        source_path = source_document["source_path"]
+
+        self.queue_write(
+            write_activation,
+            (source_path, *get_version(source_document)),
+            (source_path, compilation_tag, compilation_bit, compiled_lines),
+            [(source_path, block_counter, compilation_bit) for block_counter in activated_block_counters],
+            [(*summary_key, *[increments[field] for field in SUMMARY_FIELDS]) for summary_key, increments in summary_deltas.items()]
+        )
+
+    def queue_unbind(self, source_document : Union[SourceDocument, dict], compilation_tag : str, compilation_bit : int):
+        self.queue_write(write_unbind, (source_document["source_path"], compilation_tag, compilation_bit))
+
+    def queue_compile_command(self, compilation_tag : str, source_path : str, lib_name : str, compile_command : str):
+        self.queue_write(write_compile_command, (source_path, compilation_tag, lib_name, compile_command))
+
+    def queue_checkpoint(self, compilation_tag : str, source_path : str, lib_name : str, fingerprint : str):
+        self.queue_write(write_checkpoint, (compilation_tag, source_path, lib_name, fingerprint))
+
+    def queue_dropped_source(self, compilation_tag : str, source_path : str, lib_names : list[str]):
+        self.queue_write(write_dropped_source, (compilation_tag, source_path))
+
+    def queue_summary_increment(self, tag : str, scope : str, key : str, increments : dict[str, int]):
+
+        with self.queue_lock:
+            pending = self.pending_increments.setdefault((tag, scope, key), [0, 0, 0])
+            for i, field in enumerate(SUMMARY_FIELDS):
+                pending[i] += increments.get(field, 0)
+
+            is_full = len(self.pending_writes) + len(self.pending_increments) >= self.batch_size
+
+        if is_full:
+            self.flush()
+
+    def flush(self):
+
+        # batches are committed in the order they were filled
+        with self.flush_lock:
+
+            with self.queue_lock:
+                writes = self.pending_writes
+                increments = self.pending_increments
+                self.pending_writes = []
+                self.pending_increments = {}
+
+            if writes == [] and increments == {}:
+                return
+
+            with self.storage.transaction() as cursor:
+
+                for write, rows in writes:
+                    write(cursor, *rows)
+
+                write_summary_increments(cursor, [(*summary_key, *values) for summary_key, values in increments.items()])
+
+            logger.debug(f"Flushed {len(writes)} source writes and {len(increments)} summary increments")
+
+
+def write_source(cursor : sqlite3.Cursor, source_row : tuple, source_compilation_rows : list[tuple], block_rows : list[tuple], block_compilation_rows : list[tuple]):
+
+    '''
+    Replaces everything stored for a source.
+    '''
+
+    source_path = source_row[0]
+
+    for table in ["source_compilations", "blocks", "block_compilations"]:
+        cursor.execute(f"DELETE FROM {table} WHERE source_path = ?", (source_path,))
+
+    cursor.execute("INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?, ?, ?)", source_row)
+    cursor.executemany("INSERT INTO source_compilations VALUES (?, ?, ?, ?)", source_compilation_rows)
+    cursor.executemany("INSERT INTO blocks VALUES (?, ?, ?, ?, ?, ?, ?, ?)", block_rows)
+    cursor.executemany("INSERT INTO block_compilations VALUES (?, ?, ?)", block_compilation_rows)
+
+
+def write_compile_command(cursor : sqlite3.Cursor, command_row : tuple):
+    cursor.execute("INSERT OR REPLACE INTO compile_commands (source_path, tag, lib, command) VALUES (?, ?, ?, ?)", command_row)
+
+
+def write_unbind(cursor : sqlite3.Cursor, unbind_row : tuple):
+
+    source_path, compilation_tag, compilation_bit = unbind_row
+
+    cursor.execute("DELETE FROM source_compilations WHERE source_path = ? AND tag = ?", (source_path, compilation_tag))
+    cursor.execute("DELETE FROM block_compilations WHERE source_path = ? AND bit = ?", (source_path, compilation_bit))
+
+
+def write_checkpoint(cursor : sqlite3.Cursor, checkpoint_row : tuple):
+    cursor.execute("INSERT OR REPLACE INTO checkpoints (tag, source_path, lib, fingerprint) VALUES (?, ?, ?, ?)", checkpoint_row)
+
+
+def write_dropped_source(cursor : sqlite3.Cursor, dropped_row : tuple):
+    cursor.execute("DELETE FROM checkpoints WHERE tag = ? AND source_path = ?", dropped_row)
+    cursor.execute("DELETE FROM compile_commands WHERE tag = ? AND source_path = ?", dropped_row)
+
+
+def write_summary_increments(cursor : sqlite3.Cursor, summary_rows : list[tuple]):
+
+    cursor.executemany(
+        '''INSERT INTO summaries (tag, scope, key, compiled_lines, total_lines, sources) VALUES (?, ?, ?, ?, ?, ?)
+           ON CONFLICT (tag, scope, key) DO UPDATE SET
+           compiled_lines = compiled_lines + excluded.compiled_lines,
+           total_lines = total_lines + excluded.total_lines,
+           sources = sources + excluded.sources''',
+        summary_rows
+    )
+
+
+def write_activation(cursor : sqlite3.Cursor, version_row : tuple, source_compilation_row : tuple, block_compilation_rows : list[tuple], summary_rows : list[tuple]):
+
+    '''
+    Adds a compilation to a source and its increments to the summaries, only if the stored source still has the version the blocks were activated on.
+    '''
+
+    cursor.execute("SELECT 1 FROM sources WHERE source_path = ? AND version_key = ? AND version_value = ?", version_row)
+
+    if cursor.fetchone() == None:
+        logger.warning(f"{version_row[0]} was replaced by another version, its activation is dropped")
+        return
+
+    cursor.execute("INSERT OR REPLACE INTO source_compilations VALUES (?, ?, ?, ?)", source_compilation_row)
+    cursor.executemany("INSERT OR IGNORE INTO block_compilations VALUES (?, ?, ?)", block_compilation_rows)
+
+    write_summary_increments(cursor, summary_rows)
+
+
+class SQLiteStorage(CoverageStorage):
+
+    '''
+    Single file database, several processes may use it at once, writers wait for each other.
+    '''
+
+    path : str = None
+    connection : sqlite3.Connection = None
+    connection_lock : threading.Lock = None
+
+    def __init__(self, path : str) -> None:
+
+        self.path = path
+
+        if path != ":memory:" and os.path.dirname(path) != "":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # transactions are explicit, the connection is shared by the analysis workers
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.connection_lock = threading.RLock()
+
+    @contextmanager
+    def transaction(self):
+
+        with self.connection_lock:
+            cursor = self.connection.cursor()
+
+            # the write lock is taken upfront, so that concurrent processes wait instead of failing on upgrade
+            cursor.execute("BEGIN IMMEDIATE")
+
+            try:
+                yield cursor
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+
+            cursor.execute("COMMIT")
+
+    def query(self, statement : str, parameters : tuple = ()) -> list[sqlite3.Row]:
+
+        with self.connection_lock:
+            return self.connection.execute(statement, parameters).fetchall()
+
+    def ensure_schema(self):
+
+        # readers do not block the writer of an analysis
+        self.query("PRAGMA journal_mode=WAL")
+
+        with self.transaction() as cursor:
+            for statement in SCHEMA:
+                cursor.execute(statement)
+
+    def find_compilation(self, compilation_tag : str) -> Union[dict, None]:
+
+        rows = self.query("SELECT id AS _id, tag, app, bit FROM compilations WHERE tag = ?", (compilation_tag,))
+
+        return None if rows == [] else dict(rows[0])
+
+    def register_compilation(self, compilation_tag : str, app_workspace : str) -> tuple[int, int]:
+
+        # AUTOINCREMENT ids are never reused, so neither are the bits derived from them
+        with self.transaction() as cursor:
+            cursor.execute("INSERT INTO compilations (tag, app) VALUES (?, ?)", (compilation_tag, app_workspace))
+            compilation_id = cursor.lastrowid
+            cursor.execute("UPDATE compilations SET bit = ? WHERE id = ?", (compilation_id - 1, compilation_id))
+
+        return compilation_id, compilation_id - 1
+
+    def delete_compilation(self, compilation_tag : str):
+
+        with self.transaction() as cursor:
+            cursor.execute("DELETE FROM compilations WHERE tag = ?", (compilation_tag,))
+            cursor.execute("DELETE FROM source_failures WHERE tag = ?", (compilation_tag,))
+            cursor.execute("DELETE FROM compile_commands WHERE tag = ?", (compilation_tag,))
+            cursor.execute("DELETE FROM checkpoints WHERE tag = ?", (compilation_tag,))
+
+    def record_source_failure(self, compilation_tag : str, source_path : str, lib_name : str, reason : str):
+
+        with self.transaction() as cursor:
+            cursor.execute(
+                "INSERT OR REPLACE INTO source_failures (tag, source_path, lib, reason) VALUES (?, ?, ?, ?)",
+                (compilation_tag, source_path, lib_name, reason)
+            )
+
+    def clear_source_failures(self, compilation_tag : str):
+
+        with self.transaction() as cursor:
+            cursor.execute("DELETE FROM source_failures WHERE tag = ?", (compilation_tag,))
+
+    def get_checkpoints(self, compilation_tag : str) -> dict[tuple[str, str], str]:
+
+        rows = self.query("SELECT source_path, lib, fingerprint FROM checkpoints WHERE tag = ?", (compilation_tag,))
+
+        return {(row["source_path"], row["lib"]) : row["fingerprint"] for row in rows}
+
+    def get_source_failures(self, compilation_tag : str) -> list[dict]:
+
+        rows = self.query("SELECT source_path, lib, reason FROM source_failures WHERE tag = ? ORDER BY source_path, lib", (compilation_tag,))
+
+        return [dict(row) for row in rows]
+
+    def count_compilations(self) -> int:
+        return self.query("SELECT COUNT(*) FROM compilations")[0][0]
+
+    def get_compilation_bits(self, compilation_tags : list[str] = None) -> dict[str, int]:
+
+        if compilation_tags == None:
+            rows = self.query("SELECT tag, bit FROM compilations WHERE bit IS NOT NULL")
+        else:
+            rows = self.query("SELECT tag, bit FROM compilations WHERE bit IS NOT NULL AND tag IN (SELECT value FROM json_each(?))", (json.dumps(compilation_tags),))
+
+        return {row["tag"] : row["bit"] for row in rows}
+
+    def load_sources(self, source_filter : str, parameters : tuple) -> list[Union[SourceDocument, dict]]:
+
+        '''
+        Rebuilds whole source documents, in the same shape as the MongoDB ones.
+
+        :param source_filter: Query that selects the source paths
+        '''
+
+        source_documents : dict[str, dict] = {}
+
+        with self.connection_lock:
+
+            for row in self.connection.execute(f"SELECT * FROM sources WHERE source_path IN ({source_filter}) ORDER BY source_path", parameters):
+                source_documents[row["source_path"]] = {
+                    "source_path" : row["source_path"],
+                    "compile_blocks" : [],
+                    "universal_lines" : row["universal_lines"],
+                    TRIGGERED_BITS_FIELD : {},
+                    "compiled_stats" : {},
+                    "total_lines" : row["total_lines"],
+                    "lib" : row["lib"],
+                    row["version_key"] : row["version_value"]
+                }
+
+            for row in self.connection.execute(f"SELECT * FROM source_compilations WHERE source_path IN ({source_filter})", parameters):
+                source_document = source_documents[row["source_path"]]
+                source_document["compiled_stats"][row["tag"]] = row["compiled_lines"]
+                set_bit(source_document[TRIGGERED_BITS_FIELD], row["bit"])
+
+            # _local_id is the position of the block in compile_blocks
+            for row in self.connection.execute(f"SELECT * FROM blocks WHERE source_path IN ({source_filter}) ORDER BY source_path, local_id", parameters):
+                source_documents[row["source_path"]]["compile_blocks"].append({
+                    "symbol_condition" : row["symbol_condition"],
+                    TRIGGERED_BITS_FIELD : {},
+                    "start_line" : row["start_line"],
+                    "end_line" : row["end_line"],
+                    "_local_id" : row["local_id"],
+                    "_parent_id" : row["parent_id"],
+                    "lines" : row["lines"],
+                    "children" : json.loads(row["children"])
+                })
+
+            for row in self.connection.execute(f"SELECT * FROM block_compilations WHERE source_path IN ({source_filter})", parameters):
+                set_bit(source_documents[row["source_path"]]["compile_blocks"][row["local_id"]][TRIGGERED_BITS_FIELD], row["bit"])
+
+        return list(source_documents.values())
+
+    def get_compile_commands(self, source_paths : list[str]) -> dict[str, dict[str, dict]]:
+
+        rows = self.query(
+            "SELECT source_path, tag, lib, command FROM compile_commands WHERE source_path IN (SELECT value FROM json_each(?))",
+            (json.dumps(list(set(source_paths))),)
+        )
+
+        compile_commands = {}
+        for row in rows:
+            compile_commands.setdefault(row["source_path"], {})[row["tag"]] = {"lib" : row["lib"], "command" : row["command"]}
+
+        return compile_commands
+
+    def prefetch_sources(self, source_paths : list[str]) -> dict[str, Union[SourceDocument, dict]]:
+
+        source_documents = self.load_sources("SELECT value FROM json_each(?)", (json.dumps(list(set(source_paths))),))
+
+        return {source_document["source_path"] : source_document for source_document in source_documents}
+
+    def find_sources_by_bits(self, compilation_bits : list[int]) -> list[Union[SourceDocument, dict]]:
+        return self.load_sources("SELECT source_path FROM source_compilations WHERE bit IN (SELECT value FROM json_each(?))", (json.dumps(compilation_bits),))
+
+    def create_writer(self, batch_size : int, split_threshold : Union[int, None]) -> SQLiteSourceWriter:
+
+        if split_threshold != None:
+            logger.warning("Blocks are always stored in their own table with the sqlite backend, the split threshold is ignored")
+
+        return SQLiteSourceWriter(self, batch_size)
+
+    def get_apps_coverage(self) -> list[tuple[str, int, int]]:
+
+        apps_coverage = []
+
+        for row in self.query(
+            '''SELECT compilations.tag, summaries.compiled_lines, summaries.total_lines FROM compilations
+               LEFT JOIN summaries ON summaries.tag = compilations.tag AND summaries.scope = ? AND summaries.key = ''
+               ORDER BY compilations.id''',
+            (TOTAL_SCOPE,)
+        ):
+            if row["compiled_lines"] == None:
+                logger.warning(f"No summary for {row['tag']}, run `summaries rebuild` if the summaries were lost")
+                apps_coverage.append((row["tag"], 0, 0))
+                continue
+
+            apps_coverage.append((row["tag"], row["compiled_lines"], row["total_lines"]))
+
+        return apps_coverage
+
+    def get_summaries(self, compilation_tags : list[str], scope : str) -> list[dict]:
+
+        rows = self.query(
+            "SELECT * FROM summaries WHERE scope = ? AND tag IN (SELECT value FROM json_each(?)) ORDER BY tag, key",
+            (scope, json.dumps(compilation_tags))
+        )
+
+        return [dict(row) for row in rows]
+
+    def iterate_source_stats(self):
+
+        source_stats = {
+            row["source_path"] : {"source_path" : row["source_path"], "lib" : row["lib"], "total_lines" : row["total_lines"], "compiled_stats" : {}}
+            for row in self.query("SELECT source_path, lib, total_lines FROM sources")
+        }
+
+        for row in self.query("SELECT source_path, tag, compiled_lines FROM source_compilations"):
+            source_stats[row["source_path"]]["compiled_stats"][row["tag"]] = row["compiled_lines"]
+
+        return iter(source_stats.values())
+
+    def replace_summaries(self, summaries : list[dict], compilation_tags : list[str] = None):
+
+        with self.transaction() as cursor:
+            if compilation_tags == None:
+                cursor.execute("DELETE FROM summaries")
+            else:
+                cursor.execute("DELETE FROM summaries WHERE tag IN (SELECT value FROM json_each(?))", (json.dumps(compilation_tags),))
+            cursor.executemany(
+                "INSERT INTO summaries VALUES (?, ?, ?, ?, ?, ?)",
+                [(summary["tag"], summary["scope"], summary["key"], *[summary[field] for field in SUMMARY_FIELDS]) for summary in summaries]
+            )
+
+    def get_global_status(self, details : bool) -> dict:
+
+        # a source counts as compiled as soon as any compilation compiled it, a block as soon as any compilation triggered it
+        libs = self.query(
+            '''WITH triggered_blocks AS (SELECT DISTINCT source_path, local_id FROM block_compilations),
+               compiled_sources AS (SELECT DISTINCT source_path FROM source_compilations),
+               block_stats AS (
+                   SELECT blocks.source_path,
+                          COUNT(*) AS blocks,
+                          SUM(triggered_blocks.local_id IS NULL) AS never_triggered_blocks,
+                          SUM(CASE WHEN triggered_blocks.local_id IS NULL THEN 0 ELSE blocks.lines END) AS triggered_lines
+                   FROM blocks LEFT JOIN triggered_blocks USING (source_path, local_id)
+                   GROUP BY blocks.source_path
+               )
+               SELECT sources.lib AS lib,
+                      SUM(CASE WHEN compiled_sources.source_path IS NULL THEN 0 ELSE sources.universal_lines + COALESCE(block_stats.triggered_lines, 0) END) AS compiled_lines,
+                      SUM(sources.total_lines) AS total_lines,
+                      COUNT(*) AS sources,
+                      SUM(COALESCE(block_stats.blocks, 0)) AS blocks,
+                      SUM(COALESCE(block_stats.never_triggered_blocks, 0)) AS never_triggered_blocks
+               FROM sources
+               LEFT JOIN compiled_sources USING (source_path)
+               LEFT JOIN block_stats USING (source_path)
+               GROUP BY sources.lib
+               ORDER BY sources.lib'''
+        )
+
+        never_triggered_block_list = []
+
+        # the block list is only built when asked for
+        if details:
+
+            blocks_by_source : dict[str, list] = {}
+
+            for row in self.query(
+                '''SELECT source_path, start_line, symbol_condition FROM blocks
+                   WHERE NOT EXISTS (SELECT 1 FROM block_compilations WHERE block_compilations.source_path = blocks.source_path AND block_compilations.local_id = blocks.local_id)
+                   ORDER BY source_path, local_id'''
+            ):
+                blocks_by_source.setdefault(row["source_path"], []).append({"start_line" : row["start_line"], "symbol_condition" : row["symbol_condition"]})
+
+            never_triggered_block_list = [
+                {"source_path" : source_path, "never_triggered_block_list" : blocks}
+                for source_path, blocks in blocks_by_source.items()
+            ]
+
+        return {
+            "libs" : [dict(row) for row in libs],
+            "compiled_source_paths" : [row["source_path"] for row in self.query("SELECT DISTINCT source_path FROM source_compilations")],
+            "never_triggered_block_list" : never_triggered_block_list
+        }
+
+    def migrate(self) -> tuple[int, int]:
+
+        # sqlite databases have stored compilation bits since they exist
+        return 0, 0
@@ -4,7 +4,7 @@ from colorama import Fore
 from helpers import SourceVersionStrategy, SourceDocument, GitCommitStrategy, SHA1Strategy, CompilationBlock
 from typing import Union
 from queue import LifoQueue
-from functools import reduce
+from compilation_bits import TRIGGERED_BITS_FIELD, is_empty, has_any_bit, decode_tags
 
 PLACEHOLDER_INFO = "    "
 PLACEHOLDER_NODE = "  | "
@@ -37,7 +37,7 @@ class SrcsTrie:
         else:
             correct_child.info = src_doc
 
-    def print_compile_blocks(self, base, tabs, out_file, compilation_tags : list[str]):
+    def print_compile_blocks(self, base, tabs, out_file, compilation_bits : list[int], tags_by_bit : dict[int, str]):
 
         compile_blocks : Union[list[CompilationBlock], list[dict]] = self.info["compile_blocks"]
 
@@ -62,10 +62,10 @@ class SrcsTrie:
                 continue
             
 
-            if current["triggered_compilations"] == []:
+            if is_empty(current[TRIGGERED_BITS_FIELD]):
                 out_file.write(base * PLACEHOLDER_NODE + (depth - base) * PLACEHOLDER_INFO + Fore.RED + current["symbol_condition"] + Fore.RESET + "\n")
 
-            elif reduce(lambda acc, compile_name : acc | True if compile_name in current["triggered_compilations"] else acc | False, compilation_tags, False):
+            elif has_any_bit(current[TRIGGERED_BITS_FIELD], compilation_bits):
                 out_file.write(base * PLACEHOLDER_NODE + (depth - base) * PLACEHOLDER_INFO + Fore.GREEN + current["symbol_condition"] + Fore.RESET + "\n")
             else:
                 out_file.write(base * PLACEHOLDER_NODE + (depth - base) * PLACEHOLDER_INFO + Fore.YELLOW + current["symbol_condition"] + Fore.RESET + "\n")
@@ -77,7 +77,7 @@ class SrcsTrie:
 
             out_file.write(base * PLACEHOLDER_NODE + (depth - base) * PLACEHOLDER_INFO + f"Block counter: {current['_local_id']}\n")
 
-            out_file.write(base * PLACEHOLDER_NODE + (depth - base) * PLACEHOLDER_INFO + f"Triggered compilations/apps: {current['triggered_compilations']}\n")
+            out_file.write(base * PLACEHOLDER_NODE + (depth - base) * PLACEHOLDER_INFO + f"Triggered compilations/apps: {decode_tags(current[TRIGGERED_BITS_FIELD], tags_by_bit)}\n")
             
             out_file.write(base * PLACEHOLDER_NODE + "\n")
             
@@ -85,7 +85,7 @@ class SrcsTrie:
                 queue.put((compile_blocks[child_local_id], depth + 1))
         
 
-    def print_source(self, tabs, out_file, compilation_tags : list[str]):
+    def print_source(self, tabs, out_file, compilation_bits : list[int], tags_by_bit : dict[int, str]):
         complete = True
 
         ans = ""
@@ -105,7 +105,7 @@ class SrcsTrie:
             ans = (tabs - 2) * PLACEHOLDER_NODE + PLACEHOLDER_LEAF + f"{Fore.RED}{self.info['source_path']}:{Fore.RESET}\n" + ans
 
         ans += (tabs - 1) * PLACEHOLDER_NODE + PLACEHOLDER_INFO + "Library: " + self.info["lib"] + "\n"
-        ans += (tabs - 1) * PLACEHOLDER_NODE + PLACEHOLDER_INFO + f"Triggered compilations/apps:{self.info['triggered_compilations']}\n"
+        ans += (tabs - 1) * PLACEHOLDER_NODE + PLACEHOLDER_INFO + f"Triggered compilations/apps:{decode_tags(self.info[TRIGGERED_BITS_FIELD], tags_by_bit)}\n"
                     
         # print the type of source version strategy (git commit hash or sha1 etc.)
         if GitCommitStrategy.version_key in self.info:
@@ -117,9 +117,9 @@ class SrcsTrie:
 
         out_file.write((tabs - 1) * PLACEHOLDER_NODE + PLACEHOLDER_INFO + "Compilation blocks\n")
 
-        self.print_compile_blocks(tabs - 1, tabs, out_file, compilation_tags)
+        self.print_compile_blocks(tabs - 1, tabs, out_file, compilation_bits, tags_by_bit)
 
-    def print_trie(self, out_file, compilation_tags : list[str], tabs = 0):
+    def print_trie(self, out_file, compilation_bits : list[int], tags_by_bit : dict[int, str], tabs = 0):
 
         ans = ""
 
@@ -131,7 +131,7 @@ class SrcsTrie:
             current, depth = queue.get()
 
             if current.path_token[-2:] == ".c":
-                current.print_source(depth + 1, out_file, compilation_tags)
+                current.print_source(depth + 1, out_file, compilation_bits, tags_by_bit)
             else:
                 out_file.write(depth * PLACEHOLDER_NODE + current.path_token + "\n")
 
@@ -0,0 +1,121 @@
+import logging
+import os
+from colorama import Fore
+from storage import get_storage
+
+logger = logging.getLogger(__name__)
+
+# directories never searched for sources, build directories hold generated and copied files
+SKIPPED_DIRECTORIES = {"build", ".git"}
+
+
+def get_source_roots() -> list[str]:
+
+    '''
+    Unikraft core and external libs when they are configured, otherwise the whole workdir.
+    '''
+
+    source_roots = []
+
+    if "UK_ROOT" in os.environ and os.path.isdir(os.environ["UK_ROOT"]):
+        source_roots.append(os.environ["UK_ROOT"])
+
+    if "UK_LIBS" in os.environ and os.path.isdir(os.environ["UK_LIBS"]):
+        source_roots += [os.path.join(os.environ["UK_LIBS"], lib) for lib in sorted(os.listdir(os.environ["UK_LIBS"]))]
+
+    if source_roots == []:
+        source_roots.append(os.environ["UK_WORKDIR"])
+
+    return source_roots
+
+
+def find_local_sources(source_roots : list[str]) -> list[str]:
+
+    '''
+    All C sources under the given roots, as paths relative to UK_WORKDIR like the source_path of the Sources collection.
+    '''
+
+    local_sources = []
+
+    for source_root in source_roots:
+        for dir_path, dir_names, file_names in os.walk(source_root):
+
+            dir_names[:] = [dir_name for dir_name in dir_names if dir_name not in SKIPPED_DIRECTORIES and not dir_name.startswith(".")]
+
+            for file_name in file_names:
+                if file_name.endswith(".c"):
+                    local_sources.append(os.path.relpath(os.path.join(dir_path, file_name), os.environ["UK_WORKDIR"]))
+
+    return local_sources
+
+
+def get_global_status(details : bool) -> dict:
+
+    '''
+    Aggregates what all registered compilations together compiled.
+    A line is compiled if at least one compilation compiled it, so a block counts as soon as any bit of its bitset is set.
+    '''
+
+    return get_storage().get_global_status(details)
+
+
+def write_coverage_line(out, name : str, compiled_lines : int, total_lines : int, extra : str):
+
+    ratio = compiled_lines / total_lines if total_lines != 0 else 0
+
+    color = Fore.GREEN if compiled_lines == total_lines else Fore.RED
+
+    out.write(f"{name}: Compiled: {color}{compiled_lines}{Fore.RESET}, Total: {total_lines}, Ratio: {color}{'{:.2%}'.format(ratio)}{Fore.RESET}, {extra}\n")
+
+
+def status_subcommand(saved_outfile : str, details : bool):
+
+    global_status = get_global_status(details)
+
+    # registered sources every compilation was unbound from are never compiled too
+    compiled_sources = set(global_status["compiled_source_paths"])
+
+    source_roots = get_source_roots()
+    never_compiled_sources = sorted(set(find_local_sources(source_roots)) - compiled_sources)
+
+    libs = global_status["libs"]
+
+    registered_sources = sum(lib["sources"] for lib in libs)
+
+    logger.info(f"{registered_sources} registered sources, {len(compiled_sources)} of them compiled, {len(never_compiled_sources)} local sources never compiled under {source_roots}")
+
+    with open(saved_outfile, "a") as out:
+
+        out.write(f"Compilations: {get_storage().count_compilations()}\n")
+
+        write_coverage_line(
+            out,
+            "All libs",
+            sum(lib["compiled_lines"] for lib in libs),
+            sum(lib["total_lines"] for lib in libs),
+            f"Sources: {registered_sources}, Never triggered blocks: {sum(lib['never_triggered_blocks'] for lib in libs)}/{sum(lib['blocks'] for lib in libs)}"
+        )
+
+        out.write(f"Never compiled sources: {len(never_compiled_sources)}\n")
+
+        out.write("Libs\n")
+        for lib in libs:
+            write_coverage_line(
+                out,
+                f"\t{lib['lib']}",
+                lib["compiled_lines"],
+                lib["total_lines"],
+                f"Sources: {lib['sources']}, Never triggered blocks: {lib['never_triggered_blocks']}/{lib['blocks']}"
+            )
+
+        if not details:
+            return
+
+        out.write("Never compiled sources\n")
+        for source_path in never_compiled_sources:
+            out.write(Fore.RED + f"\t{source_path}\n" + Fore.RESET)
+
+        out.write("Never triggered blocks\n")
+        for source in global_status["never_triggered_block_list"]:
+            for block in source["never_triggered_block_list"]:
+                out.write(f"\t{source['source_path']}:{block['start_line']} " + Fore.RED + block["symbol_condition"] + Fore.RESET + "\n")
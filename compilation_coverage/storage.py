@@ -0,0 +1,306 @@
+from __future__ import annotations
+import os
+import threading
+from abc import ABC, abstractmethod
+from enum import Enum
+from typing import Union
+from helpers import SourceDocument
+
+DEFAULT_MONGO_URI = "mongodb://localhost:27017/"
+
+DEFAULT_SQLITE_PATH = os.path.join(os.path.expanduser("~"), ".local", "share", "unikraft-coverage", "coverage.sqlite")
+
+# number of buffered writes sent to the database at once
+DEFAULT_BATCH_SIZE = 500
+
+# opened by open_storage, every subcommand reaches the database through it
+active_storage : CoverageStorage = None
+
+# set by configure_storage, the database is only opened when a subcommand first needs it
+storage_settings : tuple = None
+storage_lock = threading.Lock()
+
+
+class StorageBackend(Enum):
+    # MongoDB server, shared by many users and concurrent runs
+    MONGO = "mongo"
+    # single file database, no server needed
+    SQLITE = "sqlite"
+
+
+class SourceWriter(ABC):
+
+    '''
+    Buffers the writes of an analysis run, nothing is guaranteed to be stored before flush.
+    Writes of the same source are applied in the order they were queued.
+    '''
+
+    @abstractmethod
+    def queue_new_source(self, source_document : Union[SourceDocument, dict]):
+
+        '''
+        Stores a source that was never registered, with its blocks and compilations.
+        '''
+
+    @abstractmethod
+    def queue_replaced_source(self, source_document : Union[SourceDocument, dict], previous_document : Union[SourceDocument, dict]):
+
+        '''
+        :param source_document: New version of a deprecated source, replaces all its blocks and compilations
+        :param previous_document: Stored version of the source, as prefetched
+        '''
+
+    @abstractmethod
+    def queue_activation(self, source_document : Union[SourceDocument, dict], activated_block_counters : list[int], compilation_tag : str, compilation_bit : int, compiled_lines : int, summary_deltas : dict[tuple, dict[str, int]]):
+
+        '''
+        Adds a compilation to a registered source and to its activated blocks.
+        Must be safe next to other runs registering the same source, nothing is written if another run replaced its version.
+
+        :param summary_deltas: Summary increments of the write, see get_summary_deltas, applied only if the activation is written
+        '''
+
+    @abstractmethod
+    def queue_unbind(self, source_document : Union[SourceDocument, dict], compilation_tag : str, compilation_bit : int):
+
+        '''
+        Removes a compilation from a registered source and from all its blocks, e.g. before app add --update binds it again.
+        '''
+
+    @abstractmethod
+    def queue_summary_increment(self, tag : str, scope : str, key : str, increments : dict[str, int]):
+
+        '''
+        Adds increments to a summary, which is created if it does not exist yet.
+        '''
+
+    @abstractmethod
+    def queue_compile_command(self, compilation_tag : str, source_path : str, lib_name : str, compile_command : str):
+
+        '''
+        Keeps the .o.cmd command the compilation used for a source, so that app refresh can probe the source again without the app.
+        '''
+
+    @abstractmethod
+    def queue_checkpoint(self, compilation_tag : str, source_path : str, lib_name : str, fingerprint : str):
+
+        '''
+        Marks a source of a lib as done by the compilation, queued after the writes of the source so that it is never stored without them.
+
+        :param fingerprint: Identifies the version of the source and how it was compiled, see get_checkpoint_fingerprint
+        '''
+
+    @abstractmethod
+    def queue_dropped_source(self, compilation_tag : str, source_path : str, lib_names : list[str]):
+
+        '''
+        Forgets the checkpoints and the compilation command of a source the compilation no longer compiles.
+
+        :param lib_names: Libs the source has checkpoints for
+        '''
+
+    @abstractmethod
+    def flush(self):
+
+        '''
+        Writes everything that was queued.
+        '''
+
+
+class CoverageStorage(ABC):
+
+    '''
+    Everything the subcommands read from and write to the database.
+    Source documents keep the same shape (see SourceDocument) whatever the backend.
+    '''
+
+    @abstractmethod
+    def ensure_schema(self):
+
+        '''
+        Creates the collections or tables and the indexes the queries need, if they do not exist yet.
+        '''
+
+    @abstractmethod
+    def find_compilation(self, compilation_tag : str) -> Union[dict, None]:
+
+        '''
+        :return: The compilation registered with the tag, None if there is none
+        '''
+
+    @abstractmethod
+    def register_compilation(self, compilation_tag : str, app_workspace : str) -> tuple[object, int]:
+
+        '''
+        :return: Id of the compilation and its bit in the bitsets of the sources and blocks
+        '''
+
+    @abstractmethod
+    def delete_compilation(self, compilation_tag : str):
+
+        '''
+        Removes a compilation and its stored compilation commands, its bit stays in the bitsets but is no longer decoded to a tag.
+        '''
+
+    @abstractmethod
+    def record_source_failure(self, compilation_tag : str, source_path : str, lib_name : str, reason : str):
+
+        '''
+        Keeps in the compilation record why a source could not be analyzed, the analysis goes on with the other sources.
+        '''
+
+    @abstractmethod
+    def get_source_failures(self, compilation_tag : str) -> list[dict]:
+
+        '''
+        :return: source_path, lib and reason of every source that could not be analyzed by the compilation
+        '''
+
+    @abstractmethod
+    def clear_source_failures(self, compilation_tag : str):
+
+        '''
+        Forgets the failures recorded for a compilation, before its sources are analyzed again.
+        '''
+
+    @abstractmethod
+    def get_checkpoints(self, compilation_tag : str) -> dict[tuple[str, str], str]:
+
+        '''
+        :return: (source path, lib) -> fingerprint of every source done by the compilation, as queued by queue_checkpoint
+        '''
+
+    @abstractmethod
+    def count_compilations(self) -> int:
+
+        '''
+        :return: Number of registered compilations
+        '''
+
+    @abstractmethod
+    def get_compilation_bits(self, compilation_tags : list[str] = None) -> dict[str, int]:
+
+        '''
+        :param compilation_tags: Tags to look up, None for all registered compilations
+        :return: tag -> bit
+        '''
+
+    @abstractmethod
+    def prefetch_sources(self, source_paths : list[str]) -> dict[str, Union[SourceDocument, dict]]:
+
+        '''
+        :return: source path -> complete source document, for the registered sources among source_paths
+        '''
+
+    @abstractmethod
+    def get_compile_commands(self, source_paths : list[str]) -> dict[str, dict[str, dict]]:
+
+        '''
+        :return: source path -> compilation tag -> lib and command, as queued by queue_compile_command
+        '''
+
+    @abstractmethod
+    def find_sources_by_bits(self, compilation_bits : list[int]) -> list[Union[SourceDocument, dict]]:
+
+        '''
+        :return: Complete documents of the sources compiled by at least one of the compilations, sorted by source path
+        '''
+
+    @abstractmethod
+    def create_writer(self, batch_size : int, split_threshold : Union[int, None]) -> SourceWriter:
+
+        '''
+        :param batch_size: Number of buffered writes sent to the database at once
+        :param split_threshold: Minimum number of blocks of a source stored with its blocks apart, None keeps every source embedded
+        '''
+
+    @abstractmethod
+    def get_apps_coverage(self) -> list[tuple[str, int, int]]:
+
+        '''
+        :return: (tag, compiled lines, total lines) of every registered compilation in registration order, read from the summaries
+        '''
+
+    @abstractmethod
+    def get_summaries(self, compilation_tags : list[str], scope : str) -> list[dict]:
+
+        '''
+        :return: The summaries of the compilations in a scope, see summaries.py
+        '''
+
+    @abstractmethod
+    def iterate_source_stats(self):
+
+        '''
+        Yields source_path, lib, total_lines and compiled_stats of every source, without its blocks.
+        '''
+
+    @abstractmethod
+    def replace_summaries(self, summaries : list[dict], compilation_tags : list[str] = None):
+
+        '''
+        :param compilation_tags: Only the summaries of these compilations are replaced, None replaces all of them
+        '''
+
+    @abstractmethod
+    def get_global_status(self, details : bool) -> dict:
+
+        '''
+        What all compilations compiled together, a block counts as soon as any compilation triggered it.
+
+        :return: libs (per lib compiled_lines, total_lines, sources, blocks, never_triggered_blocks), compiled_source_paths (an iterable of
+                 the sources at least one compilation is bound to) and, with details, never_triggered_block_list (source_path and its never triggered blocks)
+        '''
+
+    @abstractmethod
+    def migrate(self) -> tuple[int, int]:
+
+        '''
+        Converts data written by older versions of the tool.
+
+        :return: Number of converted compilations and sources
+        '''
+
+
+def open_storage(backend : StorageBackend, location : Union[str, None]) -> CoverageStorage:
+
+    '''
+    :param location: MongoDB URI or SQLite file path, None for the default of the backend
+    '''
+
+    global active_storage
+
+    if backend == StorageBackend.SQLITE:
+        from sqlite_storage import SQLiteStorage
+        active_storage = SQLiteStorage(location if location != None else DEFAULT_SQLITE_PATH)
+    else:
+        from mongo_storage import MongoStorage
+        active_storage = MongoStorage(location if location != None else DEFAULT_MONGO_URI)
+
+    return active_storage
+
+
+def configure_storage(backend : StorageBackend, location : Union[str, None]):
+
+    global storage_settings, active_storage
+
+    storage_settings = (backend, location)
+    active_storage = None
+
+
+def get_storage() -> CoverageStorage:
+
+    '''
+    Opens the configured storage and ensures its schema on first use.
+    '''
+
+    with storage_lock:
+
+        if active_storage == None:
+
+            if storage_settings == None:
+                raise RuntimeError("No storage has been configured")
+
+            open_storage(*storage_settings).ensure_schema()
+
+        return active_storage
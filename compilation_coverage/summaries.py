@@ -0,0 +1,156 @@
+import logging
+import os
+from colorama import Fore
+from typing import Union
+from helpers import SourceDocument
+from storage import get_storage
+
+logger = logging.getLogger(__name__)
+
+# whole compilation, one summary per compilation tag
+TOTAL_SCOPE = "total"
+
+# one summary per lib of the sources
+LIB_SCOPE = "lib"
+
+# one summary per directory that contains sources, at every depth, paths relative to UK_WORKDIR
+DIR_SCOPE = "dir"
+
+SUMMARY_KEY_FIELDS = ["tag", "scope", "key"]
+
+
+def get_source_directories(source_path : str) -> list[str]:
+
+    '''
+    lib/foo/bar.c -> [lib, lib/foo]
+    '''
+
+    directories = []
+
+    directory = os.path.dirname(source_path)
+    while directory != "":
+        directories.append(directory)
+        directory = os.path.dirname(directory)
+
+    return directories
+
+
+def get_summary_contributions(source_document : Union[SourceDocument, dict, None]) -> dict[tuple, list[int]]:
+
+    '''
+    What a source adds to the summaries of every compilation that triggered it.
+
+    :return: (tag, scope, key) -> [compiled lines, total lines, sources]
+    '''
+
+    contributions : dict[tuple, list[int]] = {}
+
+    if source_document == None:
+        return contributions
+
+    scopes = [(TOTAL_SCOPE, ""), (LIB_SCOPE, source_document["lib"])]
+    scopes += [(DIR_SCOPE, directory) for directory in get_source_directories(source_document["source_path"])]
+
+    for tag, compiled_lines in source_document["compiled_stats"].items():
+        for scope, key in scopes:
+            contributions[(tag, scope, key)] = [compiled_lines, source_document["total_lines"], 1]
+
+    return contributions
+
+
+def get_summary_deltas(previous_contributions : dict[tuple, list[int]], current_document : Union[SourceDocument, dict]) -> dict[tuple, dict[str, int]]:
+
+    '''
+    Difference between the old and new version of a source document, only for the summaries that actually change.
+
+    :param previous_contributions: Contributions of the document before the write, taken before it is changed in memory
+    :param current_document: Document after the write
+    :return: (tag, scope, key) -> field -> value added to the summary
+    '''
+
+    current_contributions = get_summary_contributions(current_document)
+
+    summary_deltas = {}
+
+    for summary_key in previous_contributions.keys() | current_contributions.keys():
+
+        previous = previous_contributions.get(summary_key, [0, 0, 0])
+        current = current_contributions.get(summary_key, [0, 0, 0])
+
+        if previous == current:
+            continue
+
+        summary_deltas[summary_key] = {
+            "compiled_lines" : current[0] - previous[0],
+            "total_lines" : current[1] - previous[1],
+            "sources" : current[2] - previous[2]
+        }
+
+    return summary_deltas
+
+
+def queue_summary_deltas(writer, previous_contributions : dict[tuple, list[int]], current_document : Union[SourceDocument, dict]):
+
+    '''
+    Queues summary increments for the difference between the old and new version of a source document, see get_summary_deltas.
+    The writer merges increments of the same summary within a batch.
+
+    :param writer: SourceWriter of the analysis
+    '''
+
+    for (tag, scope, key), increments in get_summary_deltas(previous_contributions, current_document).items():
+        writer.queue_summary_increment(tag, scope, key, increments)
+
+
+def get_compilation_summaries(compilation_tags : list[str], scope : str) -> list[dict]:
+
+    return get_storage().get_summaries(compilation_tags, scope)
+
+
+def rebuild_summaries(compilation_tags : list[str] = None) -> int:
+
+    '''
+    Recomputes summaries from the sources, only the per source stats are read, never the compile blocks.
+
+    :param compilation_tags: Compilations whose summaries are recomputed, None for all of them
+    :return: Number of summaries written
+    '''
+
+    summaries : dict[tuple, list[int]] = {}
+
+    for source_document in get_storage().iterate_source_stats():
+        for summary_key, contribution in get_summary_contributions(source_document).items():
+
+            if compilation_tags != None and summary_key[0] not in compilation_tags:
+                continue
+
+            summary = summaries.setdefault(summary_key, [0, 0, 0])
+            for i in range(len(summary)):
+                summary[i] += contribution[i]
+
+    get_storage().replace_summaries(
+        [
+            {
+                "tag" : tag,
+                "scope" : scope,
+                "key" : key,
+                "compiled_lines" : compiled_lines,
+                "total_lines" : total_lines,
+                "sources" : sources
+            }
+            for (tag, scope, key), (compiled_lines, total_lines, sources) in summaries.items()
+        ],
+        compilation_tags
+    )
+
+    return len(summaries)
+
+
+def rebuild_summaries_subcommand(saved_outfile : str):
+
+    rebuilt_summaries = rebuild_summaries()
+
+    logger.info(f"Rebuilt {rebuilt_summaries} summaries")
+
+    with open(saved_outfile, "a") as out:
+        out.write(Fore.GREEN + f"Rebuilt {rebuilt_summaries} summaries\n" + Fore.RESET)
@@ -1,79 +1,105 @@
 from __future__ import annotations
+import bisect
 import logging
 import os
 from dataclasses import dataclass
 import re
-from helpers import CompilationBlock, remove_comments
+from helpers import CompilationBlock
 from typing import Union
 
+# bump whenever the parser may find different blocks for the same source, cached parses of older versions are then ignored
+PARSER_VERSION = 2
+
+# a directive line, anchored at the start of a line, whitespace is allowed around the # and the directive must be a whole word
+DIRECTIVE_REGEX = re.compile(r"^[ \t\f\v]*#[ \t]*(ifdef|ifndef|if|elifdef|elifndef|elif|else|endif)\b(.*)$", re.MULTILINE)
+
+# empty or whitespace only line after the first one, starting with a literal keeps the search fast
+BLANK_LINE_REGEX = re.compile(r"\n[ \t\f\v\r]*(?=\n)")
+
+# directives that open a new block or a new branch of the innermost block
+OPENING_DIRECTIVES = {"if", "ifdef", "ifndef"}
+BRANCH_DIRECTIVES = {"elif", "elifdef", "elifndef", "else"}
+
+# directives whose condition is negated, #ifndef X is the block of !(X)
+NEGATED_DIRECTIVES = {"ifndef", "elifndef"}
 
 def find_children(total_blocks : list[CompilationBlock]):
 
     '''
-    Builds the compilation block hierarchy by adding children for all nodes
+    Builds the compilation block hierarchy by adding children for all nodes, in a single pass over an index of the blocks by counter.
+    Children are added in the order of total_blocks, which is sorted by counter after a parse.
 
     :param total_blocks: All compilation blocks found out by the symbol_engine, do not use on triggered ones.
     '''
 
-    for i in range(len(total_blocks) - 1):
+    blocks_by_counter = {block.block_counter : block for block in total_blocks}
+
+    for block in total_blocks:
+        parent = blocks_by_counter.get(block.parent_counter)
 
-        for j in range(i + 1, len(total_blocks)):
-            if total_blocks[i].block_counter == total_blocks[j].parent_counter:
-                total_blocks[i].children.append(total_blocks[j].block_counter)
+        if parent != None:
+            parent.children.append(block.block_counter)
     return
 
 
-def get_full_symbol_condition(start_line : int, lines : list[str]) -> tuple[str, int]:
+def get_full_symbol_condition(condition : str, condition_end : int, text : str) -> tuple[str, int]:
 
-    i = start_line
+    '''
+    Joins the condition of a directive with its backslash continuation lines, tokens are separated by a single space.
 
-    # first line, get rid of #ifdef, #ifndef or #if
-    tokens = lines[i].split()[1:]
+    :param condition: Text after the directive keyword on its first line
+    :param condition_end: Offset of the end of the first line in text
+    :return: Full symbol condition and the offset of the first line after the directive
+    '''
 
-    full_tokens = []
+    condition = condition.rstrip()
 
-    # first line is start of multiline
-    if tokens[-1] == "\\":
+    # most directives fit on one line
+    if not condition.endswith("\\"):
+        return " ".join(condition.split()), condition_end + 1
 
-        # parse first line if it is start of multiline or other lines if they are multiline symbol condition
-        while tokens[-1] == "\\":
-            for t in tokens[ : -1]:
-                full_tokens.append(t)
-            
-            i += 1
+    pieces = []
 
-            tokens = lines[i].split()
+    while condition.endswith("\\") and condition_end + 1 < len(text):
+        pieces.append(condition[ : -1])
 
-    # parse final line or first line if it is not multiline
-    for t in tokens:
-        full_tokens.append(t)
+        line_start = condition_end + 1
+        condition_end = text.find("\n", line_start)
+        condition = text[line_start : condition_end].rstrip()
 
-    # get the symbol condition
-    full_condition = ""
-    for tok in full_tokens:
-        full_condition += tok
-        full_condition += " "
-            
-    # remove last white space left by the previous for
-    full_condition = full_condition[ : -1]
+    pieces.append(condition.rstrip("\\"))
 
-    return full_condition, i + 1
+    return " ".join(" ".join(pieces).split()), condition_end + 1
 
-    
-    
 
+def find_compilation_blocks_and_lines(text : str) -> tuple[list[CompilationBlock], int]:
 
-def find_compilation_blocks_and_lines(cpy_src : str) -> tuple[list[CompilationBlock], int]:
+    '''
+    Finds the conditional compilation blocks of a source in a single regex pass over its directive lines,
+    Python code only runs for directives, never for the lines in between.
+    Lines of code are non blank lines, they count for the innermost open block or for the universal lines.
+
+    :param text: Comment free text of the source, see SourceBuffer
+    :return: Blocks sorted by their counter and the number of lines outside of any block
+    '''
 
     logger = logging.getLogger(__name__)
+    debug = logger.isEnabledFor(logging.DEBUG)
 
-    remove_comments(cpy_src)
-    
-    src_fd = open(cpy_src, 'r')
+    # every line ends with a new line, so lines between two offsets are counted with str.count
+    if not text.endswith("\n"):
+        text += "\n"
 
-    lines = src_fd.readlines()
+    # offsets of the new lines that end blank lines
+    blank_line_ends = [blank_match.end() for blank_match in BLANK_LINE_REGEX.finditer(text)]
+    if text[ : text.find("\n")].isspace() or text.startswith("\n"):
+        blank_line_ends.insert(0, text.find("\n"))
 
-    nested_directives = []
+    def count_code_lines(start : int, end : int) -> int:
+        return text.count("\n", start, end) - (bisect.bisect_left(blank_line_ends, end) - bisect.bisect_left(blank_line_ends, start))
+
+    # one list per open #if, with the blocks of all its branches so far
+    nested_directives : list[list[CompilationBlock]] = []
 
     parsed_compilation_blocks = []
 
@@ -81,130 +107,106 @@ def find_compilation_blocks_and_lines(cpy_src : str) -> tuple[list[CompilationBl
 
     universal_lines = 0
 
-    i = 0
+    # lines of code of the innermost open branch, stored in the block when the branch ends
+    branch_lines = 0
 
-    while i < len(lines):
-        
-        if (lines[i].find("#ifdef") != -1 or lines[i].find("#if") != -1 or lines[i].find("#ifndef") != -1):
+    # the text before this offset is accounted for, line_idx is the index of the line it starts
+    scanned_offset = 0
+    line_idx = 0
 
-            current_condition, line_idx_after_condition = get_full_symbol_condition(i, lines)
+    for directive_match in DIRECTIVE_REGEX.finditer(text):
 
-            if lines[i].find("#ifndef") != -1:
-                current_condition = "!(" + current_condition + ")"
+        directive_start = directive_match.start()
 
-            # default value for a block if it does not have a parent block
-            parent = -1
+        # a line of a multiline condition that looks like a directive
+        if directive_start < scanned_offset:
+            continue
 
-            # the current #ifdef is not nested, so no parent
-            # create a new sublist in the nested_blocks list
-            # the end_line is not known yet
-            if len(nested_directives) == 0:
-                nested_directives.append([CompilationBlock(
-                    {
-                    "symbol_condition" : current_condition,
-                    "start_line" : i + 1,
-                    "end_line" : i,
-                    "_local_id" : global_counter,
-                    "_parent_id" : -1,
-                    "lines" :0
-                    })])
-            
-            # the current #ifdef is nested, this means that we need to create a new sublist in the nested_blocks list
-            # the parent is the first element in the previous sublist (a previous #ifdef or #ifndef or #if which we didnt parse their #endif yet)
-            # the end_line is not known yet
+        code_lines = count_code_lines(scanned_offset, directive_start)
+        if nested_directives:
+            branch_lines += code_lines
+        else:
+            universal_lines += code_lines
+
+        line_idx += text.count("\n", scanned_offset, directive_start)
+        scanned_offset = directive_match.end() + 1
+
+        directive, condition = directive_match.groups()
+
+        if directive in OPENING_DIRECTIVES or (directive in BRANCH_DIRECTIVES and nested_directives):
+
+            if directive == "else":
+                current_condition = "!(" + nested_directives[-1][-1].symbol_condition + ")"
             else:
-                parent = nested_directives[-1][0].block_counter
-                nested_directives.append([CompilationBlock(
-                    {
-                    "symbol_condition" : current_condition,
-                    "start_line" : i + 1, 
-                    "end_line" : i,
-                    "_local_id" : global_counter,
-                    "_parent_id" : parent,
-                    "lines" : 0
-                    })])
-
-            logger.debug(f"Found a conditional compilation block starting at line {i + 1} with local counter {global_counter} and parent counter {parent}")
-            global_counter += 1
-            
-            # jump 1 line if its only 1 line of symbol condition else multiple lines if its multiline
-            i = line_idx_after_condition
-            continue
+                current_condition, scanned_offset = get_full_symbol_condition(condition, directive_match.end(), text)
 
-        elif (lines[i].find("#elif") != -1 or lines[i].find("#else") != -1):
-            
-            # only #elif may have multiline symbol condition 
-            if lines[i].find("#elif") != -1:
-                current_condition, line_idx_after_condition = get_full_symbol_condition(i, lines)
-            
-            # this is for #else
+                if directive in NEGATED_DIRECTIVES:
+                    current_condition = "!(" + current_condition + ")"
+
+            # the parent of a branch is the parent of the #if that opened it, the parent of a new #if is the innermost open block
+            if directive in OPENING_DIRECTIVES:
+                parent = nested_directives[-1][0].block_counter if nested_directives else -1
             else:
-                line_idx_after_condition = i + 1
-                current_condition = "!(" + nested_directives[-1][-1].symbol_condition + ")"
+                # close the previous branch of the same #if
+                previous_branch = nested_directives[-1][-1]
+                previous_branch.end_line = line_idx + 1
+                previous_branch.lines = branch_lines
+                parent = nested_directives[-1][0].parent_counter
 
-            # since its an #elif, we need to close (specify the end_line) the previous block in the same sublist as this #elif
-            nested_directives[-1][-1].end_line = i + 1
-            logger.debug(f"Ending a conditional compilation block starting at {nested_directives[-1][-1].start_line}, ending at {nested_directives[-1][-1].end_line} with local counter {nested_directives[-1][-1].block_counter}")
+                if debug:
+                    logger.debug(f"Ending a conditional compilation block starting at {previous_branch.start_line}, ending at {previous_branch.end_line} with local counter {previous_branch.block_counter}")
 
-            # the parent of this #elif is the same parent as the first element in the sublist which is a #if, #ifdef or #ifndef
             # the end_line is not known yet
-            parent = nested_directives[-1][0].parent_counter
-            nested_directives[-1].append(CompilationBlock(
+            compile_block = CompilationBlock(
                 {
-                "symbol_condition" : current_condition, 
-                "start_line" : i + 1,
-                "end_line" :i,
+                "symbol_condition" : current_condition,
+                "start_line" : line_idx + 1,
+                "end_line" : line_idx,
                 "_local_id" : global_counter,
                 "_parent_id" : parent,
                 "lines" : 0
-                }))
+                })
 
-            logger.debug(f"Found conditional compilation block starting at line {i + 1} with local counter {global_counter} and parent counter {parent}")
-            global_counter += 1
+            if directive in OPENING_DIRECTIVES:
+                # lines of the enclosing branch so far are kept in its block until it resumes
+                if nested_directives:
+                    nested_directives[-1][-1].lines = branch_lines
+                nested_directives.append([compile_block])
+            else:
+                nested_directives[-1].append(compile_block)
 
-            i = line_idx_after_condition
-            continue
+            branch_lines = 0
 
-        elif lines[i].find("#endif") != -1:
+            if debug:
+                logger.debug(f"Found a conditional compilation block starting at line {line_idx + 1} with local counter {global_counter} and parent counter {parent}")
+
+            global_counter += 1
+
+        elif directive == "endif" and nested_directives:
 
             ending_block = nested_directives[-1][-1]
-            ending_block.end_line = i + 1
-            logger.debug(f"Ending a conditional compilation block starting at {ending_block.start_line}, ending at {ending_block.end_line} with local counter {ending_block.block_counter}")
-            
-            for branch_block in nested_directives[-1]:
-                parsed_compilation_blocks.append(branch_block)
-
-            nested_directives.pop()
-            
-            # we just increment the line since #endif does not have multiline scenarios
-            i += 1
-            continue
-        
-        # its a line which might contain code
-        elif lines[i].split() != []:
-            
-
-            # we still have a unparsed compile block, so the line should be added in its scope not in the global one
-            if len(nested_directives) > 0:
-                nested_directives[-1][-1].lines += 1
-            else:
-                universal_lines += 1
+            ending_block.end_line = line_idx + 1
+            ending_block.lines = branch_lines
+
+            if debug:
+                logger.debug(f"Ending a conditional compilation block starting at {ending_block.start_line}, ending at {ending_block.end_line} with local counter {ending_block.block_counter}")
+
+            parsed_compilation_blocks.extend(nested_directives.pop())
+
+            # the enclosing branch resumes counting its lines
+            branch_lines = nested_directives[-1][-1].lines if nested_directives else 0
 
-            i += 1
-            continue
-        
-        # this is a empty whitespace line
         else:
-            i += 1
+            logger.warning(f"Unbalanced #{directive} at line {line_idx + 1}, ignoring it")
 
+        # the directive and its continuation lines are not lines of code
+        line_idx += text.count("\n", directive_start, scanned_offset)
 
-    src_fd.close()
+    code_lines = count_code_lines(scanned_offset, len(text))
+    if nested_directives:
+        branch_lines += code_lines
+    else:
+        universal_lines += code_lines
 
     parsed_compilation_blocks.sort(key = lambda cb : cb.block_counter)
     return (parsed_compilation_blocks, universal_lines)
-
-            
-            
-                
-                
-
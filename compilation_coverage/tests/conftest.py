@@ -0,0 +1,72 @@
+import os
+import sys
+import pytest
+
+# the modules of the tool import each other by their bare names
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import StorageBackend, configure_storage, get_storage
+
+# throwaway MongoDB server for the storage tests, its coverage database is dropped by every test
+# CI runs one as a service container, see .github/workflows/compilation-coverage-tests.yaml, the MongoDB tests are skipped without it
+MONGO_URI_VARIABLE = "COVERAGE_TEST_MONGO_URI"
+
+
+@pytest.fixture(params=[StorageBackend.SQLITE, StorageBackend.MONGO], ids=lambda backend : backend.value)
+def storage(request, tmp_path):
+
+    if request.param == StorageBackend.SQLITE:
+        configure_storage(StorageBackend.SQLITE, str(tmp_path / "coverage.sqlite"))
+        yield get_storage()
+        return
+
+    if os.environ.get(MONGO_URI_VARIABLE) == None:
+        pytest.skip(f"{MONGO_URI_VARIABLE} is not set")
+
+    import pymongo
+    from mongo_storage import DATABASE
+
+    client = pymongo.MongoClient(os.environ[MONGO_URI_VARIABLE])
+    client.drop_database(DATABASE)
+
+    configure_storage(StorageBackend.MONGO, os.environ[MONGO_URI_VARIABLE])
+    yield get_storage()
+
+    client.drop_database(DATABASE)
+
+
+@pytest.fixture
+def probe_scheduler():
+
+    from probe_scheduler import ProbeScheduler
+
+    with ProbeScheduler(max_probes=1) as scheduler:
+        yield scheduler
+
+
+def make_block(local_id : int, parent_id : int, lines : int, children : list[int] = None) -> dict:
+
+    return {
+        "_local_id" : local_id,
+        "_parent_id" : parent_id,
+        "symbol_condition" : f"CONFIG_{local_id}",
+        "start_line" : local_id * 10 + 1,
+        "end_line" : local_id * 10 + lines + 2,
+        "lines" : lines,
+        "children" : children if children != None else [],
+        "triggered_bits" : {}
+    }
+
+
+def make_source_document(source_path : str, lib_name : str, blocks : list[dict], universal_lines : int = 10, commit_id : str = "c0ffee") -> dict:
+
+    return {
+        "source_path" : source_path,
+        "compile_blocks" : blocks,
+        "universal_lines" : universal_lines,
+        "triggered_bits" : {},
+        "compiled_stats" : {},
+        "total_lines" : universal_lines + sum(block["lines"] for block in blocks),
+        "lib" : lib_name,
+        "git_commit_id" : commit_id
+    }
@@ -0,0 +1,421 @@
+import os
+import subprocess
+import threading
+import time
+import pytest
+import add_app
+import sqlite_storage
+from types import SimpleNamespace
+from bson.int64 import Int64
+from add_app import AnalysisOptions, ActivationEngine, InstrumentationMode, SourceStatus, analyze_application_sources, analyze_source_compile_coverage, get_source_lock
+from add_app import RegistrationMode, add_app_subcommand, update_db_activated_compile_blocks
+from storage import StorageBackend, configure_storage, get_storage
+from summaries import TOTAL_SCOPE, LIB_SCOPE, DIR_SCOPE, get_summary_contributions
+
+
+@pytest.fixture
+def print_srcs_app(tmp_path, monkeypatch):
+
+    '''
+    App whose make print-srcs lists three sources of libfoo and two of libbar, the headers and assembly files are skipped.
+    None of them is registered yet, in an empty SQLite database.
+    '''
+
+    monkeypatch.setenv("UK_WORKDIR", "/w")
+    configure_storage(StorageBackend.SQLITE, str(tmp_path / "coverage.sqlite"))
+
+    app_path = tmp_path / "app"
+    app_path.mkdir()
+
+    (app_path / "Makefile").write_text(
+        "print-srcs:\n"
+        "\t@echo \"libfoo:\"\n"
+        "\t@echo \"  /w/lib/foo/a.c|foo /w/lib/foo/b.c /w/lib/foo/foo.h /w/lib/foo/c.c\"\n"
+        "\t@echo \"libbar:\"\n"
+        "\t@echo \"  /w/lib/bar/a.c /w/lib/bar/entry.S /w/lib/bar/d.c|bar\"\n"
+    )
+
+    return str(app_path)
+
+
+APP_SOURCES = [
+    ("libfoo", "/w/lib/foo/a.c"),
+    ("libfoo", "/w/lib/foo/b.c"),
+    ("libfoo", "/w/lib/foo/c.c"),
+    ("libbar", "/w/lib/bar/a.c"),
+    ("libbar", "/w/lib/bar/d.c")
+]
+
+
+def record_analyzed_sources(monkeypatch, delay : float = 0) -> tuple[list, list]:
+
+    '''
+    Replaces the analysis of a source, records the analyzed sources and how many ran at the same time.
+    '''
+
+    analyzed = []
+    running = [0, 0]
+    lock = threading.Lock()
+
+    def get_source_compile_coverage(compilation_tag, lib_name, app_build_dir, src_path, options):
+
+        with lock:
+            analyzed.append((lib_name, src_path))
+            running[0] += 1
+            running[1] = max(running[1], running[0])
+
+        time.sleep(delay)
+
+        with lock:
+            running[0] -= 1
+
+    monkeypatch.setattr(add_app, "get_source_compile_coverage", get_source_compile_coverage)
+
+    return analyzed, running
+
+
+def test_serial_analysis_follows_print_srcs(print_srcs_app, monkeypatch):
+
+    analyzed, running = record_analyzed_sources(monkeypatch)
+
+    analyze_application_sources("tag", "build", print_srcs_app, AnalysisOptions(jobs=1))
+
+    assert analyzed == APP_SOURCES
+    assert running[1] == 1
+
+
+def test_parallel_analysis_visits_every_source_once(print_srcs_app, monkeypatch):
+
+    analyzed, running = record_analyzed_sources(monkeypatch, delay=0.2)
+
+    analyze_application_sources("tag", "build", print_srcs_app, AnalysisOptions(jobs=3))
+
+    assert sorted(analyzed) == sorted(APP_SOURCES)
+    assert running[1] == 3
+
+
+def test_parallel_analysis_propagates_failures(print_srcs_app, monkeypatch):
+
+    def get_source_compile_coverage(compilation_tag, lib_name, app_build_dir, src_path, options):
+        if src_path.endswith("d.c"):
+            raise RuntimeError(src_path)
+
+    monkeypatch.setattr(add_app, "get_source_compile_coverage", get_source_compile_coverage)
+
+    with pytest.raises(RuntimeError, match="d.c"):
+        analyze_application_sources("tag", "build", print_srcs_app, AnalysisOptions(jobs=3))
+
+
+def test_source_lock_per_real_path():
+
+    assert get_source_lock("/w/lib/foo/a.c") is get_source_lock("/w/lib/foo/a.c")
+    assert get_source_lock("/w/lib/foo/a.c") is not get_source_lock("/w/lib/bar/a.c")
+
+
+def replace_instrumentation(monkeypatch, error : Exception = None) -> list:
+
+    '''
+    Replaces the instrumentation and compilation of a source by a write to the file that would be instrumented.
+    '''
+
+    instrumented_paths = []
+
+    def instrument_and_trigger_source(compilation_tag, lib_name, app_build_dir, src_path, real_src_path, instrumented_src_path, options):
+
+        instrumented_paths.append(instrumented_src_path)
+
+        with open(instrumented_src_path, "a") as instrumented_src:
+            instrumented_src.write("#warning COMPILATION_COVERAGE_0\n")
+
+        if error != None:
+            raise error
+
+    monkeypatch.setattr(add_app, "instrument_and_trigger_source", instrument_and_trigger_source)
+
+    return instrumented_paths
+
+
+def test_out_of_tree_instrumentation_never_writes_the_source(tmp_path, monkeypatch):
+
+    source_path = tmp_path / "lib" / "a.c"
+    source_path.parent.mkdir()
+    source_path.write_text("int a;\n")
+
+    scratch_dir = tmp_path / "scratch"
+    scratch_dir.mkdir()
+
+    instrumented_paths = replace_instrumentation(monkeypatch)
+
+    options = AnalysisOptions(instrumentation=InstrumentationMode.OUT_OF_TREE, scratch_dir=str(scratch_dir))
+    analyze_source_compile_coverage("tag", "libfoo", str(tmp_path / "build"), str(source_path), str(source_path), options)
+
+    # the copy had its own directory in the scratch directory, removed with it
+    assert os.path.dirname(os.path.dirname(instrumented_paths[0])) == str(scratch_dir)
+    assert os.path.basename(instrumented_paths[0]) == "a.c"
+    assert os.listdir(scratch_dir) == []
+
+    assert source_path.read_text() == "int a;\n"
+    assert not (tmp_path / "build").exists()
+
+
+def test_in_place_instrumentation_restores_the_source_after_a_failure(tmp_path, monkeypatch):
+
+    source_path = tmp_path / "workdir" / "lib" / "a.c"
+    source_path.parent.mkdir(parents=True)
+    source_path.write_text("int a;\n")
+
+    monkeypatch.setenv("UK_WORKDIR", str(tmp_path / "workdir"))
+
+    instrumented_paths = replace_instrumentation(monkeypatch, RuntimeError("compiler crashed"))
+
+    with pytest.raises(RuntimeError):
+        analyze_source_compile_coverage("tag", "libfoo", str(tmp_path / "build"), str(source_path), str(source_path), AnalysisOptions())
+
+    assert instrumented_paths == [str(source_path)]
+    assert source_path.read_text() == "int a;\n"
+
+    # the backup mirrors the path relative to the workdir
+    assert (tmp_path / "build" / "srcs" / "lib" / "a.c").read_text() == "int a;\n"
+
+
+def make_registered_source() -> dict:
+
+    return {
+        "source_path" : "lib/foo/a.c",
+        "git_commit_id" : "c0ffee",
+        "lib" : "libfoo",
+        "universal_lines" : 10,
+        "total_lines" : 17,
+        "triggered_bits" : {"0" : Int64(1)},
+        "compiled_stats" : {"tag-a" : 14},
+        "compile_blocks" : [
+            {"_local_id" : 0, "_parent_id" : -1, "symbol_condition" : "CONFIG_A", "start_line" : 1, "end_line" : 6, "lines" : 4, "children" : [], "triggered_bits" : {"0" : Int64(1)}},
+            {"_local_id" : 1, "_parent_id" : -1, "symbol_condition" : "CONFIG_B", "start_line" : 7, "end_line" : 11, "lines" : 3, "children" : [], "triggered_bits" : {}}
+        ]
+    }
+
+
+def test_activation_of_a_registered_source_queues_its_summary_deltas():
+
+    activations = []
+    options = AnalysisOptions(compilation_bit=1, writer=SimpleNamespace(
+        queue_activation= lambda *arguments : activations.append(arguments)
+    ))
+
+    source_document = make_registered_source()
+
+    for _ in range(2):
+        update_db_activated_compile_blocks(SourceStatus.EXISTING, source_document, None, get_summary_contributions(source_document), [1, 0, 1], "tag-b", options)
+
+    # bound twice, applied once
+    assert source_document["triggered_bits"] == {"0" : 3}
+    assert [block["triggered_bits"] for block in source_document["compile_blocks"]] == [{"0" : 3}, {"0" : 2}]
+    assert source_document["compiled_stats"] == {"tag-a" : 14, "tag-b" : 17}
+
+    _, activated_block_counters, compilation_tag, compilation_bit, compiled_lines, summary_deltas = activations[0]
+    assert (activated_block_counters, compilation_tag, compilation_bit, compiled_lines) == ([0, 1], "tag-b", 1, 17)
+
+    # the summaries of tag-b only grow by the first registration
+    increments = {"compiled_lines" : 17, "total_lines" : 17, "sources" : 1}
+    assert summary_deltas == {
+        ("tag-b", "total", "") : increments,
+        ("tag-b", "lib", "libfoo") : increments,
+        ("tag-b", "dir", "lib/foo") : increments,
+        ("tag-b", "dir", "lib") : increments
+    }
+    assert activations[1][5] == {}
+
+
+SOURCES = {
+    "lib/foo/foo.h" : "#define FOO 1\n",
+    "lib/foo/a.c" : "#include \"foo.h\"\n#ifdef CONFIG_A\nint a1;\n#else\nint a2;\n#endif\nint main(void) { return FOO; }\n",
+    "lib/foo/b.c" : "#if CONFIG_B && FOO\nint b1;\n# ifdef CONFIG_A\nint b2;\n# endif\n#endif\nint g;\n"
+}
+
+
+class SimulatedCrash(BaseException):
+    pass
+
+
+@pytest.fixture
+def app_tree(tmp_path, monkeypatch):
+
+    '''
+    Workdir with a lib of two sources in a git repository and an app built with -DCONFIG_A -DCONFIG_B.
+    '''
+
+    workdir = tmp_path / "workdir"
+
+    for source_path, text in SOURCES.items():
+        (workdir / source_path).parent.mkdir(parents=True, exist_ok=True)
+        (workdir / source_path).write_text(text)
+
+    subprocess.run(["git", "init", "-q", str(workdir)], check=True)
+    subprocess.run(["git", "-C", str(workdir), "add", "lib"], check=True)
+    subprocess.run(["git", "-C", str(workdir), "-c", "user.name=test", "-c", "user.email=test@test", "commit", "-q", "-m", "lib"], check=True)
+
+    app_path = workdir / "app"
+    build_dir = app_path / "build"
+    (build_dir / "libfoo").mkdir(parents=True)
+
+    (app_path / "Makefile").write_text(f"print-srcs:\n\t@echo \"libfoo:\"\n\t@echo \"  {workdir}/lib/foo/a.c|foo {workdir}/lib/foo/b.c\"\n")
+
+    for name in ["a", "b"]:
+        (build_dir / "libfoo" / f"{name}.o.cmd").write_text(
+            f"$ gcc -Wp,-MD,{build_dir}/libfoo/.{name}.o.d -DCONFIG_A -DCONFIG_B -c {workdir}/lib/foo/{name}.c -o {build_dir}/libfoo/{name}.o\n"
+        )
+
+    monkeypatch.setenv("UK_WORKDIR", str(workdir))
+
+    return str(app_path), str(build_dir)
+
+
+def get_compilation_state(compilation_tag : str) -> tuple:
+
+    storage = get_storage()
+
+    summaries = [storage.get_summaries([compilation_tag], scope) for scope in [TOTAL_SCOPE, LIB_SCOPE, DIR_SCOPE]]
+
+    source_documents = storage.prefetch_sources(["lib/foo/a.c", "lib/foo/b.c"])
+
+    return summaries, source_documents, storage.get_checkpoints(compilation_tag), storage.get_apps_coverage()
+
+
+def crash_during_flush(monkeypatch):
+
+    '''
+    The next flush stores the sources and then dies, like a MongoDB run killed between the bulk writes of the collections of a batch:
+    the summary increments and the checkpoints of the batch are lost. Flushes after the crash write nothing.
+    '''
+
+    crashed = []
+
+    def flush(writer):
+
+        with writer.queue_lock:
+            writes = writer.pending_writes
+            writer.pending_writes = []
+            writer.pending_increments = {}
+
+        if crashed != []:
+            return
+
+        crashed.append(True)
+
+        with writer.storage.transaction() as cursor:
+            for write, rows in writes:
+                if write == sqlite_storage.write_checkpoint:
+                    continue
+                if write == sqlite_storage.write_activation:
+                    rows = (*rows[:-1], [])
+                write(cursor, *rows)
+
+        raise SimulatedCrash()
+
+    monkeypatch.setattr(sqlite_storage.SQLiteSourceWriter, "flush", flush)
+
+
+def test_resume_after_crash_mid_batch(app_tree, tmp_path, monkeypatch):
+
+    app_path, build_dir = app_tree
+
+    configure_storage(StorageBackend.SQLITE, str(tmp_path / "clean.sqlite"))
+    add_app_subcommand(app_path, build_dir, "app-a", AnalysisOptions())
+    expected_state = get_compilation_state("app-a")
+
+    configure_storage(StorageBackend.SQLITE, str(tmp_path / "crashed.sqlite"))
+
+    with monkeypatch.context() as crash:
+        crash_during_flush(crash)
+
+        with pytest.raises(SimulatedCrash):
+            add_app_subcommand(app_path, build_dir, "app-a", AnalysisOptions())
+
+    # the sources are stored, but neither their summaries nor their checkpoints
+    summaries, source_documents, checkpoints, _ = get_compilation_state("app-a")
+
+    assert summaries == [[], [], []]
+    assert source_documents == expected_state[1]
+    assert checkpoints == {}
+
+    add_app_subcommand(app_path, build_dir, "app-a", AnalysisOptions(registration=RegistrationMode.RESUME))
+
+    assert get_compilation_state("app-a") == expected_state
+
+
+def test_resume_after_crash_between_sources(app_tree, tmp_path, monkeypatch):
+
+    app_path, build_dir = app_tree
+
+    configure_storage(StorageBackend.SQLITE, str(tmp_path / "clean.sqlite"))
+    add_app_subcommand(app_path, build_dir, "app-a", AnalysisOptions())
+    expected_state = get_compilation_state("app-a")
+
+    configure_storage(StorageBackend.SQLITE, str(tmp_path / "crashed.sqlite"))
+
+    activated_sources = []
+    real_get_activated_blocks = add_app.get_activated_blocks
+
+    # the first source is flushed on its own, the run dies while probing the second one
+    def get_activated_blocks(*args, **kwargs):
+        activated_sources.append(args)
+        if len(activated_sources) == 2:
+            raise SimulatedCrash()
+        return real_get_activated_blocks(*args, **kwargs)
+
+    with monkeypatch.context() as crash:
+        crash.setattr(add_app, "get_activated_blocks", get_activated_blocks)
+
+        with pytest.raises(SimulatedCrash):
+            add_app_subcommand(app_path, build_dir, "app-a", AnalysisOptions(batch_size=1))
+
+    assert len(get_storage().get_checkpoints("app-a")) == 1
+
+    add_app_subcommand(app_path, build_dir, "app-a", AnalysisOptions(registration=RegistrationMode.RESUME))
+
+    assert get_compilation_state("app-a") == expected_state
+
+
+def test_parallel_run_never_instruments_in_place(app_tree, tmp_path):
+
+    app_path, build_dir = app_tree
+
+    configure_storage(StorageBackend.SQLITE, str(tmp_path / "serial.sqlite"))
+    add_app_subcommand(app_path, build_dir, "app-a", AnalysisOptions())
+    expected_state = get_compilation_state("app-a")
+
+    configure_storage(StorageBackend.SQLITE, str(tmp_path / "parallel.sqlite"))
+    options = AnalysisOptions(jobs=2, instrumentation=InstrumentationMode.IN_PLACE)
+    add_app_subcommand(app_path, build_dir, "app-a", options)
+
+    assert options.instrumentation == InstrumentationMode.OUT_OF_TREE
+    assert get_compilation_state("app-a") == expected_state
+
+
+def test_failed_preprocessing_is_neither_cached_nor_stored(app_tree, tmp_path):
+
+    app_path, build_dir = app_tree
+    broken_source = os.path.join(os.environ["UK_WORKDIR"], "lib/foo/b.c")
+
+    configure_storage(StorageBackend.SQLITE, str(tmp_path / "coverage.sqlite"))
+
+    with open(broken_source) as source:
+        fixed_text = source.read()
+
+    with open(broken_source, "w") as source:
+        source.write("#include \"missing.h\"\n" + fixed_text)
+
+    options = AnalysisOptions(engine=ActivationEngine.LINEMARKER, cache_dir=str(tmp_path / "cache"))
+    add_app_subcommand(app_path, build_dir, "app-a", options)
+
+    assert list(get_storage().prefetch_sources(["lib/foo/a.c", "lib/foo/b.c"])) == ["lib/foo/a.c"]
+    assert [failure["source_path"] for failure in get_storage().get_source_failures("app-a")] == ["lib/foo/b.c"]
+
+    # the header is found on the next run, which must probe the source again instead of reusing a result
+    with open(os.path.join(os.environ["UK_WORKDIR"], "lib/foo/missing.h"), "w") as header:
+        header.write("\n")
+
+    add_app_subcommand(app_path, build_dir, "app-a", AnalysisOptions(engine=ActivationEngine.LINEMARKER, cache_dir=str(tmp_path / "cache"), registration=RegistrationMode.RESUME))
+
+    assert get_storage().get_source_failures("app-a") == []
+    assert get_storage().prefetch_sources(["lib/foo/b.c"])["lib/foo/b.c"]["compiled_stats"]["app-a"] > 0
@@ -0,0 +1,71 @@
+from bson.int64 import Int64
+from bson.objectid import ObjectId
+from pymongo import InsertOne, UpdateOne, UpdateMany, DeleteMany
+from block_storage import should_split, get_new_source_operations, get_replaced_source_operations, get_split_activation_operation
+
+
+SOURCE_ID = ObjectId("65a000000000000000000001")
+
+
+def make_source(block_count : int, **fields) -> dict:
+
+    return dict({
+        "_id" : SOURCE_ID,
+        "source_path" : "lib/foo/a.c",
+        "compile_blocks" : [{"_local_id" : local_id, "lines" : 1, "triggered_bits" : {}} for local_id in range(block_count)]
+    }, **fields)
+
+
+def test_sources_below_the_threshold_stay_embedded():
+
+    source_document = make_source(2)
+
+    assert not should_split(make_source(1000), None)
+    assert get_new_source_operations(source_document, 3) == (InsertOne(make_source(2)), [])
+    assert "split_blocks" not in source_document
+
+
+def test_new_split_source_moves_its_blocks():
+
+    source_document = make_source(2)
+
+    operation, block_operations = get_new_source_operations(source_document, 2)
+
+    assert operation == InsertOne({"_id" : SOURCE_ID, "source_path" : "lib/foo/a.c", "split_blocks" : True, "block_count" : 2})
+    assert block_operations == [
+        InsertOne({"_local_id" : 0, "lines" : 1, "triggered_bits" : {}, "source_id" : SOURCE_ID}),
+        InsertOne({"_local_id" : 1, "lines" : 1, "triggered_bits" : {}, "source_id" : SOURCE_ID})
+    ]
+
+    # in memory the source keeps its blocks
+    assert source_document["split_blocks"] and len(source_document["compile_blocks"]) == 2
+
+
+def test_replaced_source_switches_layout():
+
+    # a split source that shrank below the threshold gets its array back and loses its block documents
+    update, block_operations = get_replaced_source_operations(make_source(1, split_blocks=True), 2)
+
+    assert update == {
+        "$set" : {"source_path" : "lib/foo/a.c", "compile_blocks" : [{"_local_id" : 0, "lines" : 1, "triggered_bits" : {}}]},
+        "$unset" : {"split_blocks" : "", "block_count" : ""}
+    }
+    assert block_operations == [DeleteMany({"source_id" : SOURCE_ID})]
+
+    # an embedded source that grew past it upserts its blocks and drops the ones past its new count
+    update, block_operations = get_replaced_source_operations(make_source(2), 2)
+
+    assert update == {"$set" : {"source_path" : "lib/foo/a.c", "split_blocks" : True, "block_count" : 2}, "$unset" : {"compile_blocks" : ""}}
+    assert block_operations == [
+        UpdateOne({"source_id" : SOURCE_ID, "_local_id" : 0}, {"$set" : {"_local_id" : 0, "lines" : 1, "triggered_bits" : {}, "source_id" : SOURCE_ID}}, upsert=True),
+        UpdateOne({"source_id" : SOURCE_ID, "_local_id" : 1}, {"$set" : {"_local_id" : 1, "lines" : 1, "triggered_bits" : {}, "source_id" : SOURCE_ID}}, upsert=True),
+        DeleteMany({"source_id" : SOURCE_ID, "_local_id" : {"$gte" : 2}})
+    ]
+
+
+def test_split_activation_sets_the_bit_on_activated_blocks():
+
+    assert get_split_activation_operation(make_source(3, split_blocks=True), [0, 2], "1", Int64(4)) == UpdateMany(
+        {"source_id" : SOURCE_ID, "_local_id" : {"$in" : [0, 2]}},
+        {"$bit" : {"triggered_bits.1" : {"or" : Int64(4)}}}
+    )
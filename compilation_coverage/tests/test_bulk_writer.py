@@ -0,0 +1,118 @@
+from types import SimpleNamespace
+from pymongo import InsertOne, UpdateOne
+from bulk_writer import BulkWriter
+
+
+class RecordingDatabase:
+
+    '''
+    Records the bulk writes sent to every collection, in order.
+    Writes are not applied, finds match the given documents.
+    '''
+
+    def __init__(self, documents : dict[str, list[dict]] = None) -> None:
+        self.writes = []
+        self.documents = documents if documents != None else {}
+
+    def __getitem__(self, collection_name : str):
+        return SimpleNamespace(
+            bulk_write= lambda operations, ordered : self.bulk_write(collection_name, operations, ordered),
+            find= lambda filter, projection : self.find(collection_name, filter)
+        )
+
+    def find(self, collection_name : str, filter : dict) -> list[dict]:
+
+        # only the $or of equality filters used by the guards
+        return [
+            document for document in self.documents.get(collection_name, [])
+            if any(all(document.get(field) == value for field, value in equality_filter.items()) for equality_filter in filter["$or"])
+        ]
+
+    def bulk_write(self, collection_name : str, operations : list, ordered : bool):
+        assert not ordered
+        self.writes.append((collection_name, list(operations)))
+        return SimpleNamespace(inserted_count=0, modified_count=0, upserted_count=0)
+
+
+def test_full_batches_are_flushed():
+
+    database = RecordingDatabase()
+    writer = BulkWriter(database, batch_size=3)
+
+    for i in range(4):
+        writer.queue("Sources", InsertOne({"source_path" : f"{i}.c"}), f"{i}.c")
+
+    assert database.writes == [("Sources", [InsertOne({"source_path" : f"{i}.c"}) for i in range(3)])]
+
+    writer.flush()
+    writer.flush()
+
+    assert database.writes[1:] == [("Sources", [InsertOne({"source_path" : "3.c"})])]
+
+
+def test_a_document_has_one_pending_operation():
+
+    database = RecordingDatabase()
+    writer = BulkWriter(database)
+
+    insert = InsertOne({"source_path" : "a.c"})
+    update = UpdateOne({"source_path" : "a.c"}, {"$set" : {"lib" : "libfoo"}})
+    other_update = UpdateOne({"source_path" : "b.c"}, {"$set" : {"lib" : "libfoo"}})
+
+    writer.queue("Sources", insert, "a.c")
+    writer.queue("Sources", other_update, "b.c")
+
+    # unordered execution could apply the update before the insert, so the insert goes first
+    writer.queue("Sources", update, "a.c")
+    writer.flush()
+
+    assert database.writes == [("Sources", [insert, other_update]), ("Sources", [update])]
+
+
+def test_batches_are_written_per_collection():
+
+    database = RecordingDatabase()
+    writer = BulkWriter(database)
+
+    writer.queue("Sources", InsertOne({"source_path" : "a.c"}))
+    writer.queue("Compilations", InsertOne({"tag" : "t"}))
+    writer.queue("Sources", InsertOne({"source_path" : "b.c"}))
+    writer.flush()
+
+    assert database.writes == [
+        ("Sources", [InsertOne({"source_path" : "a.c"}), InsertOne({"source_path" : "b.c"})]),
+        ("Compilations", [InsertOne({"tag" : "t"})])
+    ]
+
+
+def test_increments_are_merged_and_written_after_the_batch():
+
+    database = RecordingDatabase()
+    writer = BulkWriter(database)
+
+    writer.queue_increment("Summaries", {"tag" : "t", "key" : "lib"}, {"sources" : 1, "total_lines" : 10})
+    writer.queue("Sources", InsertOne({"source_path" : "a.c"}), "a.c")
+    writer.queue_increment("Summaries", {"key" : "lib", "tag" : "t"}, {"sources" : 1, "total_lines" : 5})
+    writer.flush()
+
+    assert database.writes == [
+        ("Sources", [InsertOne({"source_path" : "a.c"})]),
+        ("Summaries", [UpdateOne({"tag" : "t", "key" : "lib"}, {"$inc" : {"sources" : 2, "total_lines" : 15}}, upsert=True)])
+    ]
+
+
+def test_guarded_increments_need_a_matching_document():
+
+    # b.c was replaced by another version meanwhile, so the update of the old version matches nothing
+    database = RecordingDatabase({"Sources" : [{"source_path" : "a.c", "git_commit_id" : "1"}, {"source_path" : "b.c", "git_commit_id" : "3"}]})
+    writer = BulkWriter(database)
+
+    for source_path, commit_id in [("a.c", "1"), ("b.c", "2")]:
+        version_filter = {"source_path" : source_path, "git_commit_id" : commit_id}
+        writer.queue("Sources", UpdateOne(version_filter, {"$set" : {"compiled_stats.t" : 1}}), source_path)
+        writer.queue_guarded_increments("Sources", version_filter, [("Summaries", {"tag" : "t"}, {"compiled_lines" : 1})])
+
+    writer.queue_increment("Summaries", {"tag" : "t"}, {"sources" : 1})
+    writer.flush()
+
+    assert database.writes[1:] == [("Summaries", [UpdateOne({"tag" : "t"}, {"$inc" : {"sources" : 1, "compiled_lines" : 1}}, upsert=True)])]
@@ -0,0 +1,57 @@
+import os
+import command_index
+from command_index import CompileCommandIndex, INDEX_FILE_NAME
+
+
+def write_command_file(build_dir, lib_name : str, object_name : str, source_path : str):
+
+    (build_dir / lib_name).mkdir(parents=True, exist_ok=True)
+    (build_dir / lib_name / f"{object_name}.o.cmd").write_text(f"$ gcc -DCONFIG_A -c {source_path} -o {build_dir}/{lib_name}/{object_name}.o\n")
+
+
+def test_lookup_matches_the_exact_source(tmp_path):
+
+    write_command_file(tmp_path, "libfoo", "foobar", "/w/lib/foo/foobar.c")
+    write_command_file(tmp_path, "libfoo", "foo", "/w/lib/foo/foo.c")
+    (tmp_path / "libfoo" / "notes.txt").write_text("-c /w/lib/foo/notes.c\n")
+
+    index = CompileCommandIndex(str(tmp_path))
+
+    assert index.get_compilation_command("libfoo", "/w/lib/foo/foo.c") == f"gcc -DCONFIG_A -c /w/lib/foo/foo.c -o {tmp_path}/libfoo/foo.o\n"
+    assert index.get_compilation_command("libfoo", "/w/lib/foo/foo") == None
+    assert index.get_compilation_command("libfoo", "/w/lib/foo/notes.c") == None
+    assert index.get_compilation_command("libbar", "/w/lib/bar/bar.c") == None
+
+
+def test_saved_index_only_reads_changed_files(tmp_path, monkeypatch):
+
+    write_command_file(tmp_path, "libfoo", "a", "/w/lib/foo/a.c")
+    write_command_file(tmp_path, "libfoo", "b", "/w/lib/foo/b.c")
+
+    index = CompileCommandIndex(str(tmp_path))
+    index.get_compilation_command("libfoo", "/w/lib/foo/a.c")
+    index.save()
+
+    assert (tmp_path / INDEX_FILE_NAME).exists()
+
+    # b.o.cmd is rebuilt with another command, c.o.cmd is new
+    write_command_file(tmp_path, "libfoo", "b", "/w/lib/foo/b2.c")
+    os.utime(tmp_path / "libfoo" / "b.o.cmd", ns=(0, 0))
+    write_command_file(tmp_path, "libfoo", "c", "/w/lib/foo/c.c")
+
+    read_files = []
+    read_command_file = command_index.read_command_file
+
+    def record_read_command_file(command_file_path):
+        read_files.append(os.path.basename(command_file_path))
+        return read_command_file(command_file_path)
+
+    monkeypatch.setattr(command_index, "read_command_file", record_read_command_file)
+
+    index = CompileCommandIndex(str(tmp_path))
+
+    assert index.get_compilation_command("libfoo", "/w/lib/foo/a.c") != None
+    assert index.get_compilation_command("libfoo", "/w/lib/foo/b.c") == None
+    assert index.get_compilation_command("libfoo", "/w/lib/foo/b2.c") != None
+    assert index.get_compilation_command("libfoo", "/w/lib/foo/c.c") != None
+    assert read_files == ["b.o.cmd", "c.o.cmd"]
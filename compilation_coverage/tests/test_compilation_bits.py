@@ -0,0 +1,73 @@
+from compilation_bits import WORD_BITS, set_bit, clear_bit, has_bit, has_any_bit, is_empty, iterate_bits, decode_tags, any_bit_filter, has_bit_filter
+
+
+def test_set_and_clear_bits_across_words():
+
+    triggered_bits = {}
+
+    for compilation_bit in [0, WORD_BITS - 1, WORD_BITS, 3 * WORD_BITS + 5]:
+        set_bit(triggered_bits, compilation_bit)
+
+    # setting a bit twice changes nothing
+    set_bit(triggered_bits, 0)
+
+    assert sorted(iterate_bits(triggered_bits)) == [0, WORD_BITS - 1, WORD_BITS, 3 * WORD_BITS + 5]
+    assert sorted(triggered_bits) == ["0", "1", "3"]
+    assert has_bit(triggered_bits, WORD_BITS - 1) and not has_bit(triggered_bits, 1)
+    assert has_any_bit(triggered_bits, [1, WORD_BITS]) and not has_any_bit(triggered_bits, [1, 2 * WORD_BITS])
+
+    # the top bit of a word is its sign
+    assert triggered_bits["0"] < 0
+
+    clear_bit(triggered_bits, WORD_BITS - 1)
+
+    assert sorted(iterate_bits(triggered_bits)) == [0, WORD_BITS, 3 * WORD_BITS + 5]
+
+
+def test_clear_bit_drops_empty_words():
+
+    triggered_bits = {}
+
+    set_bit(triggered_bits, 1)
+    set_bit(triggered_bits, 2)
+    set_bit(triggered_bits, WORD_BITS)
+
+    clear_bit(triggered_bits, 1)
+    clear_bit(triggered_bits, WORD_BITS)
+
+    assert triggered_bits == {"0" : 4}
+
+    clear_bit(triggered_bits, 2)
+
+    assert triggered_bits == {}
+
+    # clearing a bit that is not set changes nothing
+    clear_bit(triggered_bits, 7)
+
+    assert triggered_bits == {}
+
+
+def test_is_empty_ignores_zero_words():
+
+    assert is_empty({})
+    assert is_empty({"0" : 0, "2" : 0})
+    assert not is_empty({"0" : 0, "1" : 1})
+
+
+def test_decode_tags_skips_deleted_compilations():
+
+    triggered_bits = {}
+
+    for compilation_bit in [0, 1, 2]:
+        set_bit(triggered_bits, compilation_bit)
+
+    assert decode_tags(triggered_bits, {0 : "app-a", 2 : "app-c"}) == ["app-a", "app-c"]
+
+
+def test_bit_filters_use_bit_positions():
+
+    assert any_bit_filter("triggered_bits", [1, 63, WORD_BITS + 2]) == {
+        "$or" : [{"triggered_bits.0" : {"$bitsAnySet" : [1, 63]}}, {"triggered_bits.1" : {"$bitsAnySet" : [2]}}]
+    }
+    assert any_bit_filter("triggered_bits", []) == {"_id" : {"$exists" : False}}
+    assert has_bit_filter("block.triggered_bits", WORD_BITS + 63) == {"block.triggered_bits.1" : {"$bitsAllSet" : [63]}}
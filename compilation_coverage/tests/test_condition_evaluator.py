@@ -0,0 +1,238 @@
+import shutil
+import subprocess
+import pytest
+from condition_evaluator import UNDECIDED, MacroEnvironment, get_macro_environment, evaluate_condition, predict_activated_blocks
+from symbol_engine import find_compilation_blocks_and_lines
+
+# configuration of the app, every other CONFIG_ macro is known to be undefined
+CONFIG_MACROS = {
+    "CONFIG_A" : "2",
+    "CONFIG_ONE" : "1",
+    "CONFIG_M_MODULE" : "1",
+    "CONFIG_EXPR" : "(CONFIG_A + 1)",
+    "CONFIG_SELF" : "CONFIG_SELF",
+    "CONFIG_BIG" : "0xffffffffffffffff",
+    "CONFIG_EMPTY" : ""
+}
+
+# conditions gcc decides without a warning, the evaluator must agree with it
+GCC_CONDITIONS = [
+    # precedence and associativity
+    "1 + 2 * 3 == 7",
+    "(1 + 2) * 3 == 9",
+    "1 << 2 + 1 == 8",
+    "1 | 2 ^ 3 & 1",
+    "(1 | 2 ^ 3) & 1",
+    "2 > 1 == 1",
+    "1 < 2 < 3",
+    "3 == 3 != 0",
+    "1 - 1 - 1 == -1",
+    "10 >> 1 << 1 == 10",
+    "-2 / 2 * 3 == -3",
+    "-7 % 3 == -1",
+    "7 / -2 == -3",
+    "!0 + !1 == 1",
+    "~0 == -1",
+    "- - 1 == 1",
+    "1 && 2 || 0 && 0",
+    "0 || 0 && 1",
+    "1 ? 2 : 3 ? 4 : 5",
+    "0 ? 1 : 0 ? 2 : 3",
+    "(0 ? 1 : 2) == 2",
+    # defined and macro expansion
+    "defined(CONFIG_A)",
+    "defined CONFIG_A && !defined(CONFIG_B)",
+    "defined(CONFIG_B) || CONFIG_A == 2",
+    "defined CONFIG_EMPTY",
+    "CONFIG_UNSET == 0",
+    "CONFIG_EXPR * 2 == 6",
+    "CONFIG_SELF == 0",
+    "CONFIG_A > CONFIG_ONE",
+    # integer constants
+    "10u == 10",
+    "10UL + 1 == 11",
+    "0x10ll == 16",
+    "010 == 8",
+    "0x7fffffffffffffff > 0",
+    "0xffffffffffffffff == -1",
+    "18446744073709551615u > 0",
+    "CONFIG_BIG > 0",
+    "'a' == 97",
+    "'\\n' == 10",
+    # unsigned arithmetic
+    "-1 > 0u",
+    "-1 < 0",
+    "1u - 2 > 0",
+    "-(1u) > 0",
+    "(0u - 1) / 2 > 0",
+    "-1 / 2u > 0",
+    "(1 ? -1 : 0u) > 0",
+    "(0 ? 0u : -1) > 0",
+    "~0u >> 63 == 1",
+    "-1 >> 63 == -1",
+    "1ull << 63 > 0",
+    "(-1 < 0u) == 0",
+    # operands that are never evaluated
+    "0 && (1 / 0)",
+    "1 || (1 % 0)",
+    "0 ? 1 / 0 : 2",
+    "1 ? 2 : 1 / 0",
+    "0 && (9223372036854775807 + 1)",
+    "CONFIG_UNSET && CONFIG_A / CONFIG_UNSET"
+]
+
+# conditions the evaluator must leave to gcc: gcc only warns about them, errors out, or the outcome depends on what the source defines
+UNDECIDED_CONDITIONS = [
+    "9223372036854775807 + 1 < 0",
+    "1 << 63 < 0",
+    "(-9223372036854775807 - 1) / -1",
+    "-(-9223372036854775807 - 1) < 0",
+    "1 << 64",
+    "1 << -1",
+    "1u >> 64",
+    "18446744073709551616 > 0",
+    "'\\377' < 0",
+    "1 / 0",
+    "CONFIG_A % 0",
+    "CONFIG_EMPTY",
+    "CONFIG_FUNCTION(1)",
+    "defined(LOCAL_MACRO)",
+    "LOCAL_MACRO == 1",
+    "UNKNOWN == 1",
+    "UNKNOWN || 0",
+    "UNKNOWN ? 1 : 2",
+    # an undecided branch may be unsigned and change the type of the result
+    "(1 ? -1 : UNKNOWN) > 0",
+    "1 +",
+    "(1",
+    "1 2",
+    "defined"
+]
+
+# conditions that stay decided next to unknown macros, or that gcc cannot check since it lacks the Kconfig helpers
+DECIDED_CONDITIONS = [
+    ("UNKNOWN || 1", 1),
+    ("1 || UNKNOWN", 1),
+    ("0 && UNKNOWN", 0),
+    ("UNKNOWN && CONFIG_UNSET", 0),
+    ("UNKNOWN ? 3 : 3", 3),
+    ("IS_ENABLED(CONFIG_ONE)", 1),
+    ("IS_ENABLED(CONFIG_M)", 1),
+    ("IS_BUILTIN(CONFIG_M)", 0),
+    ("IS_MODULE(CONFIG_M)", 1),
+    ("IS_ENABLED(CONFIG_A)", 0),
+    ("IS_ENABLED(CONFIG_UNSET)", 0)
+]
+
+
+def get_environment() -> MacroEnvironment:
+    return get_macro_environment("gcc -c -o foo.o foo.c", CONFIG_MACROS, ["#define LOCAL_MACRO 1"])
+
+
+def gcc_evaluate(condition : str) -> int:
+
+    result = subprocess.run(
+        ["gcc", "-E", "-P", "-Werror", "-x", "c", *[f"-D{name}={value}" for name, value in CONFIG_MACROS.items()], "-"],
+        input=f"#if {condition}\nyes\n#else\nno\n#endif\n",
+        capture_output=True,
+        text=True,
+        check=True
+    )
+
+    return {"yes" : 1, "no" : 0}[result.stdout.strip()]
+
+
+@pytest.mark.skipif(shutil.which("gcc") == None, reason="gcc is not installed")
+@pytest.mark.parametrize("condition", GCC_CONDITIONS)
+def test_condition_agrees_with_gcc(condition):
+
+    value = evaluate_condition(condition, get_environment())
+
+    assert value != UNDECIDED
+    assert int(value != 0) == gcc_evaluate(condition)
+
+
+@pytest.mark.parametrize("condition", UNDECIDED_CONDITIONS)
+def test_condition_is_left_to_gcc(condition):
+    assert evaluate_condition(condition, get_environment()) == UNDECIDED
+
+
+@pytest.mark.parametrize("condition, expected", DECIDED_CONDITIONS)
+def test_condition_is_decided(condition, expected):
+    assert evaluate_condition(condition, get_environment()) == expected
+
+
+def test_command_line_macros_override_the_configuration():
+
+    env = get_macro_environment("gcc -DCONFIG_B -D CONFIG_C=3 -UCONFIG_A -c foo.c", CONFIG_MACROS, [])
+
+    assert evaluate_condition("defined(CONFIG_B) && CONFIG_B == 1", env) == 1
+    assert evaluate_condition("CONFIG_C == 3", env) == 1
+    assert evaluate_condition("defined(CONFIG_A)", env) == 0
+
+
+def test_config_macros_are_undecided_without_a_configuration():
+
+    env = get_macro_environment("gcc -c foo.c", None, [])
+
+    assert evaluate_condition("defined(CONFIG_A)", env) == UNDECIDED
+    assert evaluate_condition("CONFIG_A || 1", env) == 1
+
+
+SOURCE = """#ifdef CONFIG_A
+int a;
+#if CONFIG_A > 1
+int a2;
+#endif
+#elif defined(CONFIG_ONE)
+int one;
+#else
+int other;
+#endif
+#ifndef CONFIG_UNSET
+int unset;
+#endif
+"""
+
+
+def predict(source : str):
+
+    total_blocks, _ = find_compilation_blocks_and_lines(source)
+
+    return predict_activated_blocks(total_blocks, source.splitlines(), get_environment())
+
+
+def test_predict_activated_blocks():
+
+    # the #elif branch holds too, but the #ifdef before it was taken
+    assert predict(SOURCE) == [0, 1, 4]
+
+
+def test_predict_gives_up_on_undecided_blocks():
+
+    assert predict(SOURCE.replace("CONFIG_A > 1", "UNKNOWN > 1")) == None
+
+    # a block under a branch that is not taken is never looked at
+    assert predict(SOURCE.replace("CONFIG_A > 1", "UNKNOWN > 1").replace("#ifdef CONFIG_A", "#ifdef CONFIG_UNSET")) == [2, 4]
+
+
+@pytest.mark.parametrize("header_location", ["source dir", "include dir", "forced include"])
+def test_config_macros_defined_by_headers_are_undecided(tmp_path, header_location):
+
+    source_dir = tmp_path / "lib"
+    source_dir.mkdir()
+
+    header_dir = {"source dir" : source_dir, "include dir" : tmp_path / "include" / "uk", "forced include" : tmp_path / "forced"}[header_location]
+    header_dir.mkdir(parents=True, exist_ok=True)
+    (header_dir / "arch.h").write_text("#ifndef CONFIG_ARCH_DEFAULT\n#define CONFIG_ARCH_DEFAULT 1\n#endif\n")
+
+    compile_command = f"gcc -I{tmp_path / 'include'} -c {source_dir / 'a.c'}"
+    if header_location == "forced include":
+        compile_command = f"gcc -include {header_dir / 'arch.h'} -c {source_dir / 'a.c'}"
+
+    env = get_macro_environment(compile_command, CONFIG_MACROS, [], str(source_dir / "a.c"))
+
+    # missing from the configuration, but the header may define it
+    assert evaluate_condition("defined(CONFIG_ARCH_DEFAULT)", env) == UNDECIDED
+    assert evaluate_condition("defined(CONFIG_UNSET)", env) == 0
+    assert evaluate_condition("defined(CONFIG_A)", env) == 1
@@ -0,0 +1,76 @@
+import os
+import subprocess
+import sys
+import pytest
+import storage
+from storage import StorageBackend, configure_storage, get_storage
+
+TOOL_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_light_imports_leave_the_subcommands_and_selenium_out():
+
+    # a fresh interpreter, the modules of the other tests are already loaded here
+    loaded_modules = subprocess.run(
+        [sys.executable, "-c", "import sys, coverage, add_app; print(' '.join(sys.modules))"],
+        cwd=TOOL_DIR,
+        env={key : value for key, value in os.environ.items() if not key.startswith("COVERITY_")},
+        capture_output=True,
+        text=True,
+        check=True
+    ).stdout.split()
+
+    assert "add_app" in loaded_modules
+    assert not {"list_app", "view_app", "status", "seleniumwire", "selenium"} & set(loaded_modules)
+
+
+def test_storage_is_opened_once_on_first_use(tmp_path, monkeypatch):
+
+    opened = []
+    open_storage = storage.open_storage
+
+    def record_open_storage(backend, location):
+        opened.append((backend, location))
+        return open_storage(backend, location)
+
+    monkeypatch.setattr(storage, "open_storage", record_open_storage)
+
+    configure_storage(StorageBackend.SQLITE, str(tmp_path / "coverage.sqlite"))
+
+    assert opened == [] and not (tmp_path / "coverage.sqlite").exists()
+    assert get_storage() is get_storage()
+    assert opened == [(StorageBackend.SQLITE, str(tmp_path / "coverage.sqlite"))]
+
+    # the schema is there for the first subcommand
+    assert get_storage().count_compilations() == 0
+
+
+def test_storage_must_be_configured(monkeypatch):
+
+    monkeypatch.setattr(storage, "storage_settings", None)
+    monkeypatch.setattr(storage, "active_storage", None)
+
+    with pytest.raises(RuntimeError, match="configured"):
+        get_storage()
+
+
+@pytest.mark.parametrize("arguments, message", [
+    (["app", "add", "-t", "tag", "--jobs", "0"], "argument -j/--jobs: 0 is not a positive integer"),
+    (["app", "add", "-t", "tag", "--max-probes", "0"], "argument --max-probes: 0 is not a positive integer"),
+    (["app", "add", "-t", "tag", "--batch-size", "-5"], "argument --batch-size: -5 is not a positive integer"),
+    (["app", "add", "-t", "tag", "--parse-jobs", "-1"], "argument --parse-jobs: -1 is not a non-negative integer"),
+    (["app", "refresh", "--since", "HEAD", "--jobs", "-2"], "argument -j/--jobs: -2 is not a positive integer"),
+    (["app", "refresh", "--since", "HEAD", "--probe-retries", "-1"], "argument --probe-retries: -1 is not a non-negative integer"),
+])
+def test_counts_below_their_minimum_are_rejected(tmp_path, arguments, message):
+
+    # rejected before cache.json is read, the working directory has none
+    result = subprocess.run(
+        [sys.executable, os.path.join(TOOL_DIR, "coverage.py"), *arguments],
+        cwd=tmp_path,
+        capture_output=True,
+        text=True
+    )
+
+    assert result.returncode == 2
+    assert message in result.stderr
@@ -0,0 +1,67 @@
+import os
+import add_app
+from add_app import AnalysisOptions, parse_source
+from coverage_cache import ResultCache, PARSE_NAMESPACE
+from helpers import SourceBuffer
+
+
+def test_get_returns_what_was_put(tmp_path):
+
+    cache = ResultCache(str(tmp_path), "test", 1)
+
+    assert cache.get("ab12") == None
+
+    cache.put("ab12", {"universal_lines" : 3})
+
+    assert cache.get("ab12") == {"universal_lines" : 3}
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # another run sees the same entries
+    assert ResultCache(str(tmp_path), "test", 1).get("ab12") == {"universal_lines" : 3}
+    assert ResultCache(str(tmp_path), "other", 1).get("ab12") == None
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+
+    cache = ResultCache(str(tmp_path), "test", 1)
+
+    for i, key in enumerate(["k0", "k1", "k2", "k3"]):
+        cache.put(key, {"value" : "x" * 100})
+        os.utime(cache.get_entry_path(key), (1000 + i, 1000 + i))
+
+    # reading k0 makes it the most recently used entry
+    cache.get("k0")
+
+    entry_size = os.path.getsize(cache.get_entry_path("k0"))
+    cache.max_size = 4 * entry_size
+    cache.put("k4", {"value" : "x" * 100})
+
+    # down to 90% of 4 entries, so 3 entries are left
+    assert [key for key in ["k0", "k1", "k2", "k3", "k4"] if cache.get(key) != None] == ["k0", "k3", "k4"]
+
+
+SOURCE = "#ifdef CONFIG_A /* a */\nint a;\n#ifdef CONFIG_B\nint b;\n#endif\n#endif\nint c; // c\n"
+
+
+def test_parse_source_is_cached_by_content(tmp_path, monkeypatch):
+
+    source_path = tmp_path / "a.c"
+    source_path.write_text(SOURCE)
+
+    options = AnalysisOptions(parse_cache=ResultCache(str(tmp_path / "cache"), PARSE_NAMESPACE, 1), scratch_dir=str(tmp_path))
+
+    source_buffer = SourceBuffer(str(source_path))
+    parsed_blocks, universal_lines = parse_source(source_buffer, source_buffer.get_hash(), options)
+
+    def find_compilation_blocks_and_lines(text):
+        raise AssertionError(f"{text} parsed again")
+
+    monkeypatch.setattr(add_app, "find_compilation_blocks_and_lines", find_compilation_blocks_and_lines)
+
+    source_buffer = SourceBuffer(str(source_path))
+    cached_blocks, cached_universal_lines = parse_source(source_buffer, source_buffer.get_hash(), options)
+
+    assert [block.to_mongo_dict() for block in cached_blocks] == [block.to_mongo_dict() for block in parsed_blocks]
+    assert cached_blocks[0].children == [1]
+    assert cached_universal_lines == universal_lines
+    assert (options.parse_cache.hits, options.parse_cache.misses) == (1, 1)
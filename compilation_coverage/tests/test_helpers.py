@@ -0,0 +1,265 @@
+import os
+import shlex
+import subprocess
+import pytest
+from helpers import ProbeMode, SourceBuffer, trigger_compilation_blocks, relocate_compilation_command, instrument_source, get_probe_command, CommandRelocationError
+from helpers import normalize_compilation_command, get_environment_fingerprint, hash_strategy, GitVersionIndex
+from symbol_engine import find_compilation_blocks_and_lines
+
+
+def test_trigger_compilation_blocks_reads_the_compiler_warnings(tmp_path, monkeypatch, probe_scheduler):
+
+    source_path = tmp_path / "a.c"
+    source_path.write_text("#warning COMPILATION_COVERAGE_2\n#if 0\n#warning COMPILATION_COVERAGE_3\n#endif\n#warning COMPILATION_COVERAGE_5\nint a;\n")
+
+    # parallel workers must not share a dump file in the current directory
+    monkeypatch.chdir(tmp_path)
+
+    assert trigger_compilation_blocks(f"gcc -c {source_path} -o {tmp_path / 'a.o'}", probe_scheduler) == [2, 5]
+    assert sorted(os.listdir(tmp_path)) == ["a.c", "a.o"]
+
+
+def test_trigger_compilation_blocks_ignores_the_warnings_of_included_sources(tmp_path, monkeypatch, probe_scheduler):
+
+    # b.c is instrumented in place by another worker while a.c, which includes it, is compiled
+    (tmp_path / "b.c").write_text("#warning COMPILATION_COVERAGE_0\n#warning COMPILATION_COVERAGE_1\nint b;\n")
+    (tmp_path / "a.c").write_text("#include \"b.c\"\n#warning COMPILATION_COVERAGE_1\nint a;\n")
+
+    monkeypatch.chdir(tmp_path)
+
+    assert trigger_compilation_blocks("gcc -fsyntax-only -c a.c", probe_scheduler) == [1]
+
+
+def test_relocate_compilation_command():
+
+    compile_command = "gcc -Wp,-MD,/b/libfoo/.a.o.d -MMD -MF /b/a.d -I/w/include -DCONFIG_A -c /w/lib/foo/a.c -o /b/libfoo/a.o"
+
+    assert relocate_compilation_command(compile_command, "/w/lib/foo/a.c", "/s/1/a.c") == "gcc -I/w/include -DCONFIG_A -iquote /w/lib/foo -c /s/1/a.c -o /s/1/a.o"
+
+
+def test_relocation_keeps_quoted_arguments_whole():
+
+    compile_command = "gcc '-DUK_CODENAME=\"Kiviuq 0.1\"' -c /w/lib/foo/a.c -o /b/libfoo/a.o"
+
+    relocated_command = relocate_compilation_command(compile_command, "/w/lib/foo/a.c", "/s/1/a.c")
+
+    assert shlex.split(relocated_command) == ["gcc", "-DUK_CODENAME=\"Kiviuq 0.1\"", "-iquote", "/w/lib/foo", "-c", "/s/1/a.c", "-o", "/s/1/a.o"]
+    assert shlex.split(get_probe_command(relocated_command, ProbeMode.SYNTAX))[1] == "-DUK_CODENAME=\"Kiviuq 0.1\""
+
+
+def test_relocation_requires_the_source_after_c():
+
+    # the copy would never be compiled, the real source would be probed instead
+    with pytest.raises(CommandRelocationError, match="/w/lib/foo/a.c"):
+        relocate_compilation_command("gcc -c /w/lib/foo/b.c -o /b/libfoo/a.o", "/w/lib/foo/a.c", "/s/1/a.c")
+
+
+def test_relocated_copy_includes_the_headers_of_the_source(tmp_path, probe_scheduler):
+
+    lib_dir = tmp_path / "lib"
+    lib_dir.mkdir()
+    (lib_dir / "foo.h").write_text("#define FOO 1\n")
+    (lib_dir / "a.c").write_text("#include \"foo.h\"\n#if FOO \\\n    && 1\nint a1;\n#else\nint a2;\n#endif\n#ifdef BAR\n#endif\n")
+
+    copy_dir = tmp_path / "scratch"
+    copy_dir.mkdir()
+
+    source_buffer = SourceBuffer(str(lib_dir / "a.c"))
+    total_blocks, _ = find_compilation_blocks_and_lines(source_buffer.get_text())
+    instrument_source(total_blocks, source_buffer.get_lines(), str(copy_dir / "a.c"))
+
+    compile_command = relocate_compilation_command(f"gcc -Wp,-MD,{tmp_path}/.a.o.d -c {lib_dir}/a.c -o {tmp_path}/a.o", f"{lib_dir}/a.c", f"{copy_dir}/a.c")
+
+    activated_conditions = [block.symbol_condition for block in total_blocks if block.block_counter in trigger_compilation_blocks(compile_command, probe_scheduler)]
+
+    assert activated_conditions == ["FOO && 1"]
+    assert sorted(os.listdir(tmp_path)) == ["lib", "scratch"]
+    assert (lib_dir / "a.c").read_text().startswith("#include")
+
+
+@pytest.mark.parametrize("probe_mode, probe_command", [
+    (ProbeMode.COMPILE, "gcc -Wp,-MD,/b/.a.o.d -DCONFIG_A -c /w/a.c -o /b/a.o"),
+    (ProbeMode.PREPROCESS, "gcc -DCONFIG_A -c /w/a.c -E -o /dev/null"),
+    (ProbeMode.SYNTAX, "gcc -DCONFIG_A -c /w/a.c -fsyntax-only")
+])
+def test_get_probe_command(probe_mode, probe_command):
+
+    assert get_probe_command("gcc -Wp,-MD,/b/.a.o.d -DCONFIG_A -c /w/a.c -o /b/a.o", probe_mode) == probe_command
+
+
+@pytest.mark.parametrize("probe_mode", list(ProbeMode))
+def test_probe_modes_report_the_same_blocks(tmp_path, probe_mode, probe_scheduler):
+
+    source_path = tmp_path / "a.c"
+    source_path.write_text("#ifdef CONFIG_A\n#warning COMPILATION_COVERAGE_0\n#else\n#warning COMPILATION_COVERAGE_1\n#endif\nint a;\n")
+
+    probe_command = get_probe_command(f"gcc -Wp,-MD,{tmp_path}/.a.o.d -DCONFIG_A -c {source_path} -o {tmp_path}/a.o", probe_mode)
+
+    assert trigger_compilation_blocks(probe_command, probe_scheduler) == [0]
+
+    written_files = {ProbeMode.COMPILE : [".a.o.d", "a.c", "a.o"], ProbeMode.PREPROCESS : ["a.c"], ProbeMode.SYNTAX : ["a.c"]}
+    assert sorted(os.listdir(tmp_path)) == written_files[probe_mode]
+
+
+def test_instrumentation_marks_the_first_line_of_every_branch(tmp_path):
+
+    source = "#if A && \\\n    B\nint a;\n#ifdef C\n#endif\n#else\nint b;\n#endif\nint c;\n"
+
+    total_blocks, _ = find_compilation_blocks_and_lines(source)
+    instrument_source(total_blocks, source.splitlines(keepends=True), str(tmp_path / "a.c"))
+
+    # after the whole condition, even for blocks without code
+    assert (tmp_path / "a.c").read_text() == (
+        "#if A && \\\n    B\n#warning COMPILATION_COVERAGE_0\nint a;\n"
+        "#ifdef C\n#warning COMPILATION_COVERAGE_1\n#endif\n"
+        "#else\n#warning COMPILATION_COVERAGE_2\nint b;\n#endif\nint c;\n"
+    )
+
+
+def test_source_buffer_reads_the_source_once(tmp_path):
+
+    source_path = tmp_path / "a.c"
+    source_path.write_bytes(b"int a; // \xff\r\n/* b\r\n */ char *s = \"/* c */\";\r\n")
+
+    source_buffer = SourceBuffer(str(source_path))
+
+    assert source_buffer.get_hash() == hash_strategy(str(source_path))
+
+    source_path.unlink()
+
+    # comments are removed with their lines kept, string literals are left alone
+    assert source_buffer.get_lines() == ["int a; \n", "\n", " char *s = \"/* c */\";\n"]
+
+    # undecodable bytes outside of comments are written back as they were
+    source_buffer = SourceBuffer(str(tmp_path / "b.c"))
+    source_buffer.raw = b"char c = '\xff';\n"
+
+    assert source_buffer.get_text().encode("utf-8", errors="surrogateescape") == b"char c = '\xff';\n"
+
+
+def test_normalized_commands_do_not_depend_on_the_app():
+
+    compile_command = "gcc -Wp,-MD,{build}/libfoo/.a.o.d -I{build}/include -DCONFIG_A  -c /w/lib/foo/a.c -o {build}/libfoo/a.o"
+
+    normalized_command = normalize_compilation_command(compile_command.format(build="/apps/one/build"), "/apps/one/build")
+
+    assert normalized_command == "gcc -I$BUILD/include -DCONFIG_A -c /w/lib/foo/a.c"
+    assert normalize_compilation_command(compile_command.format(build="/apps/two/build"), "/apps/two/build") == normalized_command
+    assert normalize_compilation_command(compile_command.format(build="/apps/two/build").replace("CONFIG_A", "CONFIG_B"), "/apps/two/build") != normalized_command
+
+
+def git(repository, *arguments) -> str:
+    return subprocess.run(["git", "-C", str(repository), "-c", "user.name=test", "-c", "user.email=test@test", *arguments], check=True, capture_output=True, text=True).stdout
+
+
+def commit_files(repository, files : dict[str, str]):
+
+    for file_path, text in files.items():
+        (repository / file_path).parent.mkdir(parents=True, exist_ok=True)
+        (repository / file_path).write_text(text)
+
+    git(repository, "add", "-A")
+    git(repository, "commit", "-q", "-m", " ".join(files))
+
+
+def test_environment_fingerprint(tmp_path, monkeypatch):
+
+    config_path = tmp_path / "build" / "include" / "uk" / "_config.h"
+    config_path.parent.mkdir(parents=True)
+    config_path.write_text("#define CONFIG_A 1\n")
+
+    unikraft_root = tmp_path / "unikraft"
+    unikraft_root.mkdir()
+    git(unikraft_root, "init", "-q")
+    git(unikraft_root, "commit", "-q", "--allow-empty", "-m", "first")
+
+    monkeypatch.setenv("UK_ROOT", str(unikraft_root))
+    monkeypatch.delenv("UK_LIBS", raising=False)
+
+    fingerprint = get_environment_fingerprint(str(tmp_path / "build"))
+    assert get_environment_fingerprint(str(tmp_path / "build")) == fingerprint
+
+    config_path.write_text("#define CONFIG_A 1\n#define CONFIG_B 1\n")
+    config_fingerprint = get_environment_fingerprint(str(tmp_path / "build"))
+    assert config_fingerprint != fingerprint
+
+    git(unikraft_root, "commit", "-q", "--allow-empty", "-m", "second")
+    assert get_environment_fingerprint(str(tmp_path / "build")) not in [fingerprint, config_fingerprint]
+
+
+def test_git_version_index_agrees_with_git_log(tmp_path):
+
+    unikraft_root = tmp_path / "unikraft"
+    unikraft_root.mkdir()
+    git(unikraft_root, "init", "-q")
+
+    commit_files(unikraft_root, {"lib/a.c" : "a", "lib/b.c" : "b", "lib/dir with spaces/c.c" : "c"})
+    commit_files(unikraft_root, {"lib/a.c" : "a2"})
+    commit_files(unikraft_root, {"lib/b.c" : "b2", "lib/d.c" : "d"})
+
+    # a lib with its own repository inside the tree
+    lib_root = unikraft_root / "libs" / "foo"
+    lib_root.mkdir(parents=True)
+    git(lib_root, "init", "-q")
+    commit_files(lib_root, {"foo.c" : "foo"})
+
+    (unikraft_root / "lib" / "untracked.c").write_text("untracked")
+
+    index = GitVersionIndex()
+
+    for source_path in ["lib/a.c", "lib/b.c", "lib/d.c", "lib/dir with spaces/c.c", "libs/foo/foo.c", "lib/untracked.c"]:
+        real_src_path = unikraft_root / source_path
+        assert index.get_latest_commit(str(real_src_path)) == git(real_src_path.parent, "log", "-n", "1", "--pretty=format:%H", real_src_path.name)
+
+    # one walk per repository
+    assert sorted(index.repositories) == [str(unikraft_root), str(lib_root)]
+    assert index.get_latest_commit(str(tmp_path / "outside.c")) == ""
+
+
+def test_git_version_index_agrees_with_git_log_across_merges(tmp_path, monkeypatch):
+
+    repository = tmp_path / "unikraft"
+    repository.mkdir()
+    git(repository, "init", "-q")
+
+    commit_dates = iter(range(1, 100))
+
+    def commit(files : dict[str, str]):
+        monkeypatch.setenv("GIT_COMMITTER_DATE", f"{1000000000 + next(commit_dates) * 1000} +0000")
+        commit_files(repository, files)
+
+    def merge(*arguments):
+        monkeypatch.setenv("GIT_COMMITTER_DATE", f"{1000000000 + next(commit_dates) * 1000} +0000")
+        git(repository, "merge", "-q", "--no-ff", "--no-edit", *arguments)
+
+    commit({"a.c" : "a", "b.c" : "b", "c.c" : "c", "e.c" : "e"})
+    main_branch = git(repository, "rev-parse", "--abbrev-ref", "HEAD").strip()
+
+    git(repository, "checkout", "-q", "-b", "side")
+    commit({"a.c" : "a2"})
+    git(repository, "checkout", "-q", main_branch)
+    commit({"b.c" : "b2"})
+    # a.c comes from the side branch
+    merge("side")
+
+    git(repository, "checkout", "-q", "side")
+    commit({"a.c" : "a3"})
+    git(repository, "checkout", "-q", main_branch)
+    commit({"c.c" : "c2"})
+    # the newest change of a.c is dropped by the merge
+    merge("-s", "ours", "side")
+
+    git(repository, "checkout", "-q", "side")
+    commit({"b.c" : "b3"})
+    git(repository, "checkout", "-q", main_branch)
+    # b.c is changed by the merge itself
+    merge("--no-commit", "-X", "theirs", "side")
+    commit({"b.c" : "b4"})
+
+    index = GitVersionIndex()
+
+    for file_name in ["a.c", "b.c", "c.c", "e.c"]:
+        assert index.get_latest_commit(str(repository / file_name)) == git(repository, "log", "-n", "1", "--pretty=format:%H", "--", file_name)
+
+    # files no merge changed are served by the index alone
+    assert "e.c" not in index.merge_paths[str(repository)]
@@ -0,0 +1,83 @@
+import pytest
+from helpers import SourceBuffer, instrument_source, trigger_compilation_blocks
+from linemarker_engine import find_surviving_lines, trigger_compilation_blocks_linemarkers
+from probe_scheduler import ProbeError
+from symbol_engine import find_compilation_blocks_and_lines
+
+SOURCE = """#include "foo.h"
+#ifdef CONFIG_A
+int a1;
+#if FOO > 1
+int a2;
+#elif FOO == 1
+#define A3 1
+#else
+int a4;
+#endif
+#else
+#include "bar.h"
+#endif
+#if defined(CONFIG_B) && !defined(CONFIG_A)
+int b1;
+#endif
+int main(void) { return 0; }
+"""
+
+
+@pytest.fixture
+def lib_dir(tmp_path):
+
+    lib_dir = tmp_path / "lib"
+    lib_dir.mkdir()
+
+    (lib_dir / "foo.h").write_text("#define FOO 1\n")
+    (lib_dir / "bar.h").write_text("\n")
+    (lib_dir / "a.c").write_text(SOURCE)
+
+    return lib_dir
+
+
+def test_find_surviving_lines():
+
+    preprocessed_code = '# 1 "a.c"\n# 1 "foo.h" 1\nint foo;\n# 2 "a.c" 2\n\nint a;\n#define A 1\n'
+
+    assert find_surviving_lines(preprocessed_code) == {"a.c" : {1, 3, 4}, "foo.h" : {1}}
+
+
+@pytest.mark.parametrize("flags", ["", "-DCONFIG_A", "-DCONFIG_B", "-DCONFIG_A -DCONFIG_B"])
+def test_linemarker_engine_agrees_with_the_warning_engine(lib_dir, tmp_path, flags, probe_scheduler):
+
+    source_buffer = SourceBuffer(str(lib_dir / "a.c"))
+    total_blocks, _ = find_compilation_blocks_and_lines(source_buffer.get_text())
+
+    compile_command = f"gcc -Wp,-MD,{tmp_path}/.a.o.d {flags} -c {lib_dir}/a.c -o {tmp_path}/a.o"
+
+    linemarker_blocks = trigger_compilation_blocks_linemarkers(total_blocks, compile_command, str(lib_dir / "a.c"), probe_scheduler)
+
+    # the unmodified source was only preprocessed
+    assert (lib_dir / "a.c").read_text() == SOURCE
+    assert not (tmp_path / "a.o").exists()
+
+    instrument_source(total_blocks, source_buffer.get_lines(), str(lib_dir / "a.c"))
+
+    assert sorted(linemarker_blocks) == sorted(trigger_compilation_blocks(compile_command, probe_scheduler))
+
+
+def test_blocks_without_code_are_not_activated(lib_dir, tmp_path, probe_scheduler):
+
+    (lib_dir / "a.c").write_text("#ifndef CONFIG_A\n#endif\nint a;\n")
+
+    total_blocks, _ = find_compilation_blocks_and_lines(SourceBuffer(str(lib_dir / "a.c")).get_text())
+
+    assert trigger_compilation_blocks_linemarkers(total_blocks, f"gcc -c {lib_dir}/a.c -o {tmp_path}/a.o", str(lib_dir / "a.c"), probe_scheduler) == []
+
+
+def test_failed_preprocessing_is_a_probe_error(lib_dir, tmp_path, probe_scheduler):
+
+    # everything after the missing header would look never activated
+    (lib_dir / "a.c").write_text("#include \"missing.h\"\n#ifndef CONFIG_A\nint a;\n#endif\n")
+
+    total_blocks, _ = find_compilation_blocks_and_lines(SourceBuffer(str(lib_dir / "a.c")).get_text())
+
+    with pytest.raises(ProbeError, match="missing.h"):
+        trigger_compilation_blocks_linemarkers(total_blocks, f"gcc -c {lib_dir}/a.c -o {tmp_path}/a.o", str(lib_dir / "a.c"), probe_scheduler)
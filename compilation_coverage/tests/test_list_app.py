@@ -0,0 +1,26 @@
+import list_app
+from list_app import get_apps_coverage, list_app_subcommand
+
+
+def test_apps_coverage_is_read_from_the_total_summaries(storage):
+
+    storage.register_compilation("app-a", "/apps/a")
+    storage.register_compilation("app-b", "/apps/b")
+
+    storage.replace_summaries([
+        {"tag" : "app-a", "scope" : "total", "key" : "", "compiled_lines" : 19, "total_lines" : 30, "sources" : 2},
+        {"tag" : "app-a", "scope" : "lib", "key" : "libfoo", "compiled_lines" : 4, "total_lines" : 10, "sources" : 1},
+        {"tag" : "deleted-app", "scope" : "total", "key" : "", "compiled_lines" : 20, "total_lines" : 20, "sources" : 1}
+    ])
+
+    # summaries of deleted compilations are dropped, compilations without a summary are listed with 0 lines
+    assert get_apps_coverage() == [("app-a", 19, 30), ("app-b", 0, 0)]
+
+
+def test_app_without_lines_has_a_zero_ratio(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(list_app, "get_apps_coverage", lambda : [("app-a", 0, 0)])
+
+    list_app_subcommand(str(tmp_path / "out.ansi"))
+
+    assert "Ratio:0\n" in (tmp_path / "out.ansi").read_text()
@@ -0,0 +1,72 @@
+import time
+from helpers import SourceBuffer, get_instrumented_code
+from parse_stage import ParseStage, parse_source_file, unpack_block
+from symbol_engine import find_compilation_blocks_and_lines, find_children
+
+SOURCES = {
+    "a.c" : "#ifdef CONFIG_A /* a */\nint a;\n#if B\nint b;\n#endif\n#else\nint na;\n#endif\n",
+    "b.c" : "int b;\n",
+    "c.c" : "#if C && \\\n    D\nint c;\n#endif\n"
+}
+
+
+def write_sources(tmp_path) -> list[str]:
+
+    for name, text in SOURCES.items():
+        (tmp_path / name).write_text(text)
+
+    return [str(tmp_path / name) for name in SOURCES]
+
+
+def parse_in_worker(real_src_path : str) -> tuple:
+
+    source_buffer = SourceBuffer(real_src_path)
+    total_blocks, universal_lines = find_compilation_blocks_and_lines(source_buffer.get_text())
+    find_children(total_blocks)
+
+    return [compile_block.to_mongo_dict() for compile_block in total_blocks], universal_lines, get_instrumented_code(total_blocks, source_buffer.get_lines())
+
+
+def unpack(parsed_source) -> tuple:
+    return [unpack_block(packed_block).to_mongo_dict() for packed_block in parsed_source.compile_blocks], parsed_source.universal_lines, parsed_source.instrumented_code
+
+
+def test_parse_process_agrees_with_the_worker(tmp_path):
+
+    for real_src_path in write_sources(tmp_path):
+
+        parsed_source = parse_source_file(real_src_path, True)
+
+        assert parsed_source.source_hash == SourceBuffer(real_src_path).get_hash()
+        assert unpack(parsed_source) == parse_in_worker(real_src_path)
+
+    assert parse_source_file(str(tmp_path / "a.c"), False).instrumented_code == None
+
+
+def test_workers_take_what_the_stage_parsed(tmp_path):
+
+    real_src_paths = write_sources(tmp_path)
+
+    parse_stage = ParseStage(2, real_src_paths + [str(tmp_path / "missing.c")], instrument= True)
+
+    try:
+        # the window holds every source, wait for the feeder to submit them all
+        deadline = time.monotonic() + 10
+        while len(parse_stage.futures) < 4 and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        assert unpack(parse_stage.take(real_src_paths[1])) == parse_in_worker(real_src_paths[1])
+        assert unpack(parse_stage.take(real_src_paths[0])) == parse_in_worker(real_src_paths[0])
+
+        # taken once, the worker parses it itself the second time
+        assert parse_stage.take(real_src_paths[0]) == None
+
+        parse_stage.discard(real_src_paths[2])
+        assert parse_stage.take(real_src_paths[2]) == None
+
+        # a failed parse is left to the worker as well
+        assert parse_stage.take(str(tmp_path / "missing.c")) == None
+        assert parse_stage.take(str(tmp_path / "never_scheduled.c")) == None
+
+    finally:
+        parse_stage.close()
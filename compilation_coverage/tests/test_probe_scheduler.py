@@ -0,0 +1,183 @@
+import os
+import time
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+import probe_scheduler
+from probe_scheduler import ProbeScheduler, ProbeError, find_jobserver
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(probe_scheduler, "RETRY_DELAY", 0)
+    monkeypatch.setattr(probe_scheduler, "LOAD_POLL_INTERVAL", 0.01)
+    monkeypatch.delenv("MAKEFLAGS", raising=False)
+
+
+def run_concurrent_probes(scheduler : ProbeScheduler, probes : int, tmp_path) -> int:
+
+    '''
+    :return: Most probes that were running at the same time
+    '''
+
+    running_dir = tmp_path / "running"
+    running_dir.mkdir()
+
+    counts_path = tmp_path / "counts"
+
+    # every probe counts the probes running next to it, itself included
+    command = f"touch {running_dir}/$$; ls {running_dir} | wc -l >> {counts_path}; sleep 0.3; rm {running_dir}/$$"
+
+    with ThreadPoolExecutor(max_workers=probes) as pool:
+        results = list(pool.map(lambda _ : scheduler.run(command), range(probes)))
+
+    assert [result.returncode for result in results] == [0] * probes
+
+    counts = [int(line) for line in counts_path.read_text().split()]
+
+    assert len(counts) == probes
+
+    return max(counts)
+
+
+def is_running(pid : int) -> bool:
+
+    # a killed process may stay a zombie until its new parent reaps it
+    try:
+        with open(f"/proc/{pid}/stat") as stat:
+            return stat.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except FileNotFoundError:
+        return False
+
+
+def test_exit_code_is_not_checked():
+
+    with ProbeScheduler(max_probes=1) as scheduler:
+        result = scheduler.run("echo out; echo err >&2; false", capture_stdout=True)
+
+    assert result.returncode == 1
+    assert result.stdout == b"out\n"
+    assert result.stderr == b"err\n"
+
+
+def test_timeout_kills_the_probe_and_retries(tmp_path):
+
+    attempts_path = tmp_path / "attempts"
+
+    # the shell and the sleep it started both have to go
+    command = f"sleep 30 & echo $! >> {attempts_path}; wait"
+
+    started = time.monotonic()
+
+    with ProbeScheduler(max_probes=1, timeout=0.3, retries=2) as scheduler:
+        with pytest.raises(ProbeError, match="timed out"):
+            scheduler.run(command)
+
+    assert time.monotonic() - started < 10
+
+    sleep_pids = [int(line) for line in attempts_path.read_text().split()]
+
+    assert len(sleep_pids) == 3
+
+    deadline = time.monotonic() + 5
+    while any(is_running(pid) for pid in sleep_pids) and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    assert not any(is_running(pid) for pid in sleep_pids)
+
+
+def test_probe_that_finishes_on_retry(tmp_path):
+
+    marker_path = tmp_path / "marker"
+
+    # the first attempt hangs, the second one finds the marker and exits at once
+    command = f"if [ -e {marker_path} ]; then echo retried; else touch {marker_path}; sleep 30; fi"
+
+    with ProbeScheduler(max_probes=1, timeout=0.3, retries=1) as scheduler:
+        result = scheduler.run(command, capture_stdout=True)
+
+    assert result.returncode == 0
+    assert result.stdout == b"retried\n"
+
+
+def test_no_retry_without_timeout(tmp_path):
+
+    attempts_path = tmp_path / "attempts"
+
+    with ProbeScheduler(max_probes=1, timeout=5, retries=3) as scheduler:
+        result = scheduler.run(f"echo attempt >> {attempts_path}; exit 3")
+
+    assert result.returncode == 3
+    assert attempts_path.read_text() == "attempt\n"
+
+
+@pytest.mark.parametrize("max_probes", [1, 3])
+def test_concurrency_never_exceeds_max_probes(max_probes, tmp_path):
+
+    with ProbeScheduler(max_probes=max_probes) as scheduler:
+        assert run_concurrent_probes(scheduler, 6, tmp_path) == max_probes
+
+
+def test_high_load_runs_one_probe_at_a_time(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(os, "getloadavg", lambda : (100.0, 100.0, 100.0))
+
+    with ProbeScheduler(max_probes=4, max_load=2.0) as scheduler:
+        assert run_concurrent_probes(scheduler, 4, tmp_path) == 1
+
+
+def test_low_load_does_not_limit_probes(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(os, "getloadavg", lambda : (0.5, 0.5, 0.5))
+
+    with ProbeScheduler(max_probes=4, max_load=2.0) as scheduler:
+        assert run_concurrent_probes(scheduler, 4, tmp_path) == 4
+
+
+def open_pipe_jobserver(tmp_path) -> tuple[str, int, int]:
+
+    read_fd, write_fd = os.pipe()
+
+    return f"-j3 --jobserver-auth={read_fd},{write_fd}", read_fd, write_fd
+
+
+def open_fifo_jobserver(tmp_path) -> tuple[str, int, int]:
+
+    fifo_path = tmp_path / "jobserver"
+    os.mkfifo(fifo_path)
+
+    fifo_fd = os.open(fifo_path, os.O_RDWR)
+
+    return f"-j3 --jobserver-auth=fifo:{fifo_path}", fifo_fd, fifo_fd
+
+
+@pytest.mark.parametrize("open_jobserver", [open_pipe_jobserver, open_fifo_jobserver], ids=["pipe", "fifo"])
+def test_jobserver_tokens_limit_probes(open_jobserver, tmp_path, monkeypatch):
+
+    makeflags, read_fd, write_fd = open_jobserver(tmp_path)
+
+    # make -j3 keeps one job for itself, the implicit one, and puts the two others in the pipe
+    os.write(write_fd, b"++")
+    monkeypatch.setenv("MAKEFLAGS", makeflags)
+
+    with ProbeScheduler(max_probes=8, use_jobserver=True) as scheduler:
+        assert scheduler.jobserver != None
+        assert run_concurrent_probes(scheduler, 6, tmp_path) == 3
+
+    # every token went back to make
+    os.set_blocking(read_fd, False)
+    assert os.read(read_fd, 16) == b"++"
+
+    for fd in {read_fd, write_fd}:
+        os.close(fd)
+
+
+def test_unusable_jobserver_is_ignored(monkeypatch):
+
+    # make did not pass the pipe, the recipe was not marked with +
+    read_fd, write_fd = os.pipe()
+    os.close(read_fd)
+    os.close(write_fd)
+
+    monkeypatch.setenv("MAKEFLAGS", f"-j3 --jobserver-auth={read_fd},{write_fd}")
+
+    assert find_jobserver() == None
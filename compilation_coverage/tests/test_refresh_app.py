@@ -0,0 +1,150 @@
+import subprocess
+import pytest
+import refresh_app
+from add_app import AnalysisOptions, ActivationEngine, bind_compilation, init_source_document
+from helpers import SourceBuffer, get_source_version_info
+from probe_scheduler import ProbeError
+from refresh_app import get_changed_sources, refresh_app_subcommand
+from storage import get_storage
+from summaries import TOTAL_SCOPE, queue_summary_deltas
+from symbol_engine import find_compilation_blocks_and_lines, find_children
+
+SOURCE_PATH = "unikraft/lib/foo/foo.c"
+
+ORIGINAL_SOURCE = (
+    "int a;\n"
+    "#ifdef CONFIG_A\n"
+    "int b;\n"
+    "#endif\n"
+)
+
+CHANGED_SOURCE = ORIGINAL_SOURCE + (
+    "#ifdef CONFIG_B\n"
+    "int c;\n"
+    "int d;\n"
+    "#endif\n"
+)
+
+
+def git(repository, *arguments):
+    subprocess.run(["git", "-C", str(repository), "-c", "user.name=t", "-c", "user.email=t@t", *arguments], check=True, capture_output=True)
+
+
+@pytest.fixture
+def unikraft_tree(tmp_path, monkeypatch):
+
+    '''
+    Unikraft tree with one committed source, tagged "before", and no lib repository.
+    '''
+
+    monkeypatch.setenv("UK_WORKDIR", str(tmp_path))
+    monkeypatch.setenv("UK_ROOT", str(tmp_path / "unikraft"))
+    monkeypatch.setenv("UK_LIBS", str(tmp_path / "libs"))
+
+    source = tmp_path / SOURCE_PATH
+    source.parent.mkdir(parents=True)
+    source.write_text(ORIGINAL_SOURCE)
+    (source.parent / "gone.c").write_text("int gone;\n")
+
+    git(tmp_path / "unikraft", "init", "-q")
+    git(tmp_path / "unikraft", "add", ".")
+    git(tmp_path / "unikraft", "commit", "-q", "-m", "before")
+    git(tmp_path / "unikraft", "tag", "before")
+
+    return tmp_path
+
+
+def test_changed_sources_include_uncommitted_changes_but_not_deleted_sources(unikraft_tree):
+
+    (unikraft_tree / SOURCE_PATH).write_text(CHANGED_SOURCE)
+    (unikraft_tree / "unikraft/lib/foo/gone.c").unlink()
+    (unikraft_tree / "unikraft/lib/foo/foo.h").write_text("int h;\n")
+    git(unikraft_tree / "unikraft", "add", ".")
+
+    assert get_changed_sources("before") == [SOURCE_PATH]
+    assert get_changed_sources("no-such-revision") == []
+
+
+def register_original_source(storage, unikraft_tree):
+
+    real_src_path = str(unikraft_tree / SOURCE_PATH)
+
+    total_blocks, universal_lines = find_compilation_blocks_and_lines(SourceBuffer(real_src_path).get_text())
+    find_children(total_blocks)
+    source_document = init_source_document(real_src_path, total_blocks, universal_lines, "libfoo", get_source_version_info(real_src_path))
+
+    writer = storage.create_writer(10, None)
+
+    for compilation_tag in ["app-a", "app-b"]:
+        _, compilation_bit = storage.register_compilation(compilation_tag, f"/apps/{compilation_tag}")
+        bind_compilation(source_document, [0], compilation_tag, compilation_bit)
+        writer.queue_compile_command(compilation_tag, SOURCE_PATH, "libfoo", f"gcc -DTAG={compilation_tag} -c {real_src_path} -o foo.o")
+
+    writer.queue_new_source(source_document)
+    queue_summary_deltas(writer, {}, source_document)
+    writer.flush()
+
+
+def replace_probes(monkeypatch, activations : dict[str, object]) -> list[str]:
+
+    '''
+    Replaces the compiler probes by the activations of every compilation, an exception is raised instead of returned.
+    '''
+
+    probed_commands = []
+
+    def probe_changed_source(changed_source, compile_command, options):
+
+        probed_commands.append(compile_command)
+        activation = activations[compile_command.split()[1].removeprefix("-DTAG=")]
+
+        if isinstance(activation, Exception):
+            raise activation
+
+        return activation
+
+    monkeypatch.setattr(refresh_app, "probe_changed_source", probe_changed_source)
+
+    return probed_commands
+
+
+def get_total_summaries(storage) -> list[tuple]:
+    return [(summary["tag"], summary["compiled_lines"], summary["total_lines"]) for summary in storage.get_summaries(["app-a", "app-b"], TOTAL_SCOPE)]
+
+
+def test_refresh_rebinds_every_stored_compilation(storage, unikraft_tree, tmp_path, monkeypatch):
+
+    register_original_source(storage, unikraft_tree)
+    (unikraft_tree / SOURCE_PATH).write_text(CHANGED_SOURCE)
+
+    probed_commands = replace_probes(monkeypatch, {"app-a" : [0], "app-b" : [0, 1]})
+
+    refresh_app_subcommand("before", AnalysisOptions(engine=ActivationEngine.LINEMARKER), str(tmp_path / "out.txt"))
+
+    assert len(probed_commands) == 2
+
+    source_document = storage.prefetch_sources([SOURCE_PATH])[SOURCE_PATH]
+
+    assert len(source_document["compile_blocks"]) == 2
+    assert source_document["compiled_stats"] == {"app-a" : 2, "app-b" : 4}
+    assert get_total_summaries(storage) == [("app-a", 2, 4), ("app-b", 4, 4)]
+
+    assert "Refreshed 1 sources" in (tmp_path / "out.txt").read_text()
+
+
+def test_refresh_keeps_the_stored_version_when_a_probe_fails(storage, unikraft_tree, tmp_path, monkeypatch):
+
+    register_original_source(storage, unikraft_tree)
+    (unikraft_tree / SOURCE_PATH).write_text(CHANGED_SOURCE)
+
+    replace_probes(monkeypatch, {"app-a" : [0], "app-b" : ProbeError("timed out")})
+
+    refresh_app_subcommand("before", AnalysisOptions(engine=ActivationEngine.LINEMARKER), str(tmp_path / "out.txt"))
+
+    source_document = storage.prefetch_sources([SOURCE_PATH])[SOURCE_PATH]
+
+    assert len(source_document["compile_blocks"]) == 1
+    assert get_total_summaries(storage) == [("app-a", 2, 2), ("app-b", 2, 2)]
+
+    assert storage.get_source_failures("app-b") == [{"source_path" : SOURCE_PATH, "lib" : "libfoo", "reason" : "timed out"}]
+    assert "1 sources could not be refreshed" in (tmp_path / "out.txt").read_text()
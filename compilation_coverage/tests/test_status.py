@@ -0,0 +1,27 @@
+from status import get_source_roots, find_local_sources
+
+
+def make_local_tree(workdir, source_paths : list[str]):
+
+    for source_path in source_paths:
+        (workdir / source_path).parent.mkdir(parents=True, exist_ok=True)
+        (workdir / source_path).write_text("int a;\n")
+
+
+def test_local_sources_skip_build_and_hidden_directories(tmp_path, monkeypatch):
+
+    make_local_tree(tmp_path, ["unikraft/lib/a.c", "unikraft/lib/a.h", "unikraft/build/b.c", "unikraft/.git/c.c", "libs/foo/d.c", "libs/foo/.hidden/e.c", "apps/app/main.c"])
+
+    monkeypatch.setenv("UK_WORKDIR", str(tmp_path))
+    monkeypatch.setenv("UK_ROOT", str(tmp_path / "unikraft"))
+    monkeypatch.setenv("UK_LIBS", str(tmp_path / "libs"))
+
+    assert get_source_roots() == [str(tmp_path / "unikraft"), str(tmp_path / "libs" / "foo")]
+    assert sorted(find_local_sources(get_source_roots())) == ["libs/foo/d.c", "unikraft/lib/a.c"]
+
+    # the whole workdir without a configured tree
+    monkeypatch.delenv("UK_ROOT")
+    monkeypatch.delenv("UK_LIBS")
+
+    assert get_source_roots() == [str(tmp_path)]
+    assert sorted(find_local_sources(get_source_roots())) == ["apps/app/main.c", "libs/foo/d.c", "unikraft/lib/a.c"]
@@ -0,0 +1,215 @@
+import re
+import pytest
+from add_app import AnalysisOptions, SourceStatus, bind_compilation, unbind_compilation, update_db_activated_compile_blocks
+from compilation_bits import TRIGGERED_BITS_FIELD, is_empty
+from status import status_subcommand
+from summaries import TOTAL_SCOPE, get_summary_contributions, queue_summary_deltas
+from conftest import make_block, make_source_document
+
+LIB = "libfoo"
+
+
+def register_source(storage, source_document : dict, activations : dict[str, list[int]], split_threshold : int = None):
+
+    compilation_bits = storage.get_compilation_bits()
+
+    for compilation_tag, activated_block_counters in activations.items():
+        bind_compilation(source_document, activated_block_counters, compilation_tag, compilation_bits[compilation_tag])
+
+    writer = storage.create_writer(10, split_threshold)
+    writer.queue_new_source(source_document)
+    queue_summary_deltas(writer, {}, source_document)
+    writer.flush()
+
+
+def activate_source(storage, source_document : dict, compilation_tag : str, activated_block_counters : list[int]):
+
+    options = AnalysisOptions(
+        writer= storage.create_writer(10, None),
+        compilation_bit= storage.get_compilation_bits([compilation_tag])[compilation_tag]
+    )
+
+    update_db_activated_compile_blocks(SourceStatus.EXISTING, source_document, None, get_summary_contributions(source_document), activated_block_counters, compilation_tag, options)
+
+    options.writer.flush()
+
+
+def unbind_source(storage, source_path : str, compilation_tag : str):
+
+    source_document = storage.prefetch_sources([source_path])[source_path]
+    compilation_bit = storage.get_compilation_bits([compilation_tag])[compilation_tag]
+
+    previous_contributions = get_summary_contributions(source_document)
+
+    writer = storage.create_writer(10, None)
+    writer.queue_unbind(source_document, compilation_tag, compilation_bit)
+    unbind_compilation(source_document, compilation_tag, compilation_bit)
+    queue_summary_deltas(writer, previous_contributions, source_document)
+    writer.flush()
+
+    return source_document
+
+
+def get_total_summaries(storage, compilation_tags : list[str]) -> list[tuple]:
+    return [(summary["tag"], summary["compiled_lines"], summary["total_lines"], summary["sources"]) for summary in storage.get_summaries(compilation_tags, TOTAL_SCOPE)]
+
+
+def test_prefetch_returns_the_registered_document(storage):
+
+    storage.register_compilation("app-a", "/apps/a")
+
+    source_document = make_source_document("lib/foo/foo.c", LIB, [make_block(0, -1, 4, [1]), make_block(1, 0, 2)])
+    register_source(storage, source_document, {"app-a" : [0]})
+
+    stored_document = storage.prefetch_sources(["lib/foo/foo.c", "lib/foo/missing.c"])
+
+    assert list(stored_document.keys()) == ["lib/foo/foo.c"]
+    assert {key : value for key, value in stored_document["lib/foo/foo.c"].items() if key != "_id"} == source_document
+
+
+def test_activation_updates_summaries(storage):
+
+    storage.register_compilation("app-a", "/apps/a")
+    storage.register_compilation("app-b", "/apps/b")
+
+    register_source(storage, make_source_document("lib/foo/foo.c", LIB, [make_block(0, -1, 4), make_block(1, -1, 6)]), {"app-a" : [0]})
+
+    activate_source(storage, storage.prefetch_sources(["lib/foo/foo.c"])["lib/foo/foo.c"], "app-b", [1])
+
+    assert get_total_summaries(storage, ["app-a", "app-b"]) == [("app-a", 14, 20, 1), ("app-b", 16, 20, 1)]
+
+
+def test_dropped_activation_leaves_summaries_alone(storage):
+
+    storage.register_compilation("app-a", "/apps/a")
+    storage.register_compilation("app-b", "/apps/b")
+
+    register_source(storage, make_source_document("lib/foo/foo.c", LIB, [make_block(0, -1, 4), make_block(1, -1, 6)]), {"app-a" : [0]})
+
+    # app-b prefetches the source, then another run registers a new version of it
+    stale_document = storage.prefetch_sources(["lib/foo/foo.c"])["lib/foo/foo.c"]
+
+    replacing_document = make_source_document("lib/foo/foo.c", LIB, [make_block(0, -1, 8)], commit_id="beef")
+    bind_compilation(replacing_document, [0], "app-a", storage.get_compilation_bits(["app-a"])["app-a"])
+
+    writer = storage.create_writer(10, None)
+    writer.queue_replaced_source(replacing_document, stale_document)
+    queue_summary_deltas(writer, get_summary_contributions(stale_document), replacing_document)
+    writer.flush()
+
+    activate_source(storage, stale_document, "app-b", [1])
+
+    assert "app-b" not in storage.prefetch_sources(["lib/foo/foo.c"])["lib/foo/foo.c"]["compiled_stats"]
+    assert get_total_summaries(storage, ["app-a", "app-b"]) == [("app-a", 18, 18, 1)]
+
+
+def test_unbound_source_is_never_triggered(storage):
+
+    storage.register_compilation("app-a", "/apps/a")
+
+    register_source(storage, make_source_document("lib/foo/foo.c", LIB, [make_block(0, -1, 4), make_block(1, -1, 6)]), {"app-a" : [0]})
+
+    unbound_document = unbind_source(storage, "lib/foo/foo.c", "app-a")
+
+    assert unbound_document[TRIGGERED_BITS_FIELD] == {}
+    assert all(compile_block[TRIGGERED_BITS_FIELD] == {} for compile_block in unbound_document["compile_blocks"])
+
+    # whatever words the backend keeps, none of them has a compilation
+    stored_document = storage.prefetch_sources(["lib/foo/foo.c"])["lib/foo/foo.c"]
+
+    assert is_empty(stored_document[TRIGGERED_BITS_FIELD])
+    assert all(is_empty(compile_block[TRIGGERED_BITS_FIELD]) for compile_block in stored_document["compile_blocks"])
+
+    status = storage.get_global_status(details=True)
+
+    assert status["libs"] == [{"lib" : LIB, "compiled_lines" : 0, "total_lines" : 20, "sources" : 1, "blocks" : 2, "never_triggered_blocks" : 2}]
+    # still registered, but never compiled anymore
+    assert list(status["compiled_source_paths"]) == []
+    assert status["never_triggered_block_list"] == [
+        {
+            "source_path" : "lib/foo/foo.c",
+            "never_triggered_block_list" : [{"start_line" : 1, "symbol_condition" : "CONFIG_0"}, {"start_line" : 11, "symbol_condition" : "CONFIG_1"}]
+        }
+    ]
+
+
+def test_unbind_keeps_the_other_compilations(storage):
+
+    storage.register_compilation("app-a", "/apps/a")
+    storage.register_compilation("app-b", "/apps/b")
+
+    register_source(storage, make_source_document("lib/foo/foo.c", LIB, [make_block(0, -1, 4), make_block(1, -1, 6)]), {"app-a" : [0, 1], "app-b" : [1]})
+
+    unbind_source(storage, "lib/foo/foo.c", "app-a")
+
+    status = storage.get_global_status(details=False)
+
+    assert status["libs"] == [{"lib" : LIB, "compiled_lines" : 16, "total_lines" : 20, "sources" : 1, "blocks" : 2, "never_triggered_blocks" : 1}]
+    assert list(status["compiled_source_paths"]) == ["lib/foo/foo.c"]
+
+
+STATUS_OUTPUT = """Compilations: 2
+All libs: Compiled: 23, Total: 30, Ratio: 76.67%, Sources: 2, Never triggered blocks: 3/4
+Never compiled sources: 1
+Libs
+	libbar: Compiled: 7, Total: 8, Ratio: 87.50%, Sources: 1, Never triggered blocks: 1/1
+	libfoo: Compiled: 16, Total: 22, Ratio: 72.73%, Sources: 1, Never triggered blocks: 2/3
+Never compiled sources
+	lib/baz/baz.c
+Never triggered blocks
+	lib/bar/bar.c:1 CONFIG_0
+	lib/foo/foo.c:1 CONFIG_0
+	lib/foo/foo.c:11 CONFIG_1
+"""
+
+
+@pytest.mark.parametrize("split_threshold", [None, 2], ids=["embedded", "split"])
+def test_status_after_register_activate_unbind(storage, split_threshold, tmp_path, monkeypatch):
+
+    # the never compiled sources are searched in the workdir
+    for source_path in ["lib/foo/foo.c", "lib/bar/bar.c", "lib/baz/baz.c"]:
+        (tmp_path / source_path).parent.mkdir(parents=True)
+        (tmp_path / source_path).write_text("int x;\n")
+
+    monkeypatch.setenv("UK_WORKDIR", str(tmp_path))
+    monkeypatch.delenv("UK_ROOT", raising=False)
+    monkeypatch.delenv("UK_LIBS", raising=False)
+
+    storage.register_compilation("app-a", "/apps/a")
+    storage.register_compilation("app-b", "/apps/b")
+
+    register_source(storage, make_source_document("lib/foo/foo.c", LIB, [make_block(0, -1, 4, [1]), make_block(1, 0, 2), make_block(2, -1, 6)]), {"app-a" : [0, 1]}, split_threshold)
+    register_source(storage, make_source_document("lib/bar/bar.c", "libbar", [make_block(0, -1, 1)], universal_lines=7), {"app-b" : []}, split_threshold)
+
+    activate_source(storage, storage.prefetch_sources(["lib/foo/foo.c"])["lib/foo/foo.c"], "app-b", [2])
+
+    unbind_source(storage, "lib/foo/foo.c", "app-a")
+
+    status_subcommand(str(tmp_path / "status.txt"), details=True)
+
+    # colors are left out, whatever the terminal
+    status_output = re.sub(r"\x1b\[[0-9;]*m", "", (tmp_path / "status.txt").read_text())
+
+    assert status_output == STATUS_OUTPUT
+    assert storage.get_apps_coverage() == [("app-a", 0, 0), ("app-b", 23, 30)]
+
+
+def test_status_counts_unbound_sources_as_never_compiled(storage, tmp_path, monkeypatch):
+
+    (tmp_path / "lib" / "foo").mkdir(parents=True)
+    (tmp_path / "lib" / "foo" / "foo.c").write_text("int x;\n")
+
+    monkeypatch.setenv("UK_WORKDIR", str(tmp_path))
+    monkeypatch.delenv("UK_ROOT", raising=False)
+    monkeypatch.delenv("UK_LIBS", raising=False)
+
+    storage.register_compilation("app-a", "/apps/a")
+
+    register_source(storage, make_source_document("lib/foo/foo.c", LIB, [make_block(0, -1, 4)]), {"app-a" : [0]})
+    unbind_source(storage, "lib/foo/foo.c", "app-a")
+
+    status_subcommand(str(tmp_path / "status.txt"), details=False)
+
+    status_output = re.sub(r"\x1b\[[0-9;]*m", "", (tmp_path / "status.txt").read_text())
+
+    assert "Sources: 1, Never triggered blocks: 1/1\nNever compiled sources: 1\n" in status_output
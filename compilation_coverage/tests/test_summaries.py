@@ -0,0 +1,44 @@
+from summaries import get_source_directories, get_summary_contributions, get_summary_deltas
+
+
+def test_every_directory_of_a_source_has_a_summary():
+
+    assert get_source_directories("lib/foo/bar/a.c") == ["lib/foo/bar", "lib/foo", "lib"]
+    assert get_source_directories("a.c") == []
+
+
+def test_contributions_of_a_source():
+
+    source_document = {"source_path" : "lib/foo/a.c", "lib" : "libfoo", "total_lines" : 20, "compiled_stats" : {"app-a" : 12, "app-b" : 20}}
+
+    assert get_summary_contributions(source_document) == {
+        ("app-a", "total", "") : [12, 20, 1],
+        ("app-a", "lib", "libfoo") : [12, 20, 1],
+        ("app-a", "dir", "lib/foo") : [12, 20, 1],
+        ("app-a", "dir", "lib") : [12, 20, 1],
+        ("app-b", "total", "") : [20, 20, 1],
+        ("app-b", "lib", "libfoo") : [20, 20, 1],
+        ("app-b", "dir", "lib/foo") : [20, 20, 1],
+        ("app-b", "dir", "lib") : [20, 20, 1]
+    }
+
+    assert get_summary_contributions(None) == {}
+
+
+def test_deltas_only_hold_the_changed_summaries():
+
+    previous_document = {"source_path" : "lib/a.c", "lib" : "libfoo", "total_lines" : 20, "compiled_stats" : {"app-a" : 12, "app-b" : 20}}
+
+    # a new version of the source, app-a is compiled again while app-b was dropped with the old version
+    current_document = {"source_path" : "lib/a.c", "lib" : "libfoo", "total_lines" : 22, "compiled_stats" : {"app-a" : 12, "app-c" : 22}}
+
+    deltas = get_summary_deltas(get_summary_contributions(previous_document), current_document)
+
+    for key in [("total", ""), ("lib", "libfoo"), ("dir", "lib")]:
+        assert deltas.pop(("app-a", *key)) == {"compiled_lines" : 0, "total_lines" : 2, "sources" : 0}
+        assert deltas.pop(("app-b", *key)) == {"compiled_lines" : -20, "total_lines" : -20, "sources" : -1}
+        assert deltas.pop(("app-c", *key)) == {"compiled_lines" : 22, "total_lines" : 22, "sources" : 1}
+
+    assert deltas == {}
+
+    assert get_summary_deltas(get_summary_contributions(current_document), current_document) == {}
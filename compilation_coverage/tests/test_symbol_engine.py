@@ -0,0 +1,76 @@
+from helpers import SourceBuffer
+from symbol_engine import find_compilation_blocks_and_lines, find_children
+
+SOURCE = """#include <stdio.h>
+/* comment
+#if NOT_A_BLOCK
+*/
+int g;
+
+#ifdef CONFIG_A
+int a1;
+  # if defined(CONFIG_B) && \\
+       CONFIG_C > 1
+int b1;
+
+int b2;
+  # elif CONFIG_D
+int d1;
+  # else
+int e1;
+  # endif
+int a2;
+#elifndef CONFIG_E
+int n1;
+#endif
+#ifndef CONFIG_F // trailing
+int f1;
+#endif
+#iffy
+int last;"""
+
+
+def test_blocks_of_nested_branches(tmp_path):
+
+    (tmp_path / "a.c").write_text(SOURCE)
+
+    compilation_blocks, universal_lines = find_compilation_blocks_and_lines(SourceBuffer(str(tmp_path / "a.c")).get_text())
+
+    # (condition, start line, end line, id, parent id, lines)
+    assert [
+        (block.symbol_condition, block.start_line, block.end_line, block.block_counter, block.parent_counter, block.lines)
+        for block in compilation_blocks
+    ] == [
+        ("CONFIG_A", 7, 20, 0, -1, 2),
+        ("defined(CONFIG_B) && CONFIG_C > 1", 9, 14, 1, 0, 2),
+        ("CONFIG_D", 14, 16, 2, 0, 1),
+        ("!(CONFIG_D)", 16, 18, 3, 0, 1),
+        ("!(CONFIG_E)", 20, 22, 4, -1, 1),
+        ("!(CONFIG_F)", 23, 25, 5, -1, 1)
+    ]
+
+    # #iffy is not a directive, blank lines and comments are not code
+    assert universal_lines == 4
+
+
+def test_unbalanced_directives_are_ignored(tmp_path):
+
+    (tmp_path / "a.c").write_text("#endif\nint a;\n#else\n#if X\nint b;\n")
+
+    compilation_blocks, universal_lines = find_compilation_blocks_and_lines(SourceBuffer(str(tmp_path / "a.c")).get_text())
+
+    # a block left open at the end of the source is dropped
+    assert compilation_blocks == []
+    assert universal_lines == 1
+
+
+def test_children_follow_the_order_of_the_blocks():
+
+    compilation_blocks, _ = find_compilation_blocks_and_lines(
+        "#ifdef A\nint a;\n#if B\nint b;\n#elif C\n#ifdef D\nint d;\n#endif\n#endif\n#else\nint na;\n#endif\n#ifdef E\n#endif\n"
+    )
+
+    find_children(compilation_blocks)
+
+    # #elif and #else branches are siblings of their #if, blocks nested in any branch are children of the #if
+    assert [(block.block_counter, block.children) for block in compilation_blocks] == [(0, [1, 2]), (1, [3]), (2, []), (3, []), (4, []), (5, [])]
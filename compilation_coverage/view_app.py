@@ -1,25 +1,43 @@
 import logging
-import pymongo
 from colorama import Fore
 import os
-import coverage
-from srcs_trie import SrcsTrie
-from bson.objectid import ObjectId
+from srcs_trie import SrcsTrie, PLACEHOLDER_INFO
+from summaries import get_compilation_summaries, TOTAL_SCOPE, LIB_SCOPE
+from storage import get_storage
 logger = logging.getLogger(__name__)
 from typing import Union
 from helpers import SourceDocument, CompilationBlock
-from pymongo.cursor import Cursor
+
+
+def print_compilation_summaries(compilation_tags : list[str], out_file):
+
+    # precomputed, so the totals do not depend on walking the source trie
+    lib_summaries = get_compilation_summaries(compilation_tags, LIB_SCOPE)
+
+    for total_summary in get_compilation_summaries(compilation_tags, TOTAL_SCOPE):
+
+        out_file.write(f"App: {total_summary['tag']}, Compiled: {total_summary['compiled_lines']}, Total: {total_summary['total_lines']}, Sources: {total_summary['sources']}\n")
+
+        for lib_summary in lib_summaries:
+            if lib_summary["tag"] != total_summary["tag"]:
+                continue
+
+            color = Fore.GREEN if lib_summary["compiled_lines"] == lib_summary["total_lines"] else Fore.RED
+            out_file.write(PLACEHOLDER_INFO + f"{lib_summary['key']}: Compiled: {color}{lib_summary['compiled_lines']}{Fore.RESET}, Total: {lib_summary['total_lines']}, Sources: {lib_summary['sources']}\n")
 
 
 def view_app_subcommand(compilation_tags : list[str], out_file_name : str):
 
-    from coverage import DATABASE, SOURCES_COLLECTION, COMPILATION_COLLECTION, db
+    bits_by_tag = get_storage().get_compilation_bits()
+    tags_by_bit = {compilation_bit : tag for tag, compilation_bit in bits_by_tag.items()}
 
+    compilation_bits = [bits_by_tag[tag] for tag in compilation_tags if tag in bits_by_tag]
 
-    app_src_documents : Union[list[SourceDocument], list[dict]] = db[DATABASE][SOURCES_COLLECTION].find(
-        filter={"triggered_compilations" : {"$in" : compilation_tags}},
-        sort={"source_path" : pymongo.ASCENDING}
-    )
+    for tag in compilation_tags:
+        if tag not in bits_by_tag:
+            logger.warning(f"No compilation registered with tag {tag}")
+
+    app_src_documents : Union[list[SourceDocument], list[dict]] = get_storage().find_sources_by_bits(compilation_bits)
 
     appTrie = SrcsTrie(os.environ["UK_WORKDIR"])
 
@@ -32,7 +50,7 @@ def view_app_subcommand(compilation_tags : list[str], out_file_name : str):
         
         # return
 
-        for tag in src_doc["compiled_stats"]:
+        for tag in list(src_doc["compiled_stats"]):
             if tag not in compilation_tags:
                 del src_doc["compiled_stats"][tag]
         appTrie.add_node(src_doc["source_path"].split("/"), src_doc)
@@ -40,7 +58,9 @@ def view_app_subcommand(compilation_tags : list[str], out_file_name : str):
     
     out_file = open(out_file_name, "a")
 
-    appTrie.print_trie(out_file, compilation_tags)
+    print_compilation_summaries(compilation_tags, out_file)
+
+    appTrie.print_trie(out_file, compilation_bits, tags_by_bit)
 
     
 